@@ -0,0 +1,12 @@
+"""Benchmarks for csvbase-client.
+
+These run against a local stand-in for csvbase (tests/fake_csvbase.py), in a
+child process, with a throwaway cache and config.  Run them from the root of
+the repo, eg:
+
+    python -m benchmarks.bench_fsspec --sizes 1K,1M,16M --latency 0.02
+
+Results are printed as JSON lines, which benchmarks.compare can compare with
+an earlier run.
+
+"""
@@ -0,0 +1,395 @@
+"""How reading tables via the fsspec filesystem scales with the number of
+readers: threads sharing one filesystem (as dask's threaded scheduler does),
+or processes sharing one cache directory (as dask's distributed workers on
+one machine do).
+
+    python -m benchmarks.bench_concurrency --threads 1,4,16,64 --latency 0.02
+
+Each reader opens (and reads all of) tables over and over, either each its own
+table ("distinct") or all the same table ("identical").  Reported, for each
+number of readers:
+
+- throughput: opens per second, across all readers
+- latency percentiles of opening and reading a table
+- lock_wait_seconds: the total time readers spent waiting for the lock on a
+  cache entry (CSVBaseFileSystem._lock_ref)
+- metadata_lock_wait_seconds: the total time spent waiting for the lock on
+  the cache's metadata db (in the process: processes have one each)
+- cache_seconds_per_open: the average time spent reading and writing the cache
+  (which includes waiting for the metadata db)
+
+The stand-in server is a single Python process, so can become the bottleneck
+itself with many readers.  Some --latency keeps it mostly idle, like the real
+thing is from the point of view of a client.
+
+"""
+
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import IO, Any, Callable, Dict, Iterator, List, Tuple
+
+import click
+
+from csvbase_client.fsspec import CSVBaseFileSystem, parse_path
+from csvbase_client.instrumentation import Phase, Stats, add_hook, remove_hook
+from csvbase_client.internals import cache
+from csvbase_client.internals.cache import CHUNK_SIZE
+from csvbase_client.internals.config import parse_size
+from csvbase_client.internals.value_objs import CachePolicy
+
+from .harness import (
+    Result,
+    StandIn,
+    StandInSettings,
+    isolated_environment,
+    parse_counts,
+    percentile,
+    progress,
+    stand_in_options,
+    write_results,
+)
+
+SUITE = "concurrency"
+
+# How the cache is used by each open
+MODES: Dict[str, Dict[str, Any]] = {
+    # downloaded every time
+    "miss": {"cache_policy": CachePolicy.NO_CACHE},
+    # revalidated every time
+    "304": {"max_age": 0},
+    # revalidated once, then not again
+    "fresh": {"max_age": 3600},
+}
+
+REF_PATTERNS = ["distinct", "identical"]
+
+
+class TimedLock:
+    """Wraps a lock, adding up the time spent waiting for it."""
+
+    def __init__(self, lock: Any) -> None:
+        self._lock = lock
+        self.wait_seconds = 0.0
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            # safe, as the lock is held
+            self.wait_seconds += time.perf_counter() - start
+        return acquired
+
+    def release(self) -> None:
+        self._lock.release()
+
+    def __enter__(self) -> "TimedLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.release()
+
+
+@contextmanager
+def timed_metadata_lock() -> Iterator[TimedLock]:
+    """Time waits for the metadata db lock, for the duration.  Nothing may be
+    using the cache when this starts or ends."""
+    original = cache.METADATA_LOCK
+    timed = TimedLock(original)
+    cache.METADATA_LOCK = timed  # type: ignore[assignment]
+    try:
+        yield timed
+    finally:
+        cache.METADATA_LOCK = original
+
+
+@dataclass
+class Measurements:
+    """What happened while some readers were reading."""
+
+    # wall clock times, so comparable between processes
+    started: float = float("inf")
+    finished: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+    lock_wait_seconds: float = 0.0
+    metadata_lock_wait_seconds: float = 0.0
+    cache_seconds: float = 0.0
+
+    def update(self, other: "Measurements") -> None:
+        self.started = min(self.started, other.started)
+        self.finished = max(self.finished, other.finished)
+        self.latencies.extend(other.latencies)
+        self.lock_wait_seconds += other.lock_wait_seconds
+        self.metadata_lock_wait_seconds += other.metadata_lock_wait_seconds
+        self.cache_seconds += other.cache_seconds
+
+
+def read_concurrently(
+    url: str,
+    reader_refs: List[str],
+    opens: int,
+    mode: str,
+    wait_to_start: Callable[[], None] = lambda: None,
+) -> Measurements:
+    """Read tables from one thread per ref in reader_refs, each opening its
+    ref opens times."""
+    fs = CSVBaseFileSystem(skip_instance_cache=True, pool_size=len(reader_refs))
+    fs._base_url = url
+    open_kwargs = MODES[mode]
+    # all start at once, once all are ready
+    barrier = threading.Barrier(len(reader_refs), action=wait_to_start)
+
+    def read(ref: str) -> Tuple[float, float, List[float]]:
+        latencies = []
+        barrier.wait()
+        started = time.time()
+        for _ in range(opens):
+            start = time.perf_counter()
+            with fs.open(ref, "rb", **open_kwargs) as table_f:
+                while table_f.read(CHUNK_SIZE):
+                    pass
+            latencies.append(time.perf_counter() - start)
+        return started, time.time(), latencies
+
+    stats = Stats()
+    add_hook(stats)
+    try:
+        with timed_metadata_lock() as metadata_lock:
+            with ThreadPoolExecutor(len(reader_refs)) as executor:
+                by_reader = list(executor.map(read, reader_refs))
+    finally:
+        remove_hook(stats)
+
+    total = stats.total()
+    measurements = Measurements(
+        lock_wait_seconds=total.phases.get(Phase.LOCK_WAIT, 0.0),
+        metadata_lock_wait_seconds=metadata_lock.wait_seconds,
+        cache_seconds=(
+            total.phases.get(Phase.CACHE_LOOKUP, 0.0)
+            + total.phases.get(Phase.CACHE_WRITE, 0.0)
+        ),
+    )
+    for started, finished, latencies in by_reader:
+        measurements.update(Measurements(started, finished, latencies))
+    return measurements
+
+
+def _read_in_process(
+    url: str, reader_refs: List[str], opens: int, mode: str, barrier: Any
+) -> Measurements:
+    return read_concurrently(url, reader_refs, opens, mode, barrier.wait)
+
+
+def read_in_processes(
+    url: str, process_refs: List[List[str]], opens: int, mode: str
+) -> Measurements:
+    """As read_concurrently, but from one process per list of refs (each
+    with a thread per ref)."""
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        barrier = manager.Barrier(len(process_refs))
+        with context.Pool(len(process_refs)) as pool:
+            by_process = pool.starmap(
+                _read_in_process,
+                [(url, refs, opens, mode, barrier) for refs in process_refs],
+            )
+    measurements = Measurements()
+    for process_measurements in by_process:
+        measurements.update(process_measurements)
+    return measurements
+
+
+def reader_refs(pattern: str, readers: int) -> List[str]:
+    if pattern == "distinct":
+        return [table_ref(n) for n in range(readers)]
+    return [table_ref(0)] * readers
+
+
+def table_ref(n: int) -> str:
+    return f"bench/table-{n}"
+
+
+def prime_cache(url: str, refs: List[str]) -> None:
+    fs = CSVBaseFileSystem(skip_instance_cache=True)
+    fs._base_url = url
+    for ref in refs:
+        fs._get_rep(*parse_path(ref), max_age=0).close()
+
+
+def to_result(
+    benchmark: str, params: Dict[str, Any], measurements: Measurements, size: int
+) -> Result:
+    duration = measurements.finished - measurements.started
+    opens = len(measurements.latencies)
+    latencies = measurements.latencies
+    return Result(
+        suite=SUITE,
+        benchmark=benchmark,
+        params=params,
+        seconds=latencies,
+        bytes=size,
+        extra={
+            "opens": opens,
+            "duration_seconds": duration,
+            "throughput_opens_per_second": opens / duration,
+            "throughput_bytes_per_second": opens * size / duration,
+            "latency_percentiles": {
+                f"p{percent}": percentile(latencies, percent)
+                for percent in [50, 90, 99]
+            },
+            "lock_wait_seconds": measurements.lock_wait_seconds,
+            "lock_wait_fraction": measurements.lock_wait_seconds / sum(latencies),
+            "metadata_lock_wait_seconds": measurements.metadata_lock_wait_seconds,
+            "cache_seconds_per_open": measurements.cache_seconds / opens,
+        },
+    )
+
+
+def run_suite(
+    threads: List[int],
+    processes: List[int],
+    threads_per_process: int,
+    patterns: List[str],
+    mode: str,
+    opens: int,
+    size: int,
+    settings: StandInSettings,
+) -> List[Result]:
+    max_readers = max(threads + [p * threads_per_process for p in processes])
+    tables = {table_ref(n): size for n in range(max_readers)}
+    base_params = {
+        "mode": mode,
+        "opens": opens,
+        "size": size,
+        "latency": settings.latency,
+        "bandwidth": settings.bandwidth,
+        "conditional_requests": settings.conditional_requests,
+        "gzip_responses": settings.gzip_responses,
+    }
+    results = []
+    with isolated_environment(), StandIn(tables, settings) as stand_in:
+        prime_cache(stand_in.url, list(tables))
+        for pattern in patterns:
+            for thread_count in threads:
+                refs = reader_refs(pattern, thread_count)
+                measurements = read_concurrently(stand_in.url, refs, opens, mode)
+                params = dict(base_params, refs=pattern, threads=thread_count)
+                results.append(to_result("threads", params, measurements, size))
+                report(results[-1].as_json())
+            for process_count in processes:
+                refs = reader_refs(pattern, process_count * threads_per_process)
+                process_refs = [refs[n::process_count] for n in range(process_count)]
+                measurements = read_in_processes(
+                    stand_in.url, process_refs, opens, mode
+                )
+                params = dict(
+                    base_params,
+                    refs=pattern,
+                    processes=process_count,
+                    threads_per_process=threads_per_process,
+                )
+                results.append(to_result("processes", params, measurements, size))
+                report(results[-1].as_json())
+    return results
+
+
+def report(result: Dict[str, Any]) -> None:
+    params = result["params"]
+    readers = params.get("threads") or (
+        f"{params['processes']}x{params['threads_per_process']}"
+    )
+    progress(
+        f"{result['benchmark']}={readers} refs={params['refs']}:"
+        f" {result['throughput_opens_per_second']:.0f} opens/s,"
+        f" p50 {result['latency_percentiles']['p50'] * 1000:.1f}ms,"
+        f" p99 {result['latency_percentiles']['p99'] * 1000:.1f}ms,"
+        f" lock wait {result['lock_wait_fraction']:.0%}"
+    )
+
+
+@click.command()
+@click.option(
+    "--threads",
+    default="1,2,4,8,16,32,64",
+    show_default=True,
+    callback=parse_counts,
+    help="Numbers of threads (in one process) to read with, comma separated.",
+)
+@click.option(
+    "--processes",
+    default=f"1,2,{multiprocessing.cpu_count()}",
+    show_default=True,
+    callback=parse_counts,
+    help="Numbers of processes to read with, comma separated.",
+)
+@click.option(
+    "--threads-per-process",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+)
+@click.option(
+    "--refs",
+    "patterns",
+    type=click.Choice(REF_PATTERNS),
+    multiple=True,
+    default=REF_PATTERNS,
+    show_default=True,
+    help="Whether readers read distinct tables or the identical one.",
+)
+@click.option(
+    "--mode",
+    type=click.Choice(list(MODES)),
+    default="304",
+    show_default=True,
+    help="How the cache is used: download every time, revalidate, or neither.",
+)
+@click.option(
+    "--opens",
+    type=click.IntRange(min=1),
+    default=20,
+    show_default=True,
+    help="How many times each reader opens a table.",
+)
+@click.option("--size", default="64K", show_default=True, help="Table size.")
+@stand_in_options
+@click.option(
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="Where to write the results, as JSON lines.",
+)
+def main(
+    threads: List[int],
+    processes: List[int],
+    threads_per_process: int,
+    patterns: Tuple[str, ...],
+    mode: str,
+    opens: int,
+    size: str,
+    settings: StandInSettings,
+    output: IO[str],
+) -> None:
+    try:
+        size_bytes = parse_size(size)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--size")
+    results = run_suite(
+        threads,
+        processes,
+        threads_per_process,
+        list(patterns),
+        mode,
+        opens,
+        size_bytes,
+        settings,
+    )
+    write_results(results, output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Benchmarks of getting, reading and uploading single tables via the fsspec
+filesystem.
+
+    python -m benchmarks.bench_fsspec --sizes 1K,1M,16M --latency 0.02
+
+The benchmarks are:
+
+- get_rep_miss: getting a table that isn't cached
+- get_rep_304: getting a cached table, which csvbase says hasn't changed
+- get_rep_fresh: getting a cached table within max_age, so without asking
+- file_read: reading all of a (cached) table via open()
+- file_read_lazy: reading the first block of an uncached table, lazily
+- upload: writing a table via open(mode="wb")
+
+"""
+
+from typing import IO, Callable, List, Optional, Tuple
+
+import click
+
+from csvbase_client.fsspec import CSVBaseFileSystem
+from csvbase_client.internals.cache import get_fs_cache, CHUNK_SIZE
+from csvbase_client.internals.value_objs import ContentType
+
+from .harness import (
+    Result,
+    StandIn,
+    StandInSettings,
+    isolated_environment,
+    make_table,
+    parse_sizes,
+    progress,
+    run_benchmark,
+    stand_in_options,
+    write_results,
+)
+
+SUITE = "fsspec"
+
+# How much of the table file_read_lazy reads
+LAZY_READ_SIZE = 64 * 1024
+
+
+def run_suite(
+    sizes: List[int],
+    repeat: int,
+    settings: StandInSettings,
+    only: Optional[List[str]] = None,
+) -> List[Result]:
+    results = []
+    with isolated_environment():
+        tables = {f"bench/table-{size}": size for size in sizes}
+        with StandIn(tables, settings) as stand_in:
+            for size in sizes:
+                params = {
+                    "size": size,
+                    "latency": settings.latency,
+                    "bandwidth": settings.bandwidth,
+                    "conditional_requests": settings.conditional_requests,
+                    "gzip_responses": settings.gzip_responses,
+                }
+                for name, run, setup, bytes_per_run in benchmarks(
+                    stand_in.url, f"bench/table-{size}", size
+                ):
+                    if only and name not in only:
+                        continue
+                    progress(f"{name}, {size} bytes")
+                    results.append(
+                        run_benchmark(
+                            SUITE,
+                            name,
+                            params,
+                            run,
+                            repeat,
+                            setup=setup,
+                            bytes_per_run=bytes_per_run,
+                        )
+                    )
+    return results
+
+
+Benchmark = Tuple[str, Callable[[], None], Optional[Callable[[], None]], int]
+
+
+def benchmarks(url: str, ref: str, size: int) -> List[Benchmark]:
+    """Return the benchmarks for one table: as (name, run, setup, bytes per
+    run)."""
+    fs = CSVBaseFileSystem(skip_instance_cache=True)
+    fs._base_url = url
+    upload = make_table(size, seed=ref + "-upload")
+
+    def clear_cache() -> None:
+        get_fs_cache().clear()
+
+    def prime_cache() -> None:
+        fs._get_rep(ref, ContentType.CSV, max_age=0).close()
+
+    def get_rep(max_age: Optional[float] = None) -> Callable[[], None]:
+        def run() -> None:
+            fs._get_rep(ref, ContentType.CSV, max_age=max_age).close()
+
+        return run
+
+    def file_read() -> None:
+        with fs.open(ref, "rb") as table_f:
+            while table_f.read(CHUNK_SIZE):
+                pass
+
+    def file_read_lazy() -> None:
+        with fs.open(ref, "rb", lazy=True) as table_f:
+            table_f.read(LAZY_READ_SIZE)
+
+    def upload_table() -> None:
+        view = memoryview(upload)
+        with fs.open(ref + "-upload", "wb") as table_f:
+            for start in range(0, len(view), CHUNK_SIZE):
+                table_f.write(view[start : start + CHUNK_SIZE])
+
+    return [
+        ("get_rep_miss", get_rep(), clear_cache, size),
+        ("get_rep_304", get_rep(max_age=0), prime_cache, 0),
+        ("get_rep_fresh", get_rep(max_age=3600), prime_cache, 0),
+        ("file_read", file_read, prime_cache, size),
+        ("file_read_lazy", file_read_lazy, clear_cache, min(size, LAZY_READ_SIZE)),
+        ("upload", upload_table, None, size),
+    ]
+
+
+BENCHMARK_NAMES = [
+    "get_rep_miss",
+    "get_rep_304",
+    "get_rep_fresh",
+    "file_read",
+    "file_read_lazy",
+    "upload",
+]
+
+
+@click.command()
+@click.option(
+    "--sizes",
+    default="1K,1M,16M",
+    show_default=True,
+    callback=parse_sizes,
+    help="Table sizes, comma separated.",
+)
+@click.option("--repeat", type=click.IntRange(min=1), default=5, show_default=True)
+@stand_in_options
+@click.option(
+    "--only",
+    type=click.Choice(BENCHMARK_NAMES),
+    multiple=True,
+    help="Only run this benchmark (can be repeated).",
+)
+@click.option(
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="Where to write the results, as JSON lines.",
+)
+def main(
+    sizes: List[int],
+    repeat: int,
+    settings: StandInSettings,
+    only: Tuple[str, ...],
+    output: IO[str],
+) -> None:
+    results = run_suite(sizes, repeat, settings, list(only))
+    write_results(results, output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""How long csvbase-client takes to start, as installed by pip and as the
+Nuitka binary (built by scripts/nuitka/build.sh, into dist/).
+
+    python -m benchmarks.bench_startup --nuitka-binary dist/csvbase-client
+
+Each command is run repeatedly, after a couple of runs to warm up, and timed
+from starting the process to it exiting.  The peak memory (RSS) of each run is
+recorded too.  None of the commands touch the network: table get is run with
+--offline (and fails, as the cache is empty), which still imports everything
+needed to get a table.
+
+The time for the Python interpreter alone to start (python -c pass) is
+included as python_startup, for comparison.  This only works on unix.
+
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import time
+from typing import IO, List, Optional, Sequence, Tuple
+
+import click
+
+from .harness import Result, isolated_environment, progress, write_results
+
+SUITE = "startup"
+
+# name, arguments, expected exit code
+COMMANDS: List[Tuple[str, List[str], int]] = [
+    ("version", ["--version"], 0),
+    ("help", ["--help"], 0),
+    ("info", ["info"], 0),
+    ("cache_show", ["cache", "show", "--json"], 0),
+    ("table_get", ["table", "get", "bench/not-cached", "--offline"], 1),
+]
+
+
+def run_once(argv: Sequence[str], expected_exit_code: int) -> Tuple[float, int]:
+    """Run a command, returning how long it took and its peak RSS in bytes."""
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    # wait4, rather than wait, to get the resource usage of just this process
+    _, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if process.returncode != expected_exit_code:
+        raise RuntimeError(f"{argv} exited with {process.returncode}")
+    # ru_maxrss is in kilobytes on linux but bytes on macOS
+    multiplier = 1 if sys.platform == "darwin" else 1024
+    return seconds, rusage.ru_maxrss * multiplier
+
+
+def time_command(
+    target: str,
+    name: str,
+    argv: List[str],
+    expected_exit_code: int,
+    repeat: int,
+    warmup: int,
+) -> Result:
+    progress(f"{target}: {name}")
+    for _ in range(warmup):
+        run_once(argv, expected_exit_code)
+    runs = [run_once(argv, expected_exit_code) for _ in range(repeat)]
+    return Result(
+        suite=SUITE,
+        benchmark=name,
+        params={"target": target},
+        seconds=[seconds for seconds, _ in runs],
+        peak_memory_bytes=max(rss for _, rss in runs),
+    )
+
+
+def run_suite(
+    targets: List[Tuple[str, List[str]]], repeat: int, warmup: int
+) -> List[Result]:
+    """Time each command for each target, given as (name, argv prefix)."""
+    results = []
+    with isolated_environment():
+        results.append(
+            time_command(
+                "python",
+                "python_startup",
+                [sys.executable, "-c", "pass"],
+                0,
+                repeat,
+                warmup,
+            )
+        )
+        for target, prefix in targets:
+            for name, arguments, expected_exit_code in COMMANDS:
+                results.append(
+                    time_command(
+                        target,
+                        name,
+                        prefix + arguments,
+                        expected_exit_code,
+                        repeat,
+                        warmup,
+                    )
+                )
+    return results
+
+
+@click.command()
+@click.option(
+    "--pip-command",
+    default="csvbase-client",
+    show_default=True,
+    help="The csvbase-client installed by pip (ie: on the PATH).",
+)
+@click.option(
+    "--nuitka-binary",
+    type=click.Path(dir_okay=False),
+    default="dist/csvbase-client",
+    show_default=True,
+    help="The binary built by scripts/nuitka/build.sh (skipped if missing).",
+)
+@click.option("--repeat", type=click.IntRange(min=1), default=20, show_default=True)
+@click.option("--warmup", type=click.IntRange(min=0), default=2, show_default=True)
+@click.option(
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="Where to write the results, as JSON lines.",
+)
+def main(
+    pip_command: str,
+    nuitka_binary: str,
+    repeat: int,
+    warmup: int,
+    output: IO[str],
+) -> None:
+    targets = []
+    pip_path: Optional[str] = shutil.which(pip_command)
+    if pip_path is not None:
+        targets.append(("pip", [pip_path]))
+    else:
+        progress(f"not found, skipping: {pip_command}")
+    if os.path.exists(nuitka_binary):
+        targets.append(("nuitka", [os.path.abspath(nuitka_binary)]))
+    else:
+        progress(f"not found, skipping: {nuitka_binary}")
+    results = run_suite(targets, repeat, warmup)
+    write_results(results, output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Compare two runs of a benchmark, eg: before and after a change.
+
+    python -m benchmarks.compare before.jsonl after.jsonl
+
+Benchmarks that got slower (by median time), or used more memory, by more than
+the threshold are flagged and the exit code is 1.
+
+"""
+
+import json
+from typing import IO, Any, Dict, Tuple
+
+import click
+from rich.console import Console as RichConsole
+from rich.table import Table as RichTable
+
+Key = Tuple[str, str, str]
+
+
+def read_results(results_f: IO[str]) -> Dict[Key, Dict[str, Any]]:
+    results = {}
+    for line in results_f:
+        if line.strip() == "":
+            continue
+        result = json.loads(line)
+        key = (
+            result["suite"],
+            result["benchmark"],
+            json.dumps(result["params"], sort_keys=True),
+        )
+        results[key] = result
+    return results
+
+
+def ratio(before: Any, after: Any) -> float:
+    if not before or after is None:
+        return 1.0
+    return after / before
+
+
+@click.command()
+@click.argument("before", type=click.File("r"))
+@click.argument("after", type=click.File("r"))
+@click.option(
+    "--threshold",
+    type=float,
+    default=0.1,
+    show_default=True,
+    help="The fraction slower (or bigger) that counts as a regression.",
+)
+def main(before: IO[str], after: IO[str], threshold: float) -> None:
+    before_results = read_results(before)
+    after_results = read_results(after)
+
+    table = RichTable(title="benchmark comparison")
+    table.add_column("Benchmark")
+    table.add_column("Params")
+    table.add_column("Median time", justify="right")
+    table.add_column("Peak memory", justify="right")
+    regressions = 0
+    for key, after_result in after_results.items():
+        before_result = before_results.get(key)
+        if before_result is None:
+            continue
+        time_ratio = ratio(
+            before_result["seconds"]["median"], after_result["seconds"]["median"]
+        )
+        memory_ratio = ratio(
+            before_result.get("peak_memory_bytes"),
+            after_result.get("peak_memory_bytes"),
+        )
+        regressed = time_ratio > 1 + threshold or memory_ratio > 1 + threshold
+        regressions += int(regressed)
+        table.add_row(
+            f"{after_result['suite']}.{after_result['benchmark']}",
+            " ".join(
+                f"{name}={value}"
+                for name, value in sorted(after_result["params"].items())
+            ),
+            f"{time_ratio:.2f}x",
+            f"{memory_ratio:.2f}x",
+            style="bold red" if regressed else None,
+        )
+
+    RichConsole().print(table)
+    if regressions > 0:
+        raise click.ClickException(f"{regressions} regressions")
+
+
+if __name__ == "__main__":
+    main()
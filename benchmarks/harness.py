@@ -0,0 +1,314 @@
+"""The shared parts of the benchmarks: the stand-in server, an isolated
+environment, timing and reporting."""
+
+import functools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+import click
+
+from csvbase_client.instrumentation import Stats, add_hook, remove_hook
+from csvbase_client.internals.config import parse_size
+from csvbase_client.internals.version import get_version
+
+from tests.fake_csvbase import FakeCSVBase, FakeCSVBaseServer
+
+
+@dataclass
+class StandInSettings:
+    """How the stand-in server behaves (see FakeCSVBase)."""
+
+    latency: float = 0.0
+    bandwidth: Optional[int] = None
+    conditional_requests: bool = True
+    gzip_responses: bool = False
+
+    def apply(self, fake_csvbase: FakeCSVBase) -> None:
+        fake_csvbase.latency = self.latency
+        fake_csvbase.bandwidth = self.bandwidth
+        fake_csvbase.conditional_requests = self.conditional_requests
+        fake_csvbase.gzip_responses = self.gzip_responses
+
+
+def stand_in_options(command: Callable) -> Callable:
+    """Add options to a click command for how the stand-in behaves.  The
+    command is passed them as settings, a StandInSettings."""
+
+    @click.option(
+        "--latency",
+        type=float,
+        default=0.0,
+        show_default=True,
+        help="Seconds the server waits before each response.",
+    )
+    @click.option(
+        "--bandwidth",
+        help="Bytes per second the server sends at, eg: 10M (default: unlimited).",
+    )
+    @click.option(
+        "--no-conditional-requests",
+        is_flag=True,
+        help="The server ignores If-None-Match, so tables are always sent.",
+    )
+    @click.option("--gzip", is_flag=True, help="The server gzips responses.")
+    @functools.wraps(command)
+    def wrapper(
+        *args,
+        latency: float,
+        bandwidth: Optional[str],
+        no_conditional_requests: bool,
+        gzip: bool,
+        **kwargs,
+    ):
+        settings = StandInSettings(
+            latency=latency,
+            bandwidth=parse_size(bandwidth) if bandwidth is not None else None,
+            conditional_requests=not no_conditional_requests,
+            gzip_responses=gzip,
+        )
+        return command(*args, settings=settings, **kwargs)
+
+    return wrapper
+
+
+def parse_sizes(ctx: click.Context, param: click.Parameter, value: str) -> List[int]:
+    """A click callback for a comma separated list of sizes, eg: 1K,1M."""
+    try:
+        return [parse_size(size) for size in value.split(",")]
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def parse_counts(ctx: click.Context, param: click.Parameter, value: str) -> List[int]:
+    """A click callback for a comma separated list of counts, eg: 1,2,4."""
+    try:
+        counts = [int(count) for count in value.split(",")]
+    except ValueError:
+        raise click.BadParameter(f"not a list of numbers: '{value}'")
+    if any(count < 1 for count in counts):
+        raise click.BadParameter("must all be at least 1")
+    return counts
+
+
+class StandIn:
+    """Serves tables from a FakeCSVBase in a child process, so that the server
+    doesn't compete with the client being measured for the GIL.
+
+    Tables are given as ref -> size, and made (with make_table) in the child.
+    Use as a context manager.
+
+    """
+
+    def __init__(
+        self, tables: Dict[str, int], settings: Optional[StandInSettings] = None
+    ) -> None:
+        context = multiprocessing.get_context("spawn")
+        self._stop = context.Event()
+        receiving, sending = context.Pipe(duplex=False)
+        self._url_conn = receiving
+        self._process = context.Process(
+            target=_serve,
+            args=(tables, settings or StandInSettings(), sending, self._stop),
+            daemon=True,
+        )
+        self.url = ""
+
+    def __enter__(self) -> "StandIn":
+        self._process.start()
+        # making big tables can take a while
+        if not self._url_conn.poll(timeout=300):
+            raise RuntimeError("stand-in server did not start")
+        self.url = self._url_conn.recv()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self._stop.set()
+        self._process.join(timeout=10)
+        if self._process.is_alive():
+            self._process.terminate()
+
+
+def _serve(tables: Dict[str, int], settings: StandInSettings, url_conn, stop) -> None:
+    fake_csvbase = FakeCSVBase()
+    fake_csvbase.record_requests = False
+    settings.apply(fake_csvbase)
+    for ref, size in tables.items():
+        fake_csvbase.tables[ref] = make_table(size, seed=ref)
+    with FakeCSVBaseServer(fake_csvbase) as server:
+        url_conn.send(server.url)
+        stop.wait()
+
+
+def make_table(size: int, seed: str = "") -> bytes:
+    """Return a csv of exactly size bytes.  The same seed gives the same
+    table."""
+    rng = random.Random(seed)
+    rows = [b"id,name,value\n"]
+    length = len(rows[0])
+    row_number = 0
+    while length < size:
+        row = f"{row_number},{seed}-{rng.randrange(10**6)},{rng.random():.6f}\n"
+        rows.append(row.encode("utf-8"))
+        length += len(rows[-1])
+        row_number += 1
+    return b"".join(rows)[:size]
+
+
+@contextmanager
+def isolated_environment() -> Iterator[str]:
+    """Point the client at a new, empty, cache and config (so no auth), for
+    the duration.  Child processes inherit it.  Yields the directory."""
+    overrides = {
+        "XDG_CACHE_HOME": "cache",
+        "XDG_CONFIG_HOME": "config",
+    }
+    with tempfile.TemporaryDirectory(prefix="csvbase-client-bench-") as temp_dir:
+        previous = {name: os.environ.get(name) for name in overrides}
+        previous["CSVBASE_CLIENT_CACHE_MAX_SIZE"] = os.environ.get(
+            "CSVBASE_CLIENT_CACHE_MAX_SIZE"
+        )
+        for name, subdir in overrides.items():
+            os.environ[name] = os.path.join(temp_dir, subdir)
+        # nothing should be evicted mid-benchmark
+        os.environ["CSVBASE_CLIENT_CACHE_MAX_SIZE"] = "1000G"
+        try:
+            yield temp_dir
+        finally:
+            for name, value in previous.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+
+def percentile(values: Sequence[float], percent: float) -> float:
+    """The nearest-rank percentile of some values."""
+    ordered = sorted(values)
+    rank = math.ceil(percent / 100 * len(ordered))
+    return ordered[max(rank, 1) - 1]
+
+
+def summarise(seconds: Sequence[float]) -> Dict[str, float]:
+    return {
+        "min": min(seconds),
+        "median": percentile(seconds, 50),
+        "mean": sum(seconds) / len(seconds),
+        "p95": percentile(seconds, 95),
+        "max": max(seconds),
+    }
+
+
+def environment() -> Dict[str, str]:
+    """What the benchmarks were run on."""
+    return {
+        "client_version": get_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+@dataclass
+class Result:
+    """The result of running one benchmark, with one set of parameters."""
+
+    suite: str
+    benchmark: str
+    params: Dict[str, Any]
+    seconds: List[float]
+    # bytes of table read or written per run
+    bytes: int = 0
+    peak_memory_bytes: Optional[int] = None
+    # extra measurements, particular to the benchmark
+    extra: Dict[str, Any] = field(default_factory=dict)
+
+    def as_json(self) -> Dict[str, Any]:
+        summary = summarise(self.seconds)
+        as_json = asdict(self)
+        as_json["repeat"] = len(as_json.pop("seconds"))
+        as_json["seconds"] = summary
+        as_json["bytes_per_second"] = (
+            self.bytes / summary["median"] if summary["median"] > 0 else None
+        )
+        as_json.update(as_json.pop("extra"))
+        as_json["environment"] = environment()
+        return as_json
+
+
+def run_benchmark(
+    suite: str,
+    benchmark: str,
+    params: Dict[str, Any],
+    run: Callable[[], None],
+    repeat: int,
+    setup: Optional[Callable[[], None]] = None,
+    bytes_per_run: int = 0,
+) -> Result:
+    """Time run (after setup, which isn't timed) repeat times, then run it
+    once more to find the peak memory it allocates.
+
+    The instrumentation events of the timed runs are added up: the average
+    time per phase and the cache outcomes are included in the result.
+
+    """
+    stats = Stats()
+    seconds = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        add_hook(stats)
+        try:
+            start = time.perf_counter()
+            run()
+            seconds.append(time.perf_counter() - start)
+        finally:
+            remove_hook(stats)
+
+    # tracing allocations is slow, so is kept out of the timings
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        run()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    total = stats.total()
+    return Result(
+        suite=suite,
+        benchmark=benchmark,
+        params=params,
+        seconds=seconds,
+        bytes=bytes_per_run,
+        peak_memory_bytes=peak_memory,
+        extra={
+            "phases": {
+                phase.name.lower(): phase_seconds / repeat
+                for phase, phase_seconds in total.phases.items()
+            },
+            "outcomes": {
+                outcome.name.lower(): count for outcome, count in total.outcomes.items()
+            },
+        },
+    )
+
+
+def write_results(results: Sequence[Result], output: IO[str]) -> None:
+    for result in results:
+        output.write(json.dumps(result.as_json()) + "\n")
+    output.flush()
+
+
+def progress(message: str) -> None:
+    print(message, file=sys.stderr)
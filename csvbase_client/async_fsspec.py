@@ -0,0 +1,458 @@
+"""An asyncio-native version of the csvbase fsspec filesystem.
+
+This needs aiohttp, which is an optional dependency: `pip install
+csvbase-client[async]`.  It shares the cache with CSVBaseFileSystem.
+
+"""
+
+import asyncio
+import contextlib
+import functools
+import hashlib
+import shutil
+import time
+import weakref
+from collections import defaultdict
+from logging import getLogger
+from pathlib import Path
+from typing import (
+    IO,
+    AsyncIterator,
+    Callable,
+    ContextManager,
+    Dict,
+    Optional,
+    TypeVar,
+)
+
+import aiohttp
+from fsspec.asyn import AsyncFileSystem, sync
+from fsspec.exceptions import FSTimeoutError
+
+from .internals.cache import (
+    get_fs_cache,
+    get_last_etag,
+    get_last_metadata,
+    get_last_rep,
+    get_fresh_rep,
+    is_fresh,
+    mark_validated,
+    set_etag,
+    temp_cache_file,
+    publish_blob,
+    rep_size,
+    RepCache,
+    RepKey,
+    CHUNK_SIZE,
+)
+from .internals.value_objs import CacheOutcome, CachePolicy, ContentType, RepMetadata
+from .internals.auth import get_auth
+from .internals.http import (
+    HTTP_TIMEOUT,
+    compress_chunks,
+    parse_cache_control,
+    request_body_encoding,
+    user_agent,
+)
+from .constants import CSVBASE_DOT_COM
+from .exceptions import status_code_to_user_message, CSVBaseException
+from .instrumentation import Event, Operation, Phase, measure
+from .fsspec import (
+    get_metadata_offline,
+    get_rep_offline,
+    url_for_rep,
+    parse_last_modified,
+    parse_path,
+)
+
+logger = getLogger(__name__)
+
+T = TypeVar("T")
+
+# How often a cache lock held by another thread (or process) is tried again:
+# doubling from the min to the max
+LOCK_POLL_MIN_SECONDS = 0.001
+LOCK_POLL_MAX_SECONDS = 0.05
+
+
+class AsyncCSVBaseFileSystem(AsyncFileSystem):
+    """An fsspec filesystem for csvbase, based on aiohttp.
+
+    Batch operations (eg: `fs.cat([ref1, ref2, ...])`) fetch tables
+    concurrently, on one event loop.
+
+    """
+
+    def __init__(
+        self,
+        *args,
+        asynchronous: bool = False,
+        loop=None,
+        client_kwargs: Optional[Dict] = None,
+        max_age: Optional[float] = None,
+        cache_policy: CachePolicy = CachePolicy.DEFAULT,
+        **kwargs,
+    ):
+        """client_kwargs are passed to aiohttp.ClientSession.
+
+        max_age and cache_policy are as for CSVBaseFileSystem.
+
+        """
+        kwargs["use_listings_cache"] = False
+        super().__init__(*args, asynchronous=asynchronous, loop=loop, **kwargs)
+        self._base_url = CSVBASE_DOT_COM
+        self._client_kwargs = client_kwargs or {}
+        self._max_age = max_age
+        self._cache_policy = cache_policy
+        self._session: Optional[aiohttp.ClientSession] = None
+        # the content coding that the server accepts for request bodies, as
+        # SessionPool.body_encoding
+        self._body_encoding: Optional[str] = None
+        # same-ref operations are serialised, as in CSVBaseFileSystem (see
+        # _lock_ref).  Keyed by the stripe of the cache's lock, so there are
+        # only ever as many as there are stripes
+        self._stripe_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    async def set_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            connect_timeout, read_timeout = HTTP_TIMEOUT
+            self._session = aiohttp.ClientSession(
+                headers={"User-Agent": user_agent()},
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=connect_timeout, sock_read=read_timeout
+                ),
+                **self._client_kwargs,
+            )
+            if not self.asynchronous:
+                weakref.finalize(self, close_session, self.loop, self._session)
+        return self._session
+
+    async def _cat_file(self, path, start=None, end=None, **kwargs) -> bytes:
+        with await self._get_rep(*parse_path(path)) as rep:
+            return await run_blocking(read_range, rep, start, end)
+
+    async def _get_file(self, rpath, lpath, **kwargs) -> None:
+        with await self._get_rep(*parse_path(rpath)) as rep:
+            await run_blocking(copy_to_path, rep, lpath)
+
+    async def _pipe_file(self, path, value, mode="overwrite", **kwargs) -> None:
+        # as CSVBaseFileSystem._send_rep, nothing is cached so no lock is taken
+        ref, content_type = parse_path(path)
+        session = await self.set_session()
+        headers = self._headers(content_type)
+        headers["Content-Type"] = content_type.mimetype()
+        url = url_for_rep(self._base_url, ref, content_type)
+        with measure(Operation.SEND_REP, ref, content_type) as event:
+            event.bytes = len(value)
+            data = value
+            # only once the server has said it accepts compressed bodies
+            content_encoding = self._body_encoding
+            if content_encoding is not None:
+                headers["Content-Encoding"] = content_encoding
+                data = await run_blocking(compress, value, content_encoding)
+            with event.phase(Phase.TRANSFER):
+                async with session.put(url, data=data, headers=headers) as response:
+                    await self._check_response(ref, response)
+
+    async def _info(self, path, **kwargs) -> Dict:
+        ref, content_type = parse_path(path)
+        metadata = await self._get_rep_metadata(ref, content_type)
+        size = metadata.size
+        if size is None:
+            # as in CSVBaseFileSystem.info, fall back to fetching the table
+            with await self._get_rep(ref, content_type) as rep:
+                size = await run_blocking(rep_size, rep)
+        return {
+            "name": path,
+            "size": size,
+            "type": "file" if "/" in path else "directory",
+            "etag": metadata.etag,
+            "last_modified": metadata.last_modified,
+        }
+
+    async def _ls(self, path, detail=True, **kwargs):
+        # FIXME: need a way to list a users' tables
+        return []
+
+    def _open(self, path, mode="rb", **kwargs):
+        if mode != "rb":
+            raise NotImplementedError("only reading is supported, use pipe to write")
+        return sync(self.loop, self._get_rep, *parse_path(path))
+
+    async def _get_rep(self, ref: str, content_type: ContentType) -> IO[bytes]:
+        """The async equivalent of csvbase_client.fsspec.get_rep.
+
+        Everything that touches the cache (which blocks) is run off the event
+        loop, see run_blocking.
+
+        """
+        session = await self.set_session()
+        cache = await run_blocking(get_fs_cache)
+        headers = self._headers(content_type)
+        url = url_for_rep(self._base_url, ref, content_type)
+
+        with measure(Operation.GET_REP, ref, content_type) as event:
+            lock_start = time.perf_counter()
+            async with self._lock_ref(ref, content_type):
+                event.add_phase(Phase.LOCK_WAIT, time.perf_counter() - lock_start)
+                return await self._fetch_rep(
+                    session, cache, headers, url, ref, content_type, event
+                )
+
+    async def _fetch_rep(
+        self,
+        session: aiohttp.ClientSession,
+        cache: RepCache,
+        headers: Dict[str, str],
+        url: str,
+        ref: str,
+        content_type: ContentType,
+        event: Event,
+    ) -> IO[bytes]:
+        if self._cache_policy == CachePolicy.ONLY_IF_CACHED:
+            event.outcome = CacheOutcome.UNVALIDATED
+            with event.phase(Phase.CACHE_LOOKUP):
+                return await run_blocking(
+                    get_rep_offline, cache, self._base_url, ref, content_type
+                )
+        rep = None
+        with event.phase(Phase.CACHE_LOOKUP):
+            if self._cache_policy == CachePolicy.DEFAULT:
+                rep = await run_blocking(
+                    get_fresh_rep,
+                    cache,
+                    self._base_url,
+                    ref,
+                    content_type,
+                    self._max_age,
+                )
+            if rep is None:
+                etag = await run_blocking(
+                    get_last_etag, cache, self._base_url, ref, content_type
+                )
+                if etag is not None and self._cache_policy == CachePolicy.DEFAULT:
+                    rep = await run_blocking(
+                        get_last_rep, cache, self._base_url, ref, content_type
+                    )
+                    if rep is not None:
+                        logger.debug("last known etag found: '%s' ('%s')", ref, etag)
+                        headers["If-None-Match"] = etag
+            else:
+                logger.debug("fresh, so not revalidating: '%s'", ref)
+                event.outcome = CacheOutcome.FRESH
+                return rep
+
+        request_start = time.perf_counter()
+        async with session.get(url, headers=headers) as response:
+            await self._check_response(ref, response)
+            event.add_phase(Phase.REQUEST, time.perf_counter() - request_start)
+            if response.status == 304 and rep is not None:
+                with event.phase(Phase.CACHE_WRITE):
+                    await run_blocking(
+                        mark_validated,
+                        cache,
+                        self._base_url,
+                        ref,
+                        content_type,
+                        parse_cache_control(response.headers),
+                    )
+                event.outcome = CacheOutcome.REVALIDATED
+                return rep
+            if rep is not None:
+                rep.close()
+            digest = hashlib.sha256()
+            write_seconds = 0.0
+            transfer_start = time.perf_counter()
+            # as store_blob
+            async with blocking_context(temp_cache_file(cache)) as temp_f:
+                async with blocking_context(cache.compressor.writer(temp_f)) as entry_f:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        write_start = time.perf_counter()
+                        await run_blocking(entry_f.write, chunk)
+                        digest.update(chunk)
+                        event.bytes += len(chunk)
+                        write_seconds += time.perf_counter() - write_start
+            event.add_phase(
+                Phase.TRANSFER, time.perf_counter() - transfer_start - write_seconds
+            )
+            event.add_phase(Phase.CACHE_WRITE, write_seconds)
+            with event.phase(Phase.CACHE_WRITE):
+                blob = digest.hexdigest()
+                rep = await run_blocking(
+                    publish_blob,
+                    cache,
+                    blob,
+                    Path(temp_f.name),
+                    lambda blob: set_etag(
+                        cache,
+                        self._base_url,
+                        ref,
+                        content_type,
+                        response.headers["ETag"],
+                        size=event.bytes,
+                        last_modified=parse_last_modified(response.headers),
+                        max_age=parse_cache_control(response.headers),
+                        blob=blob,
+                    ),
+                )
+            event.outcome = CacheOutcome.MISS
+            return rep
+
+    async def _get_rep_metadata(
+        self, ref: str, content_type: ContentType
+    ) -> RepMetadata:
+        """The async equivalent of csvbase_client.fsspec.get_rep_metadata."""
+        session = await self.set_session()
+        cache = await run_blocking(get_fs_cache)
+        headers = self._headers(content_type)
+        headers["Accept-Encoding"] = "identity"
+        url = url_for_rep(self._base_url, ref, content_type)
+        with measure(Operation.GET_REP_METADATA, ref, content_type) as event:
+            if self._cache_policy == CachePolicy.ONLY_IF_CACHED:
+                with event.phase(Phase.CACHE_LOOKUP):
+                    metadata = await run_blocking(
+                        get_metadata_offline, cache, self._base_url, ref, content_type
+                    )
+                event.outcome = CacheOutcome.UNVALIDATED
+                return metadata
+            with event.phase(Phase.CACHE_LOOKUP):
+                last_metadata = await run_blocking(
+                    get_last_metadata, cache, self._base_url, ref, content_type
+                )
+            if (
+                self._cache_policy == CachePolicy.DEFAULT
+                and last_metadata is not None
+                and last_metadata.size is not None
+            ):
+                if is_fresh(last_metadata, self._max_age):
+                    event.outcome = CacheOutcome.FRESH
+                    return last_metadata
+                headers["If-None-Match"] = last_metadata.etag
+
+            request_start = time.perf_counter()
+            async with session.head(url, headers=headers) as response:
+                await self._check_response(ref, response)
+                event.add_phase(Phase.REQUEST, time.perf_counter() - request_start)
+                if response.status == 304 and last_metadata is not None:
+                    with event.phase(Phase.CACHE_WRITE):
+                        await run_blocking(
+                            mark_validated,
+                            cache,
+                            self._base_url,
+                            ref,
+                            content_type,
+                            parse_cache_control(response.headers),
+                        )
+                    event.outcome = CacheOutcome.REVALIDATED
+                    return last_metadata
+                event.outcome = CacheOutcome.MISS
+                content_length = response.headers.get("Content-Length")
+                return RepMetadata(
+                    etag=response.headers["ETag"],
+                    size=int(content_length) if content_length is not None else None,
+                    last_modified=parse_last_modified(response.headers),
+                )
+
+    @contextlib.asynccontextmanager
+    async def _lock_ref(
+        self, ref: str, content_type: ContentType
+    ) -> AsyncIterator[None]:
+        """Serialise operations on a ref: between coroutines, and also with
+        other threads and processes using the cache (as CSVBaseFileSystem
+        does, including occasionally serialising unrelated refs)."""
+        lock = get_fs_cache().lock(RepKey(self._base_url, ref, content_type))
+        async with self._stripe_locks[lock.stripe]:
+            # The cache lock is polled for, rather than waited for in an
+            # executor: the holder may well need an executor thread itself
+            # to finish with the cache and release it.
+            wait = LOCK_POLL_MIN_SECONDS
+            while not lock.acquire(blocking=False):
+                await asyncio.sleep(wait)
+                wait = min(wait * 2, LOCK_POLL_MAX_SECONDS)
+            try:
+                yield
+            finally:
+                lock.release()
+
+    async def _check_response(self, ref: str, response: aiohttp.ClientResponse) -> None:
+        """As check_response, but also noting which content coding the
+        server accepts for request bodies."""
+        if "Accept-Encoding" in response.headers:
+            self._body_encoding = request_body_encoding(response.headers)
+        await check_response(ref, response)
+
+    def _headers(self, content_type: ContentType) -> Dict[str, str]:
+        headers = {"Accept": content_type.mimetype()}
+        # see CSVBaseFileSystem._get_auth for why this isn't done once
+        auth = get_auth()
+        if auth is not None:
+            headers["Authorization"] = auth.as_basic_auth()
+        return headers
+
+
+async def run_blocking(func: Callable[..., T], *args, **kwargs) -> T:
+    """Run a function that blocks (eg: on the cache's db, or on disk) in the
+    default executor, so that the event loop is free meanwhile."""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(func, *args, **kwargs)
+    )
+
+
+@contextlib.asynccontextmanager
+async def blocking_context(context: ContextManager[T]) -> AsyncIterator[T]:
+    """Enter and exit a context manager that blocks, as run_blocking."""
+    value = await run_blocking(context.__enter__)
+    try:
+        yield value
+    except BaseException as e:
+        if not await run_blocking(context.__exit__, type(e), e, e.__traceback__):
+            raise
+    else:
+        await run_blocking(context.__exit__, None, None, None)
+
+
+def read_range(rep: IO[bytes], start: Optional[int], end: Optional[int]) -> bytes:
+    """Read from start to end of a rep, as fsspec's cat_file does."""
+    if (start is not None and start < 0) or (end is not None and end < 0):
+        # offsets from the end, so the size is needed
+        return rep.read()[start:end]
+    rep.seek(start or 0)
+    if end is None:
+        return rep.read()
+    return rep.read(max(end - (start or 0), 0))
+
+
+def compress(value: bytes, content_encoding: str) -> bytes:
+    return b"".join(compress_chunks([value], content_encoding))
+
+
+def copy_to_path(rep: IO[bytes], path: str) -> None:
+    with open(path, "wb") as local_f:
+        shutil.copyfileobj(rep, local_f, CHUNK_SIZE)
+
+
+async def check_response(ref: str, response: aiohttp.ClientResponse) -> None:
+    """The async equivalent of csvbase_client.fsspec.check_response."""
+    logger.info("got response code: %d", response.status)
+
+    if response.status >= 500:
+        logger.error("got status_code: %d, %s", response.status, await response.read())
+
+    if response.status >= 400:
+        raise CSVBaseException(status_code_to_user_message(ref, response.status))
+
+
+def close_session(loop, session: aiohttp.ClientSession) -> None:
+    """Close a session when its filesystem is garbage collected: on its loop
+    if possible, otherwise (eg: the loop has stopped, or this is on the loop's
+    own thread) by closing its connections directly, as fsspec's
+    HTTPFileSystem does."""
+    if loop is not None and loop.is_running():
+        try:
+            sync(loop, session.close, timeout=0.1)
+            return
+        except (TimeoutError, FSTimeoutError, NotImplementedError):
+            pass
+    connector = session.connector
+    if connector is not None:
+        connector._close()
@@ -1,12 +1,20 @@
-import requests
+from typing import TYPE_CHECKING
 
+if TYPE_CHECKING:
+    # not imported otherwise, as that is slow (see internals/cli.py)
+    import requests
 
-def http_error_to_user_message(ref: str, response: requests.Response) -> str:
+
+def http_error_to_user_message(ref: str, response: "requests.Response") -> str:
     """Convert http responses into user-visible error messages"""
-    if response.status_code == 404:
+    return status_code_to_user_message(ref, response.status_code)
+
+
+def status_code_to_user_message(ref: str, status_code: int) -> str:
+    if status_code == 404:
         return f"Table not found: {ref}"
     else:
-        return f"Unknown error (HTTP status code: {response.status_code})"
+        return f"Unknown error (HTTP status code: {status_code})"
 
 
 class CSVBaseException(Exception):
@@ -1,53 +1,403 @@
-import io
-from typing import Dict, Optional, IO, Iterator
+import dataclasses
+import os
+import mmap
+import tempfile
+import time
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Optional,
+    IO,
+    Iterable,
+    Iterator,
+    Mapping,
+    Tuple,
+    Union,
+)
 import shutil
 from logging import getLogger
 from urllib.parse import urljoin
-from threading import Lock
 import contextlib
 
 import requests
-from pyappcache.keys import Key
-from pyappcache.fs import FilesystemCache
+import urllib3.exceptions
+from urllib3.response import HTTPResponse
 from fsspec.spec import AbstractFileSystem, AbstractBufferedFile
 
-from .io import rewind
-from .internals.cache import get_fs_cache, get_last_etag, set_etag, RepKey
-from .internals.value_objs import Auth, ContentType
+from .io import ChunkPipe, CountingReader, Readable
+from .internals.cache import (
+    get_arrow_table,
+    get_fs_cache,
+    get_cached_rep,
+    get_fresh_rep,
+    is_fresh,
+    mark_validated,
+    get_last_metadata,
+    get_last_etag,
+    get_last_rep,
+    set_etag,
+    store_blob,
+    KeyLock,
+    RepCache,
+    RepKey,
+    CHUNK_SIZE,
+)
+from .internals.value_objs import Auth, CacheOutcome, FetchedRep, RepMetadata
+
+# part of the public API (see PUBLIC_API.md), so re-exported from here
+from .internals.value_objs import CachePolicy as CachePolicy
+from .internals.value_objs import ContentType as ContentType
 from .internals.auth import get_auth
-from .internals.http import get_http_sesh, HTTP_TIMEOUT
+from .internals.http import (
+    SessionPool,
+    HTTP_TIMEOUT,
+    DEFAULT_POOL_SIZE,
+    ACCEPT_ENCODING,
+    compress_chunks,
+    parse_cache_control,
+)
 from .constants import CSVBASE_DOT_COM
 from .exceptions import http_error_to_user_message, CSVBaseException
+from .instrumentation import Event, Operation, Phase, measure
+
+if TYPE_CHECKING:
+    import pyarrow
 
 logger = getLogger(__name__)
 
+# Number of written blocks that may be waiting to be sent during an upload
+UPLOAD_QUEUE_SIZE = 2
+
 
 def get_rep(
     http_sesh: requests.Session,
-    cache: FilesystemCache,
+    cache: RepCache,
     base_url: str,
     ref: str,
     content_type: ContentType,
     auth: Optional[Auth] = None,
+    max_age: Optional[float] = None,
+    cache_policy: CachePolicy = CachePolicy.DEFAULT,
 ) -> IO[bytes]:
-    headers = {"Accept": "text/csv"}
+    return fetch_rep(
+        http_sesh, cache, base_url, ref, content_type, auth, max_age, cache_policy
+    ).rep
+
+
+def fetch_rep(
+    http_sesh: requests.Session,
+    cache: RepCache,
+    base_url: str,
+    ref: str,
+    content_type: ContentType,
+    auth: Optional[Auth] = None,
+    max_age: Optional[float] = None,
+    cache_policy: CachePolicy = CachePolicy.DEFAULT,
+) -> FetchedRep:
+    """As get_rep, but also says whether the cache was used.
+
+    A cached rep that was validated less than max_age seconds ago is returned
+    without asking the server (see is_fresh).  cache_policy can also say to
+    never ask the server, or to ignore the cache.
+
+    """
+    with measure(Operation.GET_REP, ref, content_type) as event:
+        fetched = _fetch_rep(
+            http_sesh,
+            cache,
+            base_url,
+            ref,
+            content_type,
+            auth,
+            max_age,
+            cache_policy,
+            event,
+        )
+        event.outcome = fetched.outcome
+        return fetched
+
+
+def _fetch_rep(
+    http_sesh: requests.Session,
+    cache: RepCache,
+    base_url: str,
+    ref: str,
+    content_type: ContentType,
+    auth: Optional[Auth],
+    max_age: Optional[float],
+    cache_policy: CachePolicy,
+    event: Event,
+) -> FetchedRep:
+    if cache_policy == CachePolicy.ONLY_IF_CACHED:
+        with event.phase(Phase.CACHE_LOOKUP):
+            offline_rep = get_rep_offline(cache, base_url, ref, content_type)
+        return FetchedRep(offline_rep, CacheOutcome.UNVALIDATED)
+    elif cache_policy == CachePolicy.DEFAULT:
+        with event.phase(Phase.CACHE_LOOKUP):
+            fresh_rep = get_fresh_rep(cache, base_url, ref, content_type, max_age)
+        if fresh_rep is not None:
+            logger.debug("fresh, so not revalidating: '%s'", ref)
+            return FetchedRep(fresh_rep, CacheOutcome.FRESH)
+
+    headers = {"Accept": content_type.mimetype(), "Accept-Encoding": ACCEPT_ENCODING}
     if auth is not None:
         headers["Authorization"] = auth.as_basic_auth()
     url = url_for_rep(base_url, ref, content_type)
-    etag = get_last_etag(cache, base_url, ref, content_type)
-    rep_key: Key[IO[bytes]] = RepKey(base_url, ref, content_type)
+    rep = None
+
+    with event.phase(Phase.CACHE_LOOKUP):
+        etag = get_last_etag(cache, base_url, ref, content_type)
+        if cache_policy == CachePolicy.NO_CACHE:
+            logger.debug("ignoring the cache: '%s'", ref)
+        elif etag is not None:
+            rep = get_last_rep(cache, base_url, ref, content_type)
+            if rep is not None:
+                logger.debug("last known etag found: '%s' ('%s')", ref, etag)
+                headers["If-None-Match"] = etag
+            else:
+                logger.debug("an etag is known but cache MISS: '%s'", ref)
+        else:
+            logger.debug("no etag known")
+
+    with event.phase(Phase.REQUEST):
+        response = http_sesh.get(
+            url, headers=headers, stream=True, timeout=HTTP_TIMEOUT
+        )
+        check_response(ref, response)
 
-    if etag is not None:
-        rep = cache.get(rep_key)
+    if response.status_code == 304:
+        with event.phase(Phase.CACHE_WRITE):
+            mark_validated(
+                cache,
+                base_url,
+                ref,
+                content_type,
+                parse_cache_control(response.headers),
+            )
+        # FIXME: a rejig is required here for type safety
+        return FetchedRep(rep, CacheOutcome.REVALIDATED)  # type: ignore
+    else:
         if rep is not None:
-            logger.debug("last known etag found: '%s' ('%s')", ref, etag)
-            headers["If-None-Match"] = etag
+            rep.close()
+        etag = response.headers["ETag"]
+        body = CountingReader(decoded_body(response))
+        start = time.perf_counter()
+        with contextlib.closing(response), connection_errors(ref):
+            # the etag is recorded as soon as the representation is in the
+            # cache (see store_blob)
+            _, rep = store_blob(
+                cache,
+                body,
+                lambda blob: set_etag(
+                    cache,
+                    base_url,
+                    ref,
+                    content_type,
+                    etag,
+                    size=body.count,
+                    last_modified=parse_last_modified(response.headers),
+                    max_age=parse_cache_control(response.headers),
+                    blob=blob,
+                ),
+            )
+        # the body is written into the cache as it is read
+        event.bytes = body.count
+        event.add_phase(Phase.TRANSFER, body.seconds)
+        event.add_phase(Phase.CACHE_WRITE, time.perf_counter() - start - body.seconds)
+
+    return FetchedRep(rep, CacheOutcome.MISS)
+
+
+def get_rep_offline(
+    cache: RepCache, base_url: str, ref: str, content_type: ContentType
+) -> IO[bytes]:
+    """Return the cached rep, however old, without asking the server."""
+    rep = get_last_rep(cache, base_url, ref, content_type)
+    if rep is None:
+        raise CSVBaseException(f"Table not in the cache (and offline): {ref}")
+    logger.debug("offline, so not revalidating: '%s'", ref)
+    return rep
+
+
+def get_metadata_offline(
+    cache: RepCache, base_url: str, ref: str, content_type: ContentType
+) -> RepMetadata:
+    """Return the metadata of the cached rep, however old, without asking the
+    server.
+
+    The rep itself has to be cached too (it may not be, eg: if it was cached
+    by an old version, or evicted), as otherwise it could only be read from
+    the server.
+
+    """
+    metadata = get_last_metadata(cache, base_url, ref, content_type)
+    rep = (
+        get_cached_rep(cache, base_url, ref, content_type, metadata.etag)
+        if metadata is not None
+        else None
+    )
+    if metadata is None or rep is None:
+        raise CSVBaseException(f"Table not in the cache (and offline): {ref}")
+    rep.close()
+    return metadata
+
+
+@contextlib.contextmanager
+def connection_errors(ref: str) -> Iterator[None]:
+    """Turn errors from reading a streamed body (which come straight from
+    urllib3, rather than being wrapped by requests) into CSVBaseExceptions."""
+    try:
+        yield
+    except urllib3.exceptions.HTTPError as e:
+        raise CSVBaseException(f"Connection lost while getting {ref}: {e}") from e
+
+
+def decoded_body(response: requests.Response) -> Readable:
+    """Return the body of a streamed response, decompressed as it is read.
+
+    The cache always holds the decoded representation.
+
+    """
+    raw = response.raw
+    # requests' adapter gives a urllib3 response, which does not undo the
+    # Content-Encoding unless told to
+    if isinstance(raw, HTTPResponse):
+        raw.decode_content = True
+    return raw
+
+
+def get_rep_metadata(
+    http_sesh: requests.Session,
+    cache: RepCache,
+    base_url: str,
+    ref: str,
+    content_type: ContentType,
+    auth: Optional[Auth] = None,
+    max_age: Optional[float] = None,
+    cache_policy: CachePolicy = CachePolicy.DEFAULT,
+) -> RepMetadata:
+    """Find out the etag and size of a rep, without downloading it.
+
+    If the cache already has the current version of the rep, the metadata is
+    taken from the cache - without asking the server at all if it is fresh
+    (or the cache_policy is only-if-cached).
+
+    """
+    with measure(Operation.GET_REP_METADATA, ref, content_type) as event:
+        headers = {"Accept": content_type.mimetype(), "Accept-Encoding": "identity"}
+        if auth is not None:
+            headers["Authorization"] = auth.as_basic_auth()
+        url = url_for_rep(base_url, ref, content_type)
+        if cache_policy == CachePolicy.ONLY_IF_CACHED:
+            with event.phase(Phase.CACHE_LOOKUP):
+                metadata = get_metadata_offline(cache, base_url, ref, content_type)
+            event.outcome = CacheOutcome.UNVALIDATED
+            return metadata
+        with event.phase(Phase.CACHE_LOOKUP):
+            last_metadata = get_last_metadata(cache, base_url, ref, content_type)
+        if cache_policy == CachePolicy.NO_CACHE:
+            logger.debug("ignoring the cache: '%s'", ref)
+        elif last_metadata is not None and last_metadata.size is not None:
+            if is_fresh(last_metadata, max_age):
+                logger.debug("metadata fresh, so not revalidating: '%s'", ref)
+                event.outcome = CacheOutcome.FRESH
+                return last_metadata
+            headers["If-None-Match"] = last_metadata.etag
+
+        with event.phase(Phase.REQUEST):
+            response = http_sesh.head(url, headers=headers, timeout=HTTP_TIMEOUT)
+            check_response(ref, response)
+
+        # only asked to revalidate (with If-None-Match) when there is metadata
+        if response.status_code == 304 and last_metadata is not None:
+            logger.debug("metadata still valid: '%s'", ref)
+            with event.phase(Phase.CACHE_WRITE):
+                mark_validated(
+                    cache,
+                    base_url,
+                    ref,
+                    content_type,
+                    parse_cache_control(response.headers),
+                )
+            event.outcome = CacheOutcome.REVALIDATED
+            return dataclasses.replace(
+                last_metadata, accepts_ranges=accepts_ranges(response.headers)
+            )
         else:
-            logger.debug("an etag is known but cache MISS: '%s'", ref)
-    else:
-        logger.debug("no etag known")
+            event.outcome = CacheOutcome.MISS
+            content_length = response.headers.get("Content-Length")
+            return RepMetadata(
+                etag=response.headers["ETag"],
+                size=int(content_length) if content_length is not None else None,
+                last_modified=parse_last_modified(response.headers),
+                accepts_ranges=accepts_ranges(response.headers),
+            )
+
+
+def get_rep_range(
+    http_sesh: requests.Session,
+    base_url: str,
+    ref: str,
+    content_type: ContentType,
+    etag: str,
+    start: int,
+    end: int,
+    auth: Optional[Auth] = None,
+) -> Optional[bytes]:
+    """Get the bytes from start (inclusive) to end (exclusive) of a rep.
+
+    The rep must still have the given etag, otherwise the bytes would not
+    line up with what was read before.
+
+    Returns None if the server ignores the range (and sends the whole rep):
+    the rep would be better got in one go than again for every range.
+
+    """
+    headers = {
+        "Accept": content_type.mimetype(),
+        "Accept-Encoding": "identity",
+        "Range": f"bytes={start}-{end - 1}",
+    }
+    if auth is not None:
+        headers["Authorization"] = auth.as_basic_auth()
+    url = url_for_rep(base_url, ref, content_type)
+    with measure(Operation.GET_REP_RANGE, ref, content_type) as event:
+        with event.phase(Phase.REQUEST):
+            response = http_sesh.get(
+                url, headers=headers, stream=True, timeout=HTTP_TIMEOUT
+            )
+            check_response(ref, response)
+        with contextlib.closing(response), event.phase(Phase.TRANSFER):
+            if response.headers.get("ETag") != etag:
+                raise CSVBaseException(f"Table changed while being read: {ref}")
+            if response.status_code != 206:
+                logger.warning("range request ignored: '%s'", ref)
+                return None
+            with connection_errors(ref):
+                data = response.raw.read()
+        event.bytes = len(data)
+        return data
+
+
+def parse_last_modified(headers: Mapping[str, str]) -> Optional[datetime]:
+    last_modified = headers.get("Last-Modified")
+    if last_modified is None:
+        return None
+    try:
+        return parsedate_to_datetime(last_modified)
+    except (TypeError, ValueError):
+        logger.warning("unable to parse Last-Modified: '%s'", last_modified)
+        return None
+
 
-    response = http_sesh.get(url, headers=headers, stream=True, timeout=HTTP_TIMEOUT)
+def accepts_ranges(headers: Mapping[str, str]) -> bool:
+    return headers.get("Accept-Ranges", "").strip().lower() == "bytes"
+
+
+def check_response(ref: str, response: requests.Response) -> None:
+    """Raise the appropriate exception if the response is an error."""
     logger.info("got response code: %d", response.status_code)
 
     # make sure to log all 500s to make it clear a real error has occurred
@@ -59,55 +409,170 @@ def get_rep(
         message = http_error_to_user_message(ref, response)
         raise CSVBaseException(message)
 
-    if response.status_code == 304:
-        # FIXME: a rejig is required here for type safety
-        return rep  # type: ignore
-    else:
-        etag = response.headers["ETag"]
-        set_etag(cache, base_url, ref, content_type, etag)
-        rep = io.BytesIO()
-        with rewind(rep):
-            shutil.copyfileobj(response.raw, rep)
-            response.close()
-        with rewind(rep):
-            cache.set(rep_key, rep)
-
-    return rep
-
 
 def send_rep(
     http_sesh: requests.Session,
-    cache: FilesystemCache,
     base_url: str,
     ref: str,
     content_type: ContentType,
-    rep: IO[bytes],
+    rep: Union[IO[bytes], Iterable[bytes]],
     auth: Optional[Auth] = None,
+    content_encoding: Optional[str] = None,
 ) -> None:
+    """Upload a representation.
+
+    If rep is an iterable of chunks (rather than a file) it is sent with
+    chunked transfer encoding, as the chunks are produced.  If a
+    content_encoding is given, the body is compressed with it on the way out.
+
+    """
     headers = {"Content-Type": content_type.mimetype()}
     if auth is not None:
         headers["Authorization"] = auth.as_basic_auth()
     url = url_for_rep(base_url, ref, content_type)
-    response = http_sesh.put(url, data=rep, headers=headers, timeout=HTTP_TIMEOUT)
+    with measure(Operation.SEND_REP, ref, content_type) as event:
+        data: Union[IO[bytes], Iterable[bytes]] = rep
+        start = _tell(rep)
+        if content_encoding is not None:
+            headers["Content-Encoding"] = content_encoding
+            data = compress_chunks(
+                count_chunks(iter_chunks(rep), event), content_encoding
+            )
+        elif start is None:
+            data = count_chunks(iter_chunks(rep), event)
+        with event.phase(Phase.TRANSFER):
+            response = http_sesh.put(
+                url, data=data, headers=headers, timeout=HTTP_TIMEOUT
+            )
+        if start is not None and content_encoding is None:
+            # files are sent as they are, so are counted by how far they
+            # were read
+            end = _tell(rep)
+            event.bytes = end - start if end is not None else 0
+
+        # FIXME: this needs bringing into line with the get_rep code
+        try:
+            response.raise_for_status()
+        except Exception:
+            logger.error(
+                "got status code %d from csvbase server, body: %s",
+                response.status_code,
+                response.content,
+            )
+            raise
+
 
-    # FIXME: this needs bringing into line with the get_rep code
+def count_chunks(chunks: Iterable[bytes], event: Event) -> Iterator[bytes]:
+    """Pass chunks through, adding up their size in event.bytes."""
+    for chunk in chunks:
+        event.bytes += len(chunk)
+        yield chunk
+
+
+def _tell(rep: Union[IO[bytes], Iterable[bytes]]) -> Optional[int]:
+    """Return the position of a (seekable) file, or None for anything else."""
     try:
-        response.raise_for_status()
-    except Exception:
-        logger.error("got status code %d from csvbase server, body: %s", response.status_code, response.content)
-        raise
+        return rep.tell()  # type: ignore
+    except (AttributeError, OSError):
+        return None
+
+
+def iter_chunks(rep: Union[IO[bytes], Iterable[bytes]]) -> Iterable[bytes]:
+    """Return rep as chunks of bytes, whether it is a file or already chunks."""
+    # files are iterable too, but by line
+    if hasattr(rep, "read"):
+        return iter(lambda: rep.read(CHUNK_SIZE), b"")  # type: ignore
+    return rep
+
+
+def map_rep(rep: IO[bytes]) -> Union[mmap.mmap, bytes]:
+    """Memory map a (cached) representation, so that it can be read from
+    without copying it into memory.
+
+    Reps that are not backed by a real file (and so can't be mapped) are first
+    spooled to a temporary file.  That includes cache entries that are
+    compressed at rest.
+
+    """
+    try:
+        fileno = rep.fileno()
+    except (AttributeError, OSError):
+        with tempfile.TemporaryFile() as temp_f:
+            shutil.copyfileobj(rep, temp_f, CHUNK_SIZE)
+            temp_f.flush()
+            return map_rep(temp_f)
+    if os.fstat(fileno).st_size == 0:
+        # empty files cannot be mapped
+        return b""
+    return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
 
 
 def url_for_rep(base_url: str, ref: str, content_type: ContentType) -> str:
     url = urljoin(base_url, ref)
+    if content_type != ContentType.CSV:
+        # other representations are at <ref>.<ext>, the csv is at the ref
+        # itself
+        url += content_type.file_extension()
     return url
 
 
+# The representations that can be asked for by file extension
+PATH_EXTENSIONS = {
+    ContentType.CSV.file_extension(): ContentType.CSV,
+    ContentType.PARQUET.file_extension(): ContentType.PARQUET,
+}
+
+
+def parse_path(
+    path: str, content_type: Optional[ContentType] = None
+) -> Tuple[str, ContentType]:
+    """Split a path (eg: "user/table.parquet") into the ref and the content
+    type.  Paths without an extension are csv, unless content_type is given.
+
+    """
+    for extension, path_content_type in PATH_EXTENSIONS.items():
+        if path.endswith(extension):
+            ref = path[: -len(extension)]
+            if content_type is not None and content_type != path_content_type:
+                raise CSVBaseException(
+                    f"{path} is {path_content_type.name}, not {content_type.name}"
+                )
+            return ref, path_content_type
+    return path, content_type or ContentType.CSV
+
+
 class CSVBaseFileSystem(AbstractFileSystem):
-    def __init__(self, *args, **kwargs):
+    def __init__(
+        self,
+        *args,
+        lazy: bool = False,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        max_age: Optional[float] = None,
+        cache_policy: CachePolicy = CachePolicy.DEFAULT,
+        **kwargs,
+    ):
+        """Set lazy to only download the parts of tables that are actually
+        read (this can be overridden per call to open).
+
+        pool_size is the number of HTTP connections kept open for reuse - it
+        should be at least the number of threads reading at once.
+
+        max_age is how long (in seconds) after checking with the server that a
+        cached table is used without checking again (also can be overridden
+        per call to open).  By default that is as long as the server says, via
+        Cache-Control.
+
+        cache_policy (a CachePolicy, also can be overridden per call to open)
+        can say to use only what is in the cache, never touching the network
+        (ONLY_IF_CACHED), or to always download tables again (NO_CACHE).
+
+        """
         kwargs["use_listings_cache"] = False
         self._base_url = CSVBASE_DOT_COM
-        self._cache_lock = Lock()
+        self._lazy = lazy
+        self._max_age = max_age
+        self._cache_policy = cache_policy
+        self._session_pool = SessionPool(pool_size)
 
         super().__init__(*args, **kwargs)
 
@@ -121,9 +586,24 @@ class CSVBaseFileSystem(AbstractFileSystem):
         block_size=None,
         autocommit=True,
         cache_options=None,
-        **kwargs
+        lazy: Optional[bool] = None,
+        content_type: Optional[ContentType] = None,
+        max_age: Optional[float] = None,
+        cache_policy: Optional[CachePolicy] = None,
+        **kwargs,
     ):
-        f = CSVBaseFile(self, path, mode)
+        """content_type can be given instead of a file extension, eg:
+        fs.open("user/table", content_type=ContentType.PARQUET)."""
+        f = CSVBaseFile(
+            self,
+            path,
+            mode,
+            block_size=block_size,
+            lazy=self._lazy if lazy is None else lazy,
+            content_type=content_type,
+            max_age=max_age,
+            cache_policy=cache_policy,
+        )
         return f
 
     def created(self, path):
@@ -147,89 +627,319 @@ class CSVBaseFileSystem(AbstractFileSystem):
         raise NotImplementedError
 
     def info(self, path: str) -> Dict:
-        # FIXME: implement a proper HEAD method for csvbase, avoid fetching the
-        # whole file: https://github.com/calpaterson/csvbase/issues/71
-        with self.open(path, "rb") as table_f:
-            size = table_f.size
+        ref, content_type = parse_path(path)
+        metadata = self._get_rep_metadata(ref, content_type)
+        size = metadata.size
+        if size is None:
+            # the server didn't say (see
+            # https://github.com/calpaterson/csvbase/issues/71), so fall back
+            # to fetching the whole file
+            with self.open(path, "rb") as table_f:
+                size = table_f.size
         return {
             "name": path,
             "size": size,
             "type": "file" if "/" in path else "directory",
+            "etag": metadata.etag,
+            "last_modified": metadata.last_modified,
         }
 
-    def _get_rep(self, ref: str, content_type: ContentType) -> IO[bytes]:
-        _http_sesh = get_http_sesh()
-        with self._get_fs_cache() as cache:
-            return get_rep(
+    def read_arrow(
+        self,
+        path: str,
+        max_age: Optional[float] = None,
+        cache_policy: Optional[CachePolicy] = None,
+    ) -> "pyarrow.Table":
+        """Read a table as an Arrow table (this needs pyarrow).
+
+        The csv is converted once per version of the table and kept in the
+        cache in Arrow IPC format.  Later reads memory map that, which is much
+        quicker than parsing the csv again.  Use `.to_pandas()` or
+        `polars.from_arrow` on the result to get a dataframe.
+
+        """
+        ref, content_type = parse_path(path)
+        if content_type != ContentType.CSV:
+            raise CSVBaseException(f"Only csv can be read as arrow, not: {path}")
+        _http_sesh = self._session_pool.get()
+        with self._lock_ref(ref, content_type), self._get_fs_cache() as cache:
+            fetched = fetch_rep(
                 _http_sesh,
                 cache,
                 self._base_url,
                 ref,
                 content_type,
                 self._get_auth(),
+                self._effective_max_age(max_age),
+                self._effective_cache_policy(cache_policy),
             )
+            etag = get_last_etag(cache, self._base_url, ref, content_type)
+            assert etag is not None, "etag should be known after fetching"
+            with fetched.rep as rep:
+                return get_arrow_table(cache, self._base_url, ref, etag, rep)
+
+    def _get_rep(
+        self,
+        ref: str,
+        content_type: ContentType,
+        max_age: Optional[float] = None,
+        cache_policy: Optional[CachePolicy] = None,
+    ) -> IO[bytes]:
+        return self._fetch_rep(ref, content_type, max_age, cache_policy).rep
+
+    def _fetch_rep(
+        self,
+        ref: str,
+        content_type: ContentType,
+        max_age: Optional[float] = None,
+        cache_policy: Optional[CachePolicy] = None,
+    ) -> FetchedRep:
+        _http_sesh = self._session_pool.get()
+        lock = self._lock_ref(ref, content_type)
+        # as fetch_rep, but the wait for the lock is measured too
+        with measure(Operation.GET_REP, ref, content_type) as event:
+            with event.phase(Phase.LOCK_WAIT):
+                lock.acquire()
+            try:
+                with self._get_fs_cache() as cache:
+                    fetched = _fetch_rep(
+                        _http_sesh,
+                        cache,
+                        self._base_url,
+                        ref,
+                        content_type,
+                        self._get_auth(),
+                        self._effective_max_age(max_age),
+                        self._effective_cache_policy(cache_policy),
+                        event,
+                    )
+            finally:
+                lock.release()
+            event.outcome = fetched.outcome
+            return fetched
+
+    def _get_cached_rep(
+        self, ref: str, content_type: ContentType, etag: str
+    ) -> Optional[IO[bytes]]:
+        with self._get_fs_cache() as cache:
+            return get_cached_rep(cache, self._base_url, ref, content_type, etag)
 
-    def _send_rep(self, ref: str, content_type: ContentType, rep: IO[bytes]) -> None:
-        _http_sesh = get_http_sesh()
+    def _get_rep_metadata(
+        self,
+        ref: str,
+        content_type: ContentType,
+        max_age: Optional[float] = None,
+        cache_policy: Optional[CachePolicy] = None,
+    ) -> RepMetadata:
+        _http_sesh = self._session_pool.get()
         with self._get_fs_cache() as cache:
-            send_rep(
+            return get_rep_metadata(
                 _http_sesh,
                 cache,
                 self._base_url,
                 ref,
                 content_type,
-                rep,
                 self._get_auth(),
+                self._effective_max_age(max_age),
+                self._effective_cache_policy(cache_policy),
             )
 
+    def _get_rep_range(
+        self,
+        ref: str,
+        content_type: ContentType,
+        etag: str,
+        start: int,
+        end: int,
+        cache_policy: Optional[CachePolicy] = None,
+    ) -> Optional[bytes]:
+        if self._effective_cache_policy(cache_policy) == CachePolicy.ONLY_IF_CACHED:
+            raise CSVBaseException(f"Unable to read lazily (while offline): {ref}")
+        return get_rep_range(
+            self._session_pool.get(),
+            self._base_url,
+            ref,
+            content_type,
+            etag,
+            start,
+            end,
+            self._get_auth(),
+        )
+
+    def _send_rep(
+        self,
+        ref: str,
+        content_type: ContentType,
+        rep: Union[IO[bytes], Iterable[bytes]],
+    ) -> None:
+        # Nothing is cached, so no lock is taken: the upload runs in the
+        # background for as long as the file is open, and the thread writing
+        # it may well read other tables meanwhile.
+        send_rep(
+            self._session_pool.get(),
+            self._base_url,
+            ref,
+            content_type,
+            rep,
+            self._get_auth(),
+            # only once the server has said it accepts compressed bodies
+            content_encoding=self._session_pool.body_encoding(self._base_url),
+        )
+
+    def _effective_max_age(self, max_age: Optional[float]) -> Optional[float]:
+        return self._max_age if max_age is None else max_age
+
+    def _effective_cache_policy(
+        self, cache_policy: Optional[CachePolicy]
+    ) -> CachePolicy:
+        return self._cache_policy if cache_policy is None else cache_policy
+
     def _get_auth(self) -> Optional[Auth]:
         # this can't be done on an instance level for testing reasons - fsspec
         # appears to re-use instances
         return get_auth()
 
     @contextlib.contextmanager
-    def _get_fs_cache(self) -> Iterator[FilesystemCache]:
-        # Dask requires these fsspec objects to be thread safe.  However the
-        # FilesystemCache was not designed with that in mind.  As a temporary
-        # solution, lock it.
-        with self._cache_lock:
-            yield get_fs_cache()
+    def _get_fs_cache(self) -> Iterator[RepCache]:
+        # Dask requires these fsspec objects to be thread safe.  The cache
+        # returned serialises its own metadata db access, but two threads (or
+        # processes) filling the same cache entry would race - see _lock_ref.
+        yield get_fs_cache()
+
+    def _lock_ref(self, ref: str, content_type: ContentType) -> KeyLock:
+        """Return a lock for the given ref.  Operations on the same ref are
+        serialised, across threads and processes sharing the cache.
+
+        Operations on different refs usually are not, but occasionally two
+        refs share a lock (see RepCache.lock) and are serialised too: so
+        nothing should wait on another ref while holding this.
+
+        """
+        return get_fs_cache().lock(RepKey(self._base_url, ref, content_type))
 
 
 class CSVBaseFile(AbstractBufferedFile):
-    def __init__(self, fs: CSVBaseFileSystem, path, mode, **kwargs) -> None:
+    def __init__(
+        self,
+        fs: CSVBaseFileSystem,
+        path,
+        mode,
+        lazy: bool = False,
+        content_type: Optional[ContentType] = None,
+        max_age: Optional[float] = None,
+        cache_policy: Optional[CachePolicy] = None,
+        **kwargs,
+    ) -> None:
         self.fs = fs
         self.path = path
-        self._staging_buffer = io.BytesIO()
-        # this is necessary because we have no way to get size of the file
+        self.ref, self.content_type = parse_path(path, content_type)
+        self._max_age = max_age
+        self._cache_policy = fs._effective_cache_policy(cache_policy)
+        self._upload_pipe: Optional[ChunkPipe] = None
+        self._rep_map: Union[mmap.mmap, bytes] = b""
+        # in lazy mode, only the blocks that are read are fetched (and kept in
+        # the block cache)
+        self._lazy_etag: Optional[str] = None
+        cache_type = "none"
         if mode == "rb":
-            with rewind(self._staging_buffer):
-                shutil.copyfileobj(
-                    fs._get_rep(path, ContentType.CSV), self._staging_buffer
-                )
-                size = self._staging_buffer.tell()
+            # nothing can be fetched lazily when offline
+            if lazy and self._cache_policy != CachePolicy.ONLY_IF_CACHED:
+                size = self._init_lazily()
+                if self._lazy_etag is not None:
+                    cache_type = "blockcache"
+            else:
+                size = self._init_eagerly()
         else:
             size = 0
 
         # currently this value is used only for test multi-chunk uploads
         self._chunk_count = 0
 
-        super().__init__(fs, path, mode, size=size, cache_type="none", **kwargs)
+        super().__init__(fs, path, mode, size=size, cache_type=cache_type, **kwargs)
+
+    def _init_eagerly(self) -> int:
+        with self.fs._get_rep(
+            self.ref, self.content_type, self._max_age, self._cache_policy
+        ) as rep:
+            self._map_rep(rep)
+        return len(self._rep_map)
+
+    def _init_lazily(self) -> int:
+        metadata = self.fs._get_rep_metadata(
+            self.ref, self.content_type, self._max_age, self._cache_policy
+        )
+        cached_rep = self.fs._get_cached_rep(self.ref, self.content_type, metadata.etag)
+        if cached_rep is not None:
+            logger.debug("rep is cached, so not reading lazily: '%s'", self.ref)
+            with cached_rep:
+                self._map_rep(cached_rep)
+            return len(self._rep_map)
+        elif metadata.size is None:
+            logger.warning("size unknown, unable to read lazily: '%s'", self.ref)
+            return self._init_eagerly()
+        elif not metadata.accepts_ranges:
+            logger.warning("ranges not accepted, unable to read lazily: '%s'", self.ref)
+            return self._init_eagerly()
+        else:
+            self._lazy_etag = metadata.etag
+            return metadata.size
+
+    def _map_rep(self, rep: IO[bytes]) -> None:
+        with measure(Operation.MAP_REP, self.ref, self.content_type):
+            self._rep_map = map_rep(rep)
 
     def _fetch_range(self, start: int, end: int) -> bytes:
-        self._staging_buffer.seek(start)
-        count = end - start
-        return self._staging_buffer.read(count)
+        if self._lazy_etag is not None:
+            end = min(end, self.size)
+            if start >= end:
+                return b""
+            data = self.fs._get_rep_range(
+                self.ref,
+                self.content_type,
+                self._lazy_etag,
+                start,
+                end,
+                self._cache_policy,
+            )
+            if data is not None:
+                return data
+            self._stop_reading_lazily()
+        return self._rep_map[start:end]
+
+    def _stop_reading_lazily(self) -> None:
+        """Get the whole rep (into the cache), as the server won't send parts
+        of it after all."""
+        assert self._lazy_etag is not None, "not reading lazily"
+        self.fs._get_rep(
+            self.ref, self.content_type, self._max_age, self._cache_policy
+        ).close()
+        # it must be the version that was being read
+        cached_rep = self.fs._get_cached_rep(
+            self.ref, self.content_type, self._lazy_etag
+        )
+        if cached_rep is None:
+            raise CSVBaseException(f"Table changed while being read: {self.ref}")
+        with cached_rep:
+            self._map_rep(cached_rep)
+        self._lazy_etag = None
+
+    def close(self) -> None:
+        super().close()
+        if isinstance(self._rep_map, mmap.mmap):
+            self._rep_map.close()
 
     def _initiate_upload(self) -> None:
-        # FIXME: possibly truncate the staging buffer
-        pass
+        # The whole table is sent as a single, chunked, PUT request - made in
+        # the background while blocks are written.  Only a few blocks are
+        # held in memory at once, however big the table is.
+        self._upload_pipe = ChunkPipe(
+            lambda chunks: self.fs._send_rep(self.ref, self.content_type, chunks),
+            max_pending=UPLOAD_QUEUE_SIZE,
+        )
 
     def _upload_chunk(self, final=False) -> None:
-        # we send it all in one go at the moment
-        self.buffer.seek(0)
-        shutil.copyfileobj(self.buffer, self._staging_buffer)
+        assert self._upload_pipe is not None, "upload not initiated"
+        self._upload_pipe.write(self.buffer.getvalue())
         self._chunk_count += 1
         if final:
-            self._staging_buffer.seek(0)
-            self.fs._send_rep(self.path, ContentType.CSV, self._staging_buffer)
+            self._upload_pipe.close()
@@ -0,0 +1,207 @@
+"""Hooks for finding out where the time goes when reading and writing tables.
+
+Each operation on a table (eg: getting it) is reported, once it is finished,
+as an Event to every hook added with add_hook:
+
+    >>> from csvbase_client.instrumentation import add_hook
+    >>> add_hook(lambda event: print(event.operation, event.ref, event.seconds))
+
+Hooks are called from whichever thread did the operation, so must be thread
+safe, and should be quick.  Exceptions raised by hooks are logged, not
+raised.
+
+"""
+
+import enum
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from logging import getLogger
+from threading import Lock
+from typing import Callable, Counter as CounterType, Dict, Iterator, List, Optional
+
+from .internals.value_objs import CacheOutcome, ContentType, path_for_rep
+
+logger = getLogger(__name__)
+
+
+@enum.unique
+class Operation(enum.Enum):
+    """An operation on a table.  Operations don't overlap: eg: MAP_REP does
+    not include the GET_REP before it."""
+
+    # getting a whole rep, from the cache or the server
+    GET_REP = 1
+    # getting the etag and size of a rep
+    GET_REP_METADATA = 2
+    # getting part of a rep, from the server (lazy reads)
+    GET_REP_RANGE = 3
+    # uploading a rep
+    SEND_REP = 4
+    # making a rep from the cache readable by a CSVBaseFile (which, for
+    # entries compressed at rest, means copying it)
+    MAP_REP = 5
+
+
+@enum.unique
+class Phase(enum.Enum):
+    """Part of an operation."""
+
+    # looking up the rep (and its etag) in the cache
+    CACHE_LOOKUP = 1
+    # connecting, sending the request and waiting for the response headers
+    # (ie: time to first byte)
+    REQUEST = 2
+    # reading (or, for uploads, sending) the body
+    TRANSFER = 3
+    # writing the body into the cache
+    CACHE_WRITE = 4
+    # waiting for other threads (or processes) using the same cache entry,
+    # see CSVBaseFileSystem._lock_ref
+    LOCK_WAIT = 5
+
+
+@dataclass
+class Event:
+    """A finished operation on a table."""
+
+    operation: Operation
+    ref: str
+    content_type: ContentType
+    # how long the whole operation took
+    seconds: float = 0.0
+    # bytes of body transferred to or from the server (before compression)
+    bytes: int = 0
+    # for GET_REP and GET_REP_METADATA, how the cache was used
+    outcome: Optional[CacheOutcome] = None
+    # whether the operation raised an exception
+    failed: bool = False
+    # how long was spent in each phase (phases not gone through are absent)
+    phases: Dict[Phase, float] = field(default_factory=dict)
+
+    def path(self) -> str:
+        """Return the path of the table, as would be given to the fsspec
+        filesystem."""
+        return path_for_rep(self.ref, self.content_type)
+
+    def add_phase(self, phase: Phase, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, phase: Phase) -> Iterator[None]:
+        """Time a phase of the operation."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(phase, time.perf_counter() - start)
+
+
+Hook = Callable[[Event], None]
+
+# Replaced (not mutated) when hooks are added or removed, so it can be read
+# without taking the lock
+_hooks: List[Hook] = []
+_hooks_lock = Lock()
+
+
+def add_hook(hook: Hook) -> None:
+    """Call hook with each Event from now on."""
+    global _hooks
+    with _hooks_lock:
+        _hooks = _hooks + [hook]
+
+
+def remove_hook(hook: Hook) -> None:
+    global _hooks
+    with _hooks_lock:
+        _hooks = [h for h in _hooks if h is not hook]
+
+
+@contextmanager
+def measure(
+    operation: Operation, ref: str, content_type: ContentType
+) -> Iterator[Event]:
+    """Time an operation, yielding the Event for the caller to fill in.  The
+    Event goes to the hooks once the operation finishes (or fails)."""
+    event = Event(operation, ref, content_type)
+    start = time.perf_counter()
+    try:
+        yield event
+    except BaseException:
+        event.failed = True
+        raise
+    finally:
+        event.seconds = time.perf_counter() - start
+        for hook in _hooks:
+            try:
+                hook(event)
+            except Exception:
+                logger.exception("instrumentation hook failed: %r", hook)
+
+
+@dataclass
+class Summary:
+    """Events added up."""
+
+    operations: int = 0
+    failures: int = 0
+    seconds: float = 0.0
+    bytes: int = 0
+    outcomes: CounterType[CacheOutcome] = field(default_factory=Counter)
+    phases: Dict[Phase, float] = field(default_factory=dict)
+
+    def add(self, event: Event) -> None:
+        self.operations += 1
+        self.failures += int(event.failed)
+        self.seconds += event.seconds
+        self.bytes += event.bytes
+        if event.outcome is not None:
+            self.outcomes[event.outcome] += 1
+        self._add_phases(event.phases)
+
+    def update(self, other: "Summary") -> None:
+        """Add another summary to this one."""
+        self.operations += other.operations
+        self.failures += other.failures
+        self.seconds += other.seconds
+        self.bytes += other.bytes
+        self.outcomes.update(other.outcomes)
+        self._add_phases(other.phases)
+
+    def _add_phases(self, phases: Dict[Phase, float]) -> None:
+        for phase, seconds in phases.items():
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+class Stats:
+    """A hook that adds up events per table, eg:
+
+    >>> stats = Stats()
+    >>> add_hook(stats)
+    >>> ...  # read some tables
+    >>> remove_hook(stats)
+    >>> stats.total().bytes
+
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._by_path: Dict[str, Summary] = {}
+
+    def __call__(self, event: Event) -> None:
+        with self._lock:
+            self._by_path.setdefault(event.path(), Summary()).add(event)
+
+    def by_path(self) -> Dict[str, Summary]:
+        """Return a summary for each table, by path (in path order)."""
+        with self._lock:
+            return dict(sorted(self._by_path.items()))
+
+    def total(self) -> Summary:
+        total = Summary()
+        with self._lock:
+            for summary in self._by_path.values():
+                total.update(summary)
+        return total
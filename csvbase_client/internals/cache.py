@@ -1,16 +1,101 @@
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import atexit
 from pathlib import Path
-from typing import List, Optional, Iterator
-from contextlib import closing
+from threading import Lock, RLock
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Iterator,
+    IO,
+    Tuple,
+    cast,
+)
+from contextlib import closing, contextmanager
 from dataclasses import dataclass
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from logging import getLogger
 
-from pyappcache.keys import BaseKey
-from pyappcache.fs import FilesystemCache
+from pyappcache.keys import BaseKey, Key, build_raw_key
+from pyappcache.fs import FilesystemCache, SET_DML
 from pyappcache.serialisation import BinaryFileSerialiser
 
+try:
+    import zstandard
+except ImportError:
+    # zstd is optional: pip install csvbase-client[zstd]
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    # eg: on Windows, where cache locks only keep threads apart, not processes
+    fcntl = None  # type: ignore[assignment]
+
+from .config import get_config, parse_size
 from .dirs import dirs
-from .value_objs import ContentType
+from .value_objs import ContentType, RepMetadata, path_for_rep
 from ..constants import CSVBASE_DOT_COM
+from ..exceptions import CSVBaseException
+from ..io import Readable
+
+if TYPE_CHECKING:
+    import pyarrow
+
+logger = getLogger(__name__)
+
+# Size of the chunks used when copying representations into the cache.
+CHUNK_SIZE = 64 * 1024
+
+# Serialises use of the metadata db across threads.  Only db access is done
+# under this lock - file IO (and network IO) are not.
+METADATA_LOCK = RLock()
+
+# Updates to last_read (which happen on every cache hit) are held back and
+# written in batches of up to this many, or after this many seconds.
+TOUCH_BATCH_SIZE = 100
+TOUCH_BATCH_SECONDS = 1.0
+
+# The maximum size of the cache can be set with this environment variable (or
+# cache_max_size in the config file), eg: "2G"
+CACHE_MAX_SIZE_ENV_VAR = "CSVBASE_CLIENT_CACHE_MAX_SIZE"
+DEFAULT_CACHE_MAX_SIZE = FilesystemCache.DEFAULT_MAX_SIZE
+
+# Files in the cache directory that are not entries are removed once they are
+# this old.  Younger ones may still be being written.
+ORPHAN_SECONDS = 60 * 60
+
+# Number of locks (and lock files) that keys are spread over, see
+# RepCache.lock.  Every process sharing a cache directory has to agree on it,
+# so it isn't configurable.
+KEY_LOCK_STRIPES = 1024
+
+# The lock files are kept in this subdirectory of the cache directory
+LOCKS_DIRNAME = ".locks"
+
+# Compression levels used for cache entries when none is configured
+DEFAULT_COMPRESSION_LEVELS = {"gzip": 6, "zstd": 3}
+
+# Arrow IPC files derived from a csv record the etag of the csv under this
+# key in their schema metadata
+ARROW_ETAG_METADATA_KEY = b"csvbase_etag"
+
+# Blobs (the content of reps, by sha256 digest) are keyed under this
+# namespace
+BLOB_NAMESPACE = "blobs"
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
 
 ETAG_DDL2 = """
 CREATE TABLE IF NOT EXISTS etags (
@@ -18,15 +103,56 @@ CREATE TABLE IF NOT EXISTS etags (
     ref NOT NULL,
     content_type NOT NULL,
     etag NOT NULL,
+    size,
+    last_modified,
+    validated_at,
+    max_age,
+    blob,
+    cache_key,
     PRIMARY KEY (base_url, ref, content_type)
 );
 """
 
+# cache_key is the key of the blob's entry in the pyappcache table
+ETAG_CACHE_KEY_INDEX_DDL = """
+CREATE INDEX IF NOT EXISTS etags_cache_key ON etags (cache_key);
+"""
+
+# Columns added to the etags table after it was first created, and the DDL to
+# add them to older caches
+ETAG_COLUMN_MIGRATIONS = {
+    "size": "ALTER TABLE etags ADD COLUMN size;",
+    "last_modified": "ALTER TABLE etags ADD COLUMN last_modified;",
+    "validated_at": "ALTER TABLE etags ADD COLUMN validated_at;",
+    "max_age": "ALTER TABLE etags ADD COLUMN max_age;",
+    "blob": "ALTER TABLE etags ADD COLUMN blob;",
+    "cache_key": "ALTER TABLE etags ADD COLUMN cache_key;",
+}
+
 SET_ETAG_DML2 = """
 INSERT OR REPLACE INTO etags
-(base_url, ref, content_type, etag)
+(
+    base_url,
+    ref,
+    content_type,
+    etag,
+    size,
+    last_modified,
+    validated_at,
+    max_age,
+    blob,
+    cache_key
+)
 VALUES
-(?, ?, ?, ?);
+(?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+"""
+
+MARK_VALIDATED_DML = """
+UPDATE etags
+SET validated_at = ?, max_age = ?
+WHERE base_url = ?
+AND ref = ?
+AND content_type = ?;
 """
 
 GET_ETAG_DQL2 = """
@@ -36,6 +162,60 @@ AND ref = ?
 AND content_type = ?;
 """
 
+GET_BLOB_DQL = """
+SELECT blob FROM etags
+WHERE base_url = ?
+AND ref = ?
+AND content_type = ?;
+"""
+
+COUNT_BLOB_REFS_DQL = """
+SELECT COUNT(*) FROM etags WHERE cache_key = ?;
+"""
+
+GET_METADATA_DQL = """
+SELECT etag, size, last_modified, validated_at, max_age FROM etags
+WHERE base_url = ?
+AND ref = ?
+AND content_type = ?;
+"""
+
+IS_LIVE_DQL = """
+SELECT 1 FROM pyappcache
+WHERE key = ?
+AND (expiry >= ? OR expiry = '-1');
+"""
+
+# Live entries beyond the most recently read max_size bytes, and expired ones
+GET_EVICTION_COHORT_DQL2 = """
+SELECT key FROM (
+    SELECT
+        key,
+        SUM(size) OVER (ORDER BY last_read DESC, key) AS total_size
+    FROM pyappcache
+    WHERE expiry >= ? OR expiry = '-1'
+) AS t
+WHERE total_size > ?
+UNION ALL
+SELECT key FROM pyappcache
+WHERE expiry < ? AND expiry != '-1';
+"""
+
+DELETE_ENTRY_DML = """
+DELETE FROM pyappcache WHERE key = ?;
+"""
+
+DELETE_ENTRY_ETAGS_DML = """
+DELETE FROM etags WHERE cache_key = ?;
+"""
+
+TOUCH_DML2 = """
+UPDATE pyappcache
+SET last_read = ?
+WHERE key = ?;
+"""
+
+# The ORDER BY is one of CACHE_ENTRY_ORDERINGS
 GET_CACHE_ENTRIES_DQL = """
 SELECT
     e.base_url,
@@ -43,14 +223,34 @@ SELECT
     e.content_type,
     e.etag,
     p.last_read,
-    p.size
+    p.size,
+    e.size
 FROM
     etags AS e
-    LEFT JOIN pyappcache AS p ON p.key = CASE WHEN base_url = 'https://csvbase.com' THEN
-        'v0/' || e.ref || '.csv'
-    ELSE
-        'v0/' || e.base_url || e.ref || '.csv'
-    END;
+    JOIN pyappcache AS p ON p.key = e.cache_key
+WHERE e.ref GLOB ?
+ORDER BY {order_by};
+"""
+
+CACHE_ENTRY_ORDERINGS = {
+    "ref": "e.ref, e.content_type, e.base_url",
+    "last-read": "p.last_read DESC, e.ref, e.content_type, e.base_url",
+    "size": "e.size DESC, e.ref, e.content_type, e.base_url",
+}
+
+# Blobs can be shared, so the size on disk counts each once
+GET_CACHE_TOTALS_DQL = """
+SELECT
+    COUNT(*),
+    COALESCE(SUM(e.size), 0),
+    (
+        SELECT COALESCE(SUM(size), 0) FROM pyappcache
+        WHERE key IN (SELECT cache_key FROM etags WHERE ref GLOB ?)
+    )
+FROM
+    etags AS e
+    JOIN pyappcache AS p ON p.key = e.cache_key
+WHERE e.ref GLOB ?;
 """
 
 
@@ -68,28 +268,431 @@ class RepKey(BaseKey):
         return segs
 
 
+class BlobKey(BaseKey):
+    """Key for a blob: the content of a rep, by its sha256 digest.
+
+    Reps with the same content (eg: copies of a table) share one blob, which
+    the etags table maps them to.
+
+    """
+
+    def __init__(self, blob: str):
+        self.blob = blob
+
+    def cache_key_segments(self) -> List[str]:
+        return [BLOB_NAMESPACE, self.blob]
+
+
+class ArrowKey(RepKey):
+    """Key for the Arrow IPC file derived from a rep."""
+
+    def cache_key_segments(self) -> List[str]:
+        segs = super().cache_key_segments()
+        segs[-1] += ".arrow"
+        return segs
+
+
+class CacheCompressor:
+    """Compresses cache entries at rest, with gzip or zstd (or not at all).
+
+    This follows pyappcache's Compressor protocol, so FilesystemCache.get
+    decompresses entries as they are read.  Entries are recognised by their
+    magic number, so a cache can hold a mix of entries written with different
+    settings.
+
+    """
+
+    def __init__(self, coding: Optional[str] = None, level: Optional[int] = None):
+        if coding not in (None, "gzip", "zstd"):
+            raise CSVBaseException(f"Unknown cache compression: {coding}")
+        if coding == "zstd" and zstandard is None:
+            raise CSVBaseException(
+                "zstd cache compression needs the zstandard library:"
+                " pip install csvbase-client[zstd]"
+            )
+        self.coding = coding
+        self.level = level
+
+    def is_compressed(self, data: IO[bytes]) -> bool:
+        head = data.read(4)
+        data.seek(0)
+        return head[:2] == GZIP_MAGIC or head == ZSTD_MAGIC
+
+    def compress(self, data: IO[bytes]) -> IO[bytes]:
+        buf = io.BytesIO()
+        with self.writer(buf) as writer:
+            shutil.copyfileobj(data, writer, CHUNK_SIZE)
+        buf.seek(0)
+        return buf
+
+    def decompress(self, data: IO[bytes]) -> IO[bytes]:
+        """Return a stream of the decompressed entry.  It is decompressed as
+        it is read, not all at once."""
+        head = data.read(4)
+        data.seek(0)
+        if head == ZSTD_MAGIC:
+            if zstandard is None:
+                data.close()
+                raise CSVBaseException(
+                    "Cache entry is zstd compressed but the zstandard library"
+                    " is not installed: pip install csvbase-client[zstd]"
+                )
+            return zstandard.ZstdDecompressor().stream_reader(data, closefd=True)
+        return cast(IO[bytes], _GzipRep(data))
+
+    @contextmanager
+    def writer(self, f: IO[bytes]) -> Iterator[IO[bytes]]:
+        """Wrap f, a new cache entry, so that what is written is compressed."""
+        if self.coding is None:
+            yield f
+            return
+        level = self.level
+        if level is None:
+            level = DEFAULT_COMPRESSION_LEVELS[self.coding]
+        if self.coding == "gzip":
+            with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=level) as gzip_f:
+                yield gzip_f  # type: ignore
+        elif self.coding == "zstd":
+            compressor = zstandard.ZstdCompressor(level=level)
+            with compressor.stream_writer(f, closefd=False) as zstd_f:
+                yield zstd_f
+
+
+class _GzipRep(gzip.GzipFile):
+    """A gzipped cache entry, read as if it were not compressed."""
+
+    def __init__(self, fileobj: IO[bytes]) -> None:
+        super().__init__(fileobj=fileobj, mode="rb")
+        self._entry_f = fileobj
+
+    def fileno(self) -> int:
+        # GzipFile gives the fileno of the compressed file, which would be
+        # wrong to mmap or fstat
+        raise io.UnsupportedOperation("compressed cache entries have no fileno")
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            # unlike GzipFile, close the underlying file too
+            self._entry_f.close()
+
+
+class KeyLock:
+    """An exclusive lock on one stripe of a cache's keys, held against both
+    other threads and other processes (via flock on a lock file).
+
+    Use as a context manager.  An instance can only be held once at a time,
+    so get a new one (from RepCache.lock) for each use.
+
+    """
+
+    def __init__(self, thread_lock: Lock, path: Path, stripe: int) -> None:
+        self.stripe = stripe
+        self._thread_lock = thread_lock
+        self._path = path
+        self._lock_f: Optional[IO[bytes]] = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Acquire the lock, returning whether it was.  Unless blocking, this
+        returns False at once if another thread or process holds it."""
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if fcntl is None:
+            return True
+        try:
+            self._lock_f = self._path.open("ab")
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            fcntl.flock(self._lock_f.fileno(), flags)
+            return True
+        except BlockingIOError:
+            self._unlock_thread()
+            return False
+        except BaseException:
+            self._unlock_thread()
+            raise
+
+    def _unlock_thread(self) -> None:
+        if self._lock_f is not None:
+            self._lock_f.close()
+            self._lock_f = None
+        self._thread_lock.release()
+
+    def release(self) -> None:
+        if self._lock_f is not None:
+            # closing would release the flock anyway
+            fcntl.flock(self._lock_f.fileno(), fcntl.LOCK_UN)
+            self._lock_f.close()
+            self._lock_f = None
+        self._thread_lock.release()
+
+    def __enter__(self) -> "KeyLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.release()
+
+
+class RepCache(FilesystemCache):
+    """A FilesystemCache that can be used from many threads, and many
+    processes, at once.
+
+    One connection to the metadata db is shared between threads, and all use
+    of it (by pyappcache and by the functions in this module) is done under
+    METADATA_LOCK.  The db is in WAL mode, so committing does not fsync.
+
+    Entries are written to a temporary file, fsynced and then renamed into
+    place, so other processes never see a partly written entry, and the
+    metadata db never refers to one that could be lost in a crash.  Filling
+    a particular entry should be done under its lock (see lock).
+
+    """
+
+    def __init__(self, directory: Path) -> None:
+        with METADATA_LOCK:
+            super().__init__(directory)
+            self.metadata_conn.close()
+            self.metadata_conn = sqlite3.connect(
+                str(directory / self.METADATA_DB_FILENAME), check_same_thread=False
+            )
+            self.metadata_conn.execute("PRAGMA journal_mode=WAL;")
+            self.metadata_conn.execute("PRAGMA synchronous=NORMAL;")
+            ensure_etag_table(self)
+        self._pending_touches: Dict[str, str] = {}
+        self._last_flush = time.monotonic()
+        self._orphans_removed_at: Optional[float] = None
+        self.compressor: CacheCompressor = CacheCompressor()
+        self._key_locks = [Lock() for _ in range(KEY_LOCK_STRIPES)]
+        (directory / LOCKS_DIRNAME).mkdir(exist_ok=True)
+
+    def lock(self, key: BaseKey) -> KeyLock:
+        """Return a lock for the given key, which is respected by all threads
+        and processes using this cache directory.
+
+        Keys are spread over KEY_LOCK_STRIPES locks, so unrelated keys only
+        occasionally (1 in KEY_LOCK_STRIPES) share a lock.  When they do, they
+        wait on each other just as if they were the same key: eg: a reader of
+        one table can wait for the whole download of another, even one by
+        another process.
+
+        """
+        raw_key = build_raw_key(self.prefix, key)
+        digest = hashlib.sha256(raw_key.encode("utf-8")).digest()
+        stripe = int.from_bytes(digest[:8], "big") % KEY_LOCK_STRIPES
+        return KeyLock(
+            self._key_locks[stripe],
+            self.directory / LOCKS_DIRNAME / f"{stripe}.lock",
+            stripe,
+        )
+
+    def get_raw(self, raw_key: str) -> Optional[IO[bytes]]:
+        now = datetime.utcnow().isoformat()
+        with METADATA_LOCK:
+            with closing(self.metadata_conn.cursor()) as cursor:
+                cursor.execute(IS_LIVE_DQL, (raw_key, now))
+                if cursor.fetchone() is None:
+                    return None
+            self._pending_touches[raw_key] = now
+            if (
+                len(self._pending_touches) >= TOUCH_BATCH_SIZE
+                or time.monotonic() - self._last_flush >= TOUCH_BATCH_SECONDS
+            ):
+                self.flush()
+
+        path = self._make_path(raw_key)
+        try:
+            return path.open("rb")
+        except FileNotFoundError:
+            return None
+
+    def set_raw(self, raw_key: str, value_bytes: IO[bytes], ttl_seconds: int) -> None:
+        """As FilesystemCache.set_raw, but the value is written (into a
+        temporary file, renamed into place) before taking the metadata lock,
+        which is then held only to record it."""
+        # value_bytes has already been through the compressor
+        with temp_cache_file(self) as temp_f:
+            shutil.copyfileobj(value_bytes, temp_f, CHUNK_SIZE)
+            size = temp_f.tell()
+        os.replace(temp_f.name, self._make_path(raw_key))
+        if ttl_seconds != 0:
+            expiry = (datetime.utcnow() + timedelta(seconds=ttl_seconds)).isoformat()
+        else:
+            expiry = "-1"
+        with METADATA_LOCK:
+            with closing(self.metadata_conn.cursor()) as cursor:
+                cursor.execute(
+                    SET_DML, (raw_key, expiry, datetime.utcnow().isoformat(), size)
+                )
+            self.metadata_conn.commit()
+        self._evict()
+
+    def flush(self) -> None:
+        """Write out any held back updates to last_read."""
+        with METADATA_LOCK:
+            if len(self._pending_touches) > 0:
+                with closing(self.metadata_conn.cursor()) as cursor:
+                    cursor.executemany(
+                        TOUCH_DML2,
+                        [(last, key) for key, last in self._pending_touches.items()],
+                    )
+                self.metadata_conn.commit()
+                self._pending_touches.clear()
+            self._last_flush = time.monotonic()
+
+    def _evict(self) -> None:
+        """Evict expired entries, and then the least recently read ones until
+        the cache is within max_size_bytes.  The etags of the reps in evicted
+        blobs go too."""
+        now = datetime.utcnow().isoformat()
+        with METADATA_LOCK:
+            self.flush()
+            with closing(self.metadata_conn.cursor()) as cursor:
+                cursor.execute(
+                    GET_EVICTION_COHORT_DQL2, (now, self.max_size_bytes, now)
+                )
+                evicted = {row[0] for row in cursor.fetchall()}
+                if len(evicted) == 0:
+                    return
+                evicted_keys = [(key,) for key in evicted]
+                cursor.executemany(DELETE_ENTRY_DML, evicted_keys)
+                cursor.executemany(DELETE_ENTRY_ETAGS_DML, evicted_keys)
+            self.metadata_conn.commit()
+
+        logger.info("evicted %d entries from the cache", len(evicted))
+        for raw_key in evicted:
+            self._make_path(raw_key).unlink(missing_ok=True)
+        # looking for orphans means listing the whole directory, so is done at
+        # most once per ORPHAN_SECONDS (orphans younger than that are left
+        # anyway)
+        if (
+            self._orphans_removed_at is None
+            or time.monotonic() - self._orphans_removed_at >= ORPHAN_SECONDS
+        ):
+            self.remove_orphans()
+
+    def clear(self) -> None:
+        """Remove every entry, and every etag."""
+        with METADATA_LOCK:
+            self._pending_touches.clear()
+            with closing(self.metadata_conn.cursor()) as cursor:
+                cursor.execute("SELECT key FROM pyappcache;")
+                keys = [row[0] for row in cursor.fetchall()]
+                cursor.execute("DELETE FROM pyappcache;")
+                cursor.execute("DELETE FROM etags;")
+            self.metadata_conn.commit()
+        for raw_key in keys:
+            self._make_path(raw_key).unlink(missing_ok=True)
+        self.remove_orphans()
+
+    def remove_orphans(self) -> None:
+        """Remove files in the cache directory that are not cache entries, for
+        example those left behind by a process that died while writing."""
+        self._orphans_removed_at = time.monotonic()
+        cutoff = time.time() - ORPHAN_SECONDS
+        with METADATA_LOCK, closing(self.metadata_conn.cursor()) as cursor:
+            cursor.execute("SELECT key FROM pyappcache;")
+            entry_names = {self._make_path(row[0]).name for row in cursor.fetchall()}
+        for path in self.directory.iterdir():
+            if path.name in entry_names or path.name.startswith(
+                self.METADATA_DB_FILENAME
+            ):
+                continue
+            try:
+                if path.is_file() and path.stat().st_mtime < cutoff:
+                    logger.info("removing orphaned file from cache: %s", path)
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def release_blob(self, blob: str) -> None:
+        """Remove a blob, unless some rep still refers to it."""
+        raw_key = build_raw_key(self.prefix, BlobKey(blob))
+        with METADATA_LOCK, closing(self.metadata_conn.cursor()) as cursor:
+            cursor.execute(COUNT_BLOB_REFS_DQL, (raw_key,))
+            (ref_count,) = cursor.fetchone()
+            if ref_count > 0:
+                return
+            self._pending_touches.pop(raw_key, None)
+            cursor.execute(DELETE_ENTRY_DML, (raw_key,))
+            self.metadata_conn.commit()
+        logger.debug("removing unreferenced blob: %s", blob)
+        self._make_path(raw_key).unlink(missing_ok=True)
+
+
+# Caches are opened once per directory and then reused for the life of the
+# process.
+_fs_caches: Dict[Path, RepCache] = {}
+
+
+def _flush_fs_caches() -> None:
+    with METADATA_LOCK:
+        for fs_cache in _fs_caches.values():
+            fs_cache.flush()
+
+
+def _forget_fs_caches() -> None:
+    """Forked children must not use the parent's connections (or locks)."""
+    global METADATA_LOCK
+    METADATA_LOCK = RLock()
+    _fs_caches.clear()
+
+
+atexit.register(_flush_fs_caches)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_fs_caches)
+
+
 def cache_path() -> Path:
     return Path(dirs.user_cache_dir)
 
 
-def get_fs_cache(path: Optional[Path] = None) -> FilesystemCache:
-    fs_cache = FilesystemCache(path or cache_path())
-    # FIXME: this prefix should go at some point
-    fs_cache.prefix = "v0"
-    fs_cache.serialiser = BinaryFileSerialiser()
-    ensure_etag_table(fs_cache)
+def get_fs_cache(path: Optional[Path] = None) -> RepCache:
+    directory = path or cache_path()
+    with METADATA_LOCK:
+        fs_cache = _fs_caches.get(directory)
+        if fs_cache is None:
+            fs_cache = RepCache(directory)
+            # FIXME: this prefix should go at some point
+            fs_cache.prefix = "v0"
+            fs_cache.serialiser = BinaryFileSerialiser()
+            config = get_config()
+            fs_cache.compressor = CacheCompressor(
+                config.cache_compression, config.cache_compression_level
+            )
+            fs_cache.max_size_bytes = get_cache_max_size()
+            _fs_caches[directory] = fs_cache
     return fs_cache
 
 
+def get_cache_max_size() -> int:
+    """The maximum size of the cache in bytes: from the environment variable,
+    else the config file, else the default."""
+    from_env = os.environ.get(CACHE_MAX_SIZE_ENV_VAR)
+    if from_env:
+        return parse_size(from_env)
+    from_config = get_config().cache_max_size
+    if from_config is not None:
+        return from_config
+    return DEFAULT_CACHE_MAX_SIZE
+
+
 def ensure_etag_table(fs_cache) -> None:
-    with closing(fs_cache.metadata_conn.cursor()) as cursor:
+    with METADATA_LOCK, closing(fs_cache.metadata_conn.cursor()) as cursor:
         cursor.execute(ETAG_DDL2)
+        cursor.execute("PRAGMA table_info(etags);")
+        columns = {row[1] for row in cursor.fetchall()}
+        for column, ddl in ETAG_COLUMN_MIGRATIONS.items():
+            if column not in columns:
+                cursor.execute(ddl)
+        cursor.execute(ETAG_CACHE_KEY_INDEX_DDL)
+        fs_cache.metadata_conn.commit()
 
 
 def get_last_etag(
-    cache: FilesystemCache, base_url: str, ref: str, content_type: ContentType
+    cache: RepCache, base_url: str, ref: str, content_type: ContentType
 ) -> Optional[str]:
-    with closing(cache.metadata_conn.cursor()) as cursor:
+    with METADATA_LOCK, closing(cache.metadata_conn.cursor()) as cursor:
         cursor.execute(GET_ETAG_DQL2, (base_url, ref, content_type.mimetype()))
         rv = cursor.fetchone()
         if rv is not None:
@@ -98,16 +701,352 @@ def get_last_etag(
             return None
 
 
+def get_last_metadata(
+    cache: RepCache, base_url: str, ref: str, content_type: ContentType
+) -> Optional[RepMetadata]:
+    with METADATA_LOCK, closing(cache.metadata_conn.cursor()) as cursor:
+        cursor.execute(GET_METADATA_DQL, (base_url, ref, content_type.mimetype()))
+        rv = cursor.fetchone()
+    if rv is not None:
+        etag, size, last_modified, validated_at, max_age = rv
+        return RepMetadata(
+            etag=etag,
+            size=size,
+            last_modified=(
+                datetime.fromisoformat(last_modified)
+                if last_modified is not None
+                else None
+            ),
+            validated_at=(
+                datetime.fromisoformat(validated_at)
+                if validated_at is not None
+                else None
+            ),
+            max_age=max_age,
+        )
+    else:
+        return None
+
+
 def set_etag(
-    cache: FilesystemCache,
+    cache: RepCache,
     base_url: str,
     ref: str,
     content_type: ContentType,
     etag: str,
+    size: Optional[int] = None,
+    last_modified: Optional[datetime] = None,
+    max_age: Optional[int] = None,
+    blob: Optional[str] = None,
 ) -> None:
-    with closing(cache.metadata_conn.cursor()) as cursor:
-        cursor.execute(SET_ETAG_DML2, (base_url, ref, content_type.mimetype(), etag))
+    """Record the etag (and metadata) of a rep just got from the server, and
+    the blob holding it (see store_blob).
+
+    The blob the rep was previously in is removed if nothing else refers to
+    it.
+
+    """
+    with METADATA_LOCK, closing(cache.metadata_conn.cursor()) as cursor:
+        cursor.execute(GET_BLOB_DQL, (base_url, ref, content_type.mimetype()))
+        row = cursor.fetchone()
+        previous_blob = row[0] if row is not None else None
+        cursor.execute(
+            SET_ETAG_DML2,
+            (
+                base_url,
+                ref,
+                content_type.mimetype(),
+                etag,
+                size,
+                last_modified.isoformat() if last_modified is not None else None,
+                datetime.utcnow().isoformat(),
+                max_age,
+                blob,
+                (
+                    build_raw_key(cache.prefix, BlobKey(blob))
+                    if blob is not None
+                    else None
+                ),
+            ),
+        )
         cache.metadata_conn.commit()
+        if previous_blob is not None and previous_blob != blob:
+            cache.release_blob(previous_blob)
+
+
+def mark_validated(
+    cache: RepCache,
+    base_url: str,
+    ref: str,
+    content_type: ContentType,
+    max_age: Optional[int] = None,
+) -> None:
+    """Record that the server has just confirmed the cached rep is current."""
+    with METADATA_LOCK, closing(cache.metadata_conn.cursor()) as cursor:
+        cursor.execute(
+            MARK_VALIDATED_DML,
+            (
+                datetime.utcnow().isoformat(),
+                max_age,
+                base_url,
+                ref,
+                content_type.mimetype(),
+            ),
+        )
+        cache.metadata_conn.commit()
+
+
+def is_fresh(metadata: RepMetadata, max_age: Optional[float]) -> bool:
+    """Whether a cached rep can be used without asking the server.
+
+    max_age is how stale (in seconds) the caller will accept, None meaning to
+    go by what the server said.  The server's Cache-Control is honoured either
+    way: it can shorten max_age but not extend it.
+
+    """
+    if metadata.validated_at is None:
+        return False
+    if max_age is None:
+        fresh_for: Optional[float] = metadata.max_age
+    elif metadata.max_age is None:
+        fresh_for = max_age
+    else:
+        fresh_for = min(max_age, metadata.max_age)
+    if fresh_for is None or fresh_for <= 0:
+        return False
+    age = (datetime.utcnow() - metadata.validated_at).total_seconds()
+    return 0 <= age < fresh_for
+
+
+def get_fresh_rep(
+    cache: RepCache,
+    base_url: str,
+    ref: str,
+    content_type: ContentType,
+    max_age: Optional[float],
+) -> Optional[IO[bytes]]:
+    """Return the cached rep if it is fresh (see is_fresh), else None."""
+    metadata = get_last_metadata(cache, base_url, ref, content_type)
+    if metadata is None or not is_fresh(metadata, max_age):
+        return None
+    return get_last_rep(cache, base_url, ref, content_type)
+
+
+def get_last_rep(
+    cache: RepCache, base_url: str, ref: str, content_type: ContentType
+) -> Optional[IO[bytes]]:
+    """Return the cached rep of the last known version of a ref, if the
+    cache still has it."""
+    with METADATA_LOCK, closing(cache.metadata_conn.cursor()) as cursor:
+        cursor.execute(GET_BLOB_DQL, (base_url, ref, content_type.mimetype()))
+        row = cursor.fetchone()
+    # reps cached before there were blobs have none, and are got again
+    if row is None or row[0] is None:
+        return None
+    blob_key: Key[IO[bytes]] = BlobKey(row[0])
+    return cache.get(blob_key)
+
+
+def store_blob(
+    cache: RepCache,
+    stream: Readable,
+    record: Optional[Callable[[str], None]] = None,
+) -> Tuple[str, IO[bytes]]:
+    """Copy a stream into the cache, as a blob: returning its digest and a
+    handle on it.  Content that is already cached is not stored again.
+
+    The stream is copied in fixed-size chunks into a temporary file alongside
+    the cache entries and then renamed into place, so memory use does not
+    depend on the size of the representation and a half-written entry is
+    never visible to readers.
+
+    Until something refers to it, a blob can be released (see release_blob)
+    by another thread, so record (eg: a call to set_etag) is called with the
+    digest as soon as the blob is in place, without letting go of the
+    metadata lock in between.
+
+    """
+    digest = hashlib.sha256()
+    with temp_cache_file(cache) as temp_f:
+        with cache.compressor.writer(temp_f) as entry_f:
+            while len(chunk := stream.read(CHUNK_SIZE)) > 0:
+                digest.update(chunk)
+                entry_f.write(chunk)
+    blob = digest.hexdigest()
+    return blob, publish_blob(cache, blob, Path(temp_f.name), record)
+
+
+def publish_blob(
+    cache: RepCache,
+    blob: str,
+    temp_path: Path,
+    record: Optional[Callable[[str], None]] = None,
+) -> IO[bytes]:
+    """As publish_into_cache, but for a blob (and record is as for
+    store_blob).  If the cache already has the blob, the temporary file is
+    discarded."""
+    blob_key: Key[IO[bytes]] = BlobKey(blob)
+    with METADATA_LOCK:
+        rep = cache.get(blob_key)
+        if rep is not None and record is not None:
+            record(blob)
+    if rep is not None:
+        logger.debug("blob already cached: %s", blob)
+        temp_path.unlink()
+        return rep
+    return publish_into_cache(
+        cache,
+        blob_key,
+        temp_path,
+        (lambda: record(blob)) if record is not None else None,
+    )
+
+
+@contextmanager
+def temp_cache_file(cache: RepCache) -> Iterator[IO[bytes]]:
+    """A temporary file in the cache directory, for writing a rep into before
+    it is published with publish_into_cache.  Removed if writing fails, and
+    made durable (fsynced) if it doesn't.
+
+    Reps should be written via cache.compressor.writer.
+
+    """
+    with tempfile.NamedTemporaryFile(
+        dir=cache.directory, prefix=".tmp-", delete=False
+    ) as temp_f:
+        try:
+            yield temp_f
+            temp_f.flush()
+            os.fsync(temp_f.fileno())
+        except BaseException:
+            temp_f.close()
+            os.unlink(temp_f.name)
+            raise
+
+
+def publish_into_cache(
+    cache: RepCache,
+    rep_key: Key[IO[bytes]],
+    temp_path: Path,
+    record: Optional[Callable[[], None]] = None,
+) -> IO[bytes]:
+    """Move a (fully written) temporary file into place as the cache entry for
+    rep_key, returning a handle on it.
+
+    If given, record is called as the entry is recorded, under the metadata
+    lock and in the same transaction.  The cache is only evicted from after
+    that, so whatever record refers to is evicted along with the entry.
+
+    """
+    raw_key = build_raw_key(cache.prefix, rep_key)
+    path = cache._make_path(raw_key)
+    size = temp_path.stat().st_size
+    os.replace(temp_path, path)
+    fsync_directory(cache.directory)
+    # the entry is durable, so now it can be recorded
+    with METADATA_LOCK:
+        with closing(cache.metadata_conn.cursor()) as cursor:
+            cursor.execute(
+                SET_DML, (raw_key, "-1", datetime.utcnow().isoformat(), size)
+            )
+        if record is not None:
+            record()
+        cache.metadata_conn.commit()
+    # open before evicting so that the handle remains valid even if this entry
+    # is itself evicted
+    rep: IO[bytes] = path.open("rb")
+    if cache.compressor.is_compressed(rep):
+        rep = cache.compressor.decompress(rep)
+    cache._evict()
+    return rep
+
+
+def fsync_directory(directory: Path) -> None:
+    """Make renames into a directory durable."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # directories can't be opened on Windows, where renames are durable
+        # anyway
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def rep_size(rep: IO[bytes]) -> int:
+    """Return the size of a rep from the cache, as read (ie: decompressed).
+
+    For compressed entries, this means reading through it.
+
+    """
+    try:
+        return os.fstat(rep.fileno()).st_size
+    except (AttributeError, OSError):
+        return sum(len(chunk) for chunk in iter(lambda: rep.read(CHUNK_SIZE), b""))
+
+
+def get_cached_rep(
+    cache: RepCache,
+    base_url: str,
+    ref: str,
+    content_type: ContentType,
+    etag: str,
+) -> Optional[IO[bytes]]:
+    """Return the cached rep, but only if it has the given etag."""
+    if get_last_etag(cache, base_url, ref, content_type) != etag:
+        return None
+    return get_last_rep(cache, base_url, ref, content_type)
+
+
+def get_arrow_table(
+    cache: RepCache, base_url: str, ref: str, etag: str, rep: IO[bytes]
+) -> "pyarrow.Table":
+    """Return a (cached, csv) rep as an Arrow table, memory mapped from an
+    Arrow IPC file derived from it.
+
+    The IPC file is built from rep the first time and rebuilt whenever the
+    etag changes, so the csv is parsed only once per version of the table.
+
+    """
+    try:
+        import pyarrow.csv
+        import pyarrow.ipc
+    except ImportError:
+        raise CSVBaseException(
+            "Reading tables as arrow needs pyarrow: pip install csvbase-client[arrow]"
+        )
+    arrow_key: Key[IO[bytes]] = ArrowKey(base_url, ref, ContentType.CSV)
+    path = cache._make_path(build_raw_key(cache.prefix, arrow_key))
+
+    # the cache is asked first so that last_read is updated (and expired
+    # entries are not used)
+    entry = cache.get(arrow_key)
+    if entry is not None:
+        entry.close()
+        try:
+            reader = pyarrow.ipc.open_file(pyarrow.memory_map(str(path)))
+        except (FileNotFoundError, pyarrow.ArrowInvalid):
+            reader = None
+        if reader is not None and (reader.schema.metadata or {}).get(
+            ARROW_ETAG_METADATA_KEY
+        ) == etag.encode("utf-8"):
+            return reader.read_all().replace_schema_metadata(None)
+
+    table = pyarrow.csv.read_csv(rep)
+    with temp_cache_file(cache) as temp_f:
+        # never compressed, so that it can be memory mapped
+        schema = table.schema.with_metadata(
+            {ARROW_ETAG_METADATA_KEY: etag.encode("utf-8")}
+        )
+        with pyarrow.ipc.new_file(temp_f, schema) as writer:
+            writer.write_table(table.replace_schema_metadata(schema.metadata))
+    publish_into_cache(cache, arrow_key, Path(temp_f.name)).close()
+    # the mapping stays open for as long as the table (or any part of it)
+    # is in use
+    reader = pyarrow.ipc.open_file(pyarrow.memory_map(str(path)))
+    return reader.read_all().replace_schema_metadata(None)
 
 
 @dataclass
@@ -120,6 +1059,9 @@ class CacheEntry:
     etag: str
     last_read: datetime
     size_bytes: int
+    """The size on disk, which is smaller if the entry is compressed"""
+    logical_size_bytes: Optional[int]
+    """The size of the rep itself, if known"""
 
     def etag_prefix(self) -> str:
         """Return a short prefix of the etag (minus the w/ bit) in order to
@@ -128,11 +1070,53 @@ class CacheEntry:
         """
         return self.etag[4:14]
 
+    def path(self) -> str:
+        """Return the path of the entry, as would be given to the fsspec
+        filesystem."""
+        return path_for_rep(self.ref, self.content_type)
+
+    def as_json(self) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "ref": self.ref,
+            "path": self.path(),
+            "content_type": self.content_type.mimetype(),
+            "etag": self.etag,
+            "last_read": self.last_read.isoformat(),
+            "size_bytes": self.size_bytes,
+            "logical_size_bytes": self.logical_size_bytes,
+        }
 
-def cache_contents(fs_cache: FilesystemCache) -> Iterator[CacheEntry]:
-    """Returns metadata on each cache entry"""
-    with closing(fs_cache.metadata_conn.cursor()) as cursor:
-        cursor.execute(GET_CACHE_ENTRIES_DQL)
+
+@dataclass
+class CacheTotals:
+    """Value object for cache_totals"""
+
+    entries: int
+    size_bytes: int
+    """The size on disk, counting shared blobs once"""
+    logical_size_bytes: int
+    """The total size of the reps, where known"""
+
+
+def cache_contents(
+    fs_cache: RepCache, sort: str = "ref", ref_glob: str = "*"
+) -> Iterator[CacheEntry]:
+    """Returns metadata on each cache entry, in the order given by sort (one
+    of CACHE_ENTRY_ORDERINGS).  ref_glob restricts it to refs that match,
+    eg: "calpaterson/*".
+
+    The entries are read from the db as they are iterated over, on a
+    (read-only) connection of their own: so without holding METADATA_LOCK,
+    and seeing the db as it was when iteration began.
+
+    """
+    order_by = CACHE_ENTRY_ORDERINGS[sort]
+    fs_cache.flush()
+    db_path = (fs_cache.directory / fs_cache.METADATA_DB_FILENAME).resolve()
+    conn = sqlite3.connect(f"{db_path.as_uri()}?mode=ro", uri=True)
+    with closing(conn), closing(conn.cursor()) as cursor:
+        cursor.execute(GET_CACHE_ENTRIES_DQL.format(order_by=order_by), (ref_glob,))
         while (row := cursor.fetchone()) is not None:
             ce = CacheEntry(
                 base_url=row[0],
@@ -141,15 +1125,27 @@ def cache_contents(fs_cache: FilesystemCache) -> Iterator[CacheEntry]:
                 etag=row[3],
                 last_read=datetime.fromisoformat(row[4]).replace(tzinfo=timezone.utc),
                 size_bytes=row[5],
+                logical_size_bytes=row[6],
             )
             yield ce
 
 
+def cache_totals(fs_cache: RepCache, ref_glob: str = "*") -> CacheTotals:
+    """Returns the totals of the cache entries matching ref_glob."""
+    fs_cache.flush()
+    with METADATA_LOCK, closing(fs_cache.metadata_conn.cursor()) as cursor:
+        cursor.execute(GET_CACHE_TOTALS_DQL, (ref_glob, ref_glob))
+        entries, logical_size_bytes, size_bytes = cursor.fetchone()
+    return CacheTotals(
+        entries=entries, size_bytes=size_bytes, logical_size_bytes=logical_size_bytes
+    )
+
+
 ## old code:
 
 # import sqlite3
 # import shutil
-# from contextlib import closing
+# from contextlib import closing, contextmanager
 # from logging import getLogger
 # from pathlib import Path
 # from typing import List, Optional, IO, Any, Dict, Iterable, Tuple
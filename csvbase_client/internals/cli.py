@@ -1,30 +1,133 @@
+"""The command line interface.
+
+This is started for every invocation of csvbase-client, so should be quick to
+import: anything slow to import (eg: rich, fsspec, requests, and the cache,
+which imports pyappcache) is imported by the commands that need it.
+
+"""
+
+import json
 import shutil
 import sys
+import time
+from collections import Counter
 from logging import DEBUG, basicConfig, WARNING
-from typing import IO
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Dict, List, Optional, Tuple, Type
 
-import humanize
-import fsspec
 import click
-from rich.console import Console as RichConsole
-from rich.table import Table as RichTable
 
-from .config import config_path
-from .version import get_version
-from .cache import cache_path, get_fs_cache, cache_contents
+from .value_objs import CacheOutcome, CachePolicy, ContentType, FetchedRep
+from ..constants import CSVBASE_DOT_COM
 from ..exceptions import CSVBaseException
 
+if TYPE_CHECKING:
+    from ..instrumentation import Stats
+
+# the outcomes counted as cache hits in summaries
+CACHE_HITS = [CacheOutcome.REVALIDATED, CacheOutcome.FRESH, CacheOutcome.UNVALIDATED]
+
+# the orderings of cache show (see cache.CACHE_ENTRY_ORDERINGS, which is not
+# used here as it would mean importing the cache)
+CACHE_SORTS = ["ref", "last-read", "size"]
+
+
+def fetch_errors() -> Tuple[Type[Exception], ...]:
+    """The errors that getting one of many tables can fail with, without
+    stopping the others: from csvbase, from the connection, or from writing
+    it out (or into the cache)."""
+    import requests
+
+    return (CSVBaseException, requests.RequestException, OSError)
+
+
+def print_version(ctx: click.Context, param: click.Parameter, value: bool) -> None:
+    """As click.version_option, but only finding out the version if asked."""
+    if not value or ctx.resilient_parsing:
+        return
+    from .version import get_version
+
+    click.echo(f"{ctx.find_root().info_name}, version {get_version()}")
+    ctx.exit()
+
 
 @click.group("csvbase-client")
-@click.version_option(version=get_version())
+@click.option(
+    "--version",
+    is_flag=True,
+    expose_value=False,
+    is_eager=True,
+    callback=print_version,
+    help="Show the version and exit.",
+)
 @click.option("--verbose", is_flag=True, help="Enable more verbose output (to stderr).")
-def cli(verbose: bool):
+@click.option(
+    "--stats",
+    is_flag=True,
+    help="Summarise time taken, bytes transferred and cache use (to stderr).",
+)
+@click.pass_context
+def cli(ctx: click.Context, verbose: bool, stats: bool):
     """A cli client for csvbase."""
     if verbose:
         level = DEBUG
     else:
         level = WARNING
     basicConfig(level=level, stream=sys.stderr, format="%(levelname)s: %(message)s")
+    if stats:
+        from ..instrumentation import Stats, add_hook, remove_hook
+
+        collector = Stats()
+        add_hook(collector)
+
+        def print_collected() -> None:
+            remove_hook(collector)
+            print_stats(collector)
+
+        # after the subcommand, even if it failed
+        ctx.call_on_close(print_collected)
+
+
+def print_stats(stats: "Stats") -> None:
+    """Print a table of stats per table, and in total, to stderr."""
+    import humanize
+    from rich.console import Console as RichConsole
+    from rich.table import Table as RichTable
+
+    from ..instrumentation import Phase, Summary
+
+    table = RichTable(title="csvbase-client stats")
+    table.add_column("Table")
+    table.add_column("Fresh", justify="right")
+    table.add_column("304", justify="right")
+    table.add_column("Miss", justify="right")
+    table.add_column("Failed", justify="right")
+    table.add_column("Transferred", justify="right")
+    table.add_column("Time", justify="right")
+    table.add_column("Network", justify="right")
+
+    def add_row(name: str, summary: Summary, end_section: bool = False) -> None:
+        fresh = summary.outcomes[CacheOutcome.FRESH]
+        fresh += summary.outcomes[CacheOutcome.UNVALIDATED]
+        network = summary.phases.get(Phase.REQUEST, 0.0)
+        network += summary.phases.get(Phase.TRANSFER, 0.0)
+        table.add_row(
+            name,
+            str(fresh),
+            str(summary.outcomes[CacheOutcome.REVALIDATED]),
+            str(summary.outcomes[CacheOutcome.MISS]),
+            str(summary.failures),
+            humanize.naturalsize(summary.bytes, gnu=True),
+            f"{summary.seconds:.3f}s",
+            f"{network:.3f}s",
+            end_section=end_section,
+        )
+
+    by_path = stats.by_path()
+    for index, (path, summary) in enumerate(by_path.items()):
+        add_row(path, summary, end_section=index == len(by_path) - 1)
+    add_row("total", stats.total())
+    RichConsole(stderr=True).print(table)
 
 
 @cli.group("table", help="Interact with tables")
@@ -34,6 +137,9 @@ def table(): ...
 @cli.command()
 def info():
     """Show the configuration file location, and the contents"""
+    from .cache import cache_path
+    from .config import config_path
+
     exist_str = "" if config_path().exists() else " (does not exist)"
     click.echo(f"config path: {config_path()}{exist_str}")
     exist_str = "" if cache_path().exists() else " (does not exist)"
@@ -45,21 +151,68 @@ def cache(): ...
 
 
 @cache.command("show", help="Show cache location and contents")
-def cache_show() -> None:
+@click.option(
+    "--sort",
+    type=click.Choice(CACHE_SORTS),
+    default="ref",
+    show_default=True,
+    help="Sort by ref, most recently read or largest first.",
+)
+@click.option(
+    "--filter",
+    "ref_glob",
+    default="*",
+    help="Only show refs matching this glob, eg: 'calpaterson/*'.",
+)
+@click.option(
+    "--json",
+    "as_json",
+    is_flag=True,
+    default=False,
+    help="Output the entries as JSON, one per line.",
+)
+def cache_show(sort: str, ref_glob: str, as_json: bool) -> None:
+    from .cache import cache_contents, cache_path, cache_totals, get_fs_cache
+
+    fs_cache = get_fs_cache()
+    if as_json:
+        # streamed, rather than built up in memory
+        for ce in cache_contents(fs_cache, sort, ref_glob):
+            click.echo(json.dumps(ce.as_json()))
+        return
+
+    import humanize
+    from rich.console import Console as RichConsole
+    from rich.table import Table as RichTable
+
+    max_size = humanize.naturalsize(fs_cache.max_size_bytes, gnu=True)
+    totals = cache_totals(fs_cache, ref_glob)
     table = RichTable(
-        title="csvbase-client cache", caption=f"Cache path: {cache_path()}"
+        title="csvbase-client cache",
+        caption=(
+            f"{totals.entries} tables,"
+            f" {humanize.naturalsize(totals.logical_size_bytes, gnu=True)}"
+            f" ({humanize.naturalsize(totals.size_bytes, gnu=True)} on disk)."
+            f" Cache path: {cache_path()}, max size: {max_size}"
+        ),
     )
     table.add_column("Ref")
     table.add_column("ETag prefix")
     table.add_column("Last read")
     table.add_column("Size")
+    table.add_column("Size on disk")
 
-    for ce in cache_contents(get_fs_cache()):
+    for ce in cache_contents(fs_cache, sort, ref_glob):
         # for now, only some of the CacheEntry data is surfaced
         table.add_row(
-            ce.ref,
+            ce.path(),
             ce.etag_prefix(),
             humanize.naturaltime(ce.last_read),
+            (
+                humanize.naturalsize(ce.logical_size_bytes, gnu=True)
+                if ce.logical_size_bytes is not None
+                else "unknown"
+            ),
             humanize.naturalsize(ce.size_bytes, gnu=True),
         )
 
@@ -67,13 +220,69 @@ def cache_show() -> None:
     console.print(table)
 
 
+@cache.command(
+    "refresh", help="Check all cached tables are current, downloading any changed"
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="How many tables to check at once.",
+)
+def cache_refresh(jobs: int) -> None:
+    from concurrent.futures import ThreadPoolExecutor
+
+    import fsspec
+    from rich.console import Console as RichConsole
+
+    from .cache import cache_contents, get_fs_cache
+    from ..fsspec import parse_path
+
+    # the filesystem only talks to csvbase.com, so only its entries can be
+    # refreshed
+    paths = [
+        ce.path()
+        for ce in cache_contents(get_fs_cache())
+        if ce.base_url == CSVBASE_DOT_COM
+    ]
+    fs = fsspec.filesystem("csvbase", pool_size=jobs)
+    error_console = RichConsole(stderr=True, style="bold red")
+
+    def refresh_one(path: str) -> Optional[CacheOutcome]:
+        try:
+            # max_age=0 so that even fresh entries are revalidated
+            fetched = fs._fetch_rep(*parse_path(path), max_age=0)
+        except fetch_errors() as e:
+            error_console.print(f"{path}: {e}")
+            return None
+        fetched.rep.close()
+        if fetched.outcome == CacheOutcome.MISS:
+            click.echo(f"updated: {path}", err=True)
+        return fetched.outcome
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(jobs) as executor:
+        outcomes = Counter(executor.map(refresh_one, paths))
+    duration = time.perf_counter() - start
+
+    click.echo(
+        f"refreshed {len(paths)} tables in {duration:.2f}s:"
+        f" {outcomes[CacheOutcome.MISS]} updated,"
+        f" {outcomes[CacheOutcome.REVALIDATED]} skipped (unchanged),"
+        f" {outcomes[None]} failed",
+        err=True,
+    )
+    if outcomes[None] > 0:
+        sys.exit(1)
+
+
 @cache.command("clear", help="Wipe the cache")
 def clear() -> None:
-    fs_cache = get_fs_cache()
-    fs_cache.clear()
-    # FIXME: it should be pyappcache that does this:
-    for path in fs_cache.directory.glob("*.csv"):
-        path.unlink()
+    from .cache import get_fs_cache
+
+    get_fs_cache().clear()
 
 
 # @cli.command()
@@ -103,23 +312,157 @@ def clear() -> None:
 #         exit(1)
 
 
-@table.command(help="Get a table.")
-@click.argument("ref")
+@table.command(
+    help="Get one or more tables.  Add .parquet to a ref to get it as parquet."
+)
+@click.argument("refs", nargs=-1)
+@click.option(
+    "--refs-file",
+    type=click.File("r"),
+    help="Also get the refs listed in this file, one per line ('-' for stdin).",
+)
+@click.option(
+    "--output-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    help="Write each table to <output-dir>/<ref>.csv (or .parquet) not stdout.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="How many tables to get at once (with --output-dir).",
+)
 @click.option(
     "--force-cache-miss",
     is_flag=True,
     default=False,
     help="Always download the table again, even if it hasn't changed",
 )
-def get(ref: str, force_cache_miss: bool):
-    fs = fsspec.filesystem("csvbase")
-    try:
-        table_buf = fs.open(ref, "r")
-    except CSVBaseException as e:
-        error_console = RichConsole(stderr=True, style="bold red")
-        error_console.print(str(e))
+@click.option(
+    "--offline",
+    is_flag=True,
+    default=False,
+    help="Only use the cache, never csvbase (fails for tables not cached).",
+)
+def get(
+    refs: Tuple[str, ...],
+    refs_file: Optional[IO[str]],
+    output_dir: Optional[Path],
+    jobs: int,
+    force_cache_miss: bool,
+    offline: bool,
+):
+    all_refs = list(refs)
+    if refs_file is not None:
+        all_refs.extend(line.strip() for line in refs_file if line.strip() != "")
+    if len(all_refs) == 0:
+        raise click.UsageError("No refs given")
+    if force_cache_miss and offline:
+        raise click.UsageError("--force-cache-miss and --offline are contradictory")
+    if force_cache_miss:
+        cache_policy = CachePolicy.NO_CACHE
+    elif offline:
+        cache_policy = CachePolicy.ONLY_IF_CACHED
+    else:
+        cache_policy = CachePolicy.DEFAULT
+
+    if output_dir is None:
+        if len(all_refs) > 1:
+            raise click.UsageError("--output-dir is required for more than one ref")
+        import fsspec
+        from rich.console import Console as RichConsole
+
+        fs = fsspec.filesystem("csvbase", cache_policy=cache_policy)
+        try:
+            table_buf = fs.open(all_refs[0], "rb")
+        except CSVBaseException as e:
+            error_console = RichConsole(stderr=True, style="bold red")
+            error_console.print(str(e))
+            sys.exit(1)
+        # binary, as the table might be parquet
+        shutil.copyfileobj(table_buf, sys.stdout.buffer)
+    else:
+        get_many(all_refs, output_dir, jobs, cache_policy)
+
+
+def get_many(
+    refs: List[str],
+    output_dir: Path,
+    jobs: int,
+    cache_policy: CachePolicy = CachePolicy.DEFAULT,
+) -> None:
+    """Get many tables at once, writing each into output_dir and then
+    reporting on how it went (to stderr)."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    import fsspec
+    import humanize
+    from rich.console import Console as RichConsole
+
+    from ..fsspec import parse_path
+
+    fs = fsspec.filesystem("csvbase", pool_size=jobs, cache_policy=cache_policy)
+    error_console = RichConsole(stderr=True, style="bold red")
+
+    # refs that would be written to the same file (eg: given twice) are only
+    # got once, so that they don't race to write it
+    output_paths: Dict[Path, str] = {}
+    invalid = 0
+    for ref in refs:
+        try:
+            output_path = get_output_path(output_dir, *parse_path(ref))
+        except CSVBaseException as e:
+            error_console.print(str(e))
+            invalid += 1
+            continue
+        output_paths.setdefault(output_path, ref)
+
+    def get_one(item: Tuple[Path, str]) -> Tuple[str, Optional[FetchedRep], int]:
+        output_path, ref = item
+        try:
+            fetched = fs._fetch_rep(*parse_path(ref))
+            with fetched.rep:
+                output_path.parent.mkdir(parents=True, exist_ok=True)
+                with output_path.open("wb") as output_f:
+                    shutil.copyfileobj(fetched.rep, output_f)
+                    return ref, fetched, output_f.tell()
+        except fetch_errors() as e:
+            error_console.print(f"{ref}: {e}")
+            return ref, None, 0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(jobs) as executor:
+        results = list(executor.map(get_one, output_paths.items()))
+    duration = time.perf_counter() - start
+
+    outcomes = Counter(fetched.outcome for _, fetched, _ in results if fetched)
+    failed = invalid + len([ref for ref, fetched, _ in results if fetched is None])
+    total_bytes = sum(size for _, _, size in results)
+    tables = invalid + len(results)
+    click.echo(
+        f"got {tables - failed} of {tables} tables"
+        f" ({humanize.naturalsize(total_bytes, gnu=True)})"
+        f" in {duration:.2f}s:"
+        f" {sum(outcomes[outcome] for outcome in CACHE_HITS)} cache hits,"
+        f" {outcomes[CacheOutcome.MISS]} cache misses,"
+        f" {failed} failed",
+        err=True,
+    )
+    if failed > 0:
         sys.exit(1)
-    shutil.copyfileobj(table_buf, sys.stdout)
+
+
+def get_output_path(output_dir: Path, ref: str, content_type: ContentType) -> Path:
+    """Return where in output_dir a table is written, refusing refs that would
+    be written outside of it."""
+    output_path = output_dir / (ref + content_type.file_extension())
+    try:
+        output_path.resolve().relative_to(output_dir.resolve())
+    except ValueError:
+        raise CSVBaseException(f"not a valid ref: {ref}")
+    return output_path
 
 
 # @table.command("show", help="Show metadata about a table")
@@ -138,13 +481,20 @@ def get(ref: str, force_cache_miss: bool):
 #     click.echo(toml.dumps(rv))
 
 
-@table.command("set", help="Create or upsert a table.")
+@table.command(
+    "set", help="Create or upsert a table.  FILE can be - for standard input."
+)
 @click.argument("ref")
 @click.argument("file", type=click.File("rb"))
-def set(ref: str, file: IO[str]):
+def set(ref: str, file: IO[bytes]):
+    import fsspec
+
+    from .cache import CHUNK_SIZE
+
     fs = fsspec.filesystem("csvbase")
+    # the table is uploaded as it is read, see CSVBaseFile._upload_chunk
     with fs.open(ref, "wb") as table_buf:
-        shutil.copyfileobj(file, table_buf)
+        shutil.copyfileobj(file, table_buf, CHUNK_SIZE)
 
 
 # NOTE: This is for convenience only, the cli is actually called by setup.py
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Optional, Union
 from dataclasses import dataclass, fields
 from pathlib import Path
 import functools
@@ -16,6 +16,11 @@ class Config:
     base_url: str
     username: Optional[str]
     api_key: Optional[str]
+    # "gzip" or "zstd" to compress cache entries at rest
+    cache_compression: Optional[str] = None
+    cache_compression_level: Optional[int] = None
+    # in bytes
+    cache_max_size: Optional[int] = None
 
 
 DEFAULT_CONFIG = Config(base_url="https://csvbase.com/", username=None, api_key=None)
@@ -39,10 +44,39 @@ def get_config() -> Config:
             base_url=parsed.get("base_url", DEFAULT_CONFIG.base_url),
             username=parsed.get("username", DEFAULT_CONFIG.username),
             api_key=parsed.get("api_key", DEFAULT_CONFIG.api_key),
+            cache_compression=parsed.get(
+                "cache_compression", DEFAULT_CONFIG.cache_compression
+            ),
+            cache_compression_level=parsed.get(
+                "cache_compression_level", DEFAULT_CONFIG.cache_compression_level
+            ),
+            cache_max_size=(
+                parse_size(parsed["cache_max_size"])
+                if "cache_max_size" in parsed
+                else DEFAULT_CONFIG.cache_max_size
+            ),
         )
         return config
 
 
+SIZE_SUFFIXES = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(size: Union[int, str]) -> int:
+    """Parse a size in bytes, optionally with a suffix, eg: "500M" or "2G"."""
+    if isinstance(size, int):
+        return size
+    size_str = size.strip().upper().rstrip("B")
+    multiplier = 1
+    if size_str[-1:] in SIZE_SUFFIXES:
+        multiplier = SIZE_SUFFIXES[size_str[-1]]
+        size_str = size_str[:-1]
+    try:
+        return int(float(size_str) * multiplier)
+    except ValueError:
+        raise ValueError(f"invalid size: '{size}'")
+
+
 def write_config(config: Config) -> None:
     path = config_path()
     if not path.exists():
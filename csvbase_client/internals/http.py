@@ -1,5 +1,17 @@
-from urllib.parse import urljoin
+import zlib
+from urllib.parse import urljoin, urlsplit
+from threading import local
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+
+try:
+    import zstandard
+except ImportError:
+    # zstd is optional: pip install csvbase-client[zstd]
+    zstandard = None
 
 from .value_objs import ContentType
 
@@ -7,22 +19,136 @@ from .value_objs import ContentType
 # requests.Session objects
 HTTP_TIMEOUT = (5, 60)
 
+# Number of connections kept open per host
+DEFAULT_POOL_SIZE = 10
+
+# The content codings downloads are negotiated with.  urllib3 decodes them:
+# gzip and deflate always, br and zstd only if the libraries for them are
+# installed.
+ACCEPT_ENCODING = make_headers(accept_encoding=True)["accept-encoding"]
+
+# Compression level for request bodies.  Low, as the point is to save time.
+GZIP_LEVEL = 1
+ZSTD_LEVEL = 3
+
 
 def _get_http_sesh() -> requests.Session:
     """This internal function exists only for testing/mocking reasons."""
     return requests.Session()
 
 
-def get_http_sesh() -> requests.Session:
+def user_agent() -> str:
+    version = "0.0.1"  # FIXME:
+    return f"csvbase-client/{version}"
+
+
+def get_http_sesh(adapter: Optional[HTTPAdapter] = None) -> requests.Session:
     sesh = _get_http_sesh()
     # disable automatic loading from the netrc - we will do that (so that we
     # can log it)
     sesh.trust_env = False
-    version = "0.0.1"  # FIXME:
-    sesh.headers.update({"User-Agent": f"csvbase-client/{version}"})
+    sesh.headers.update({"User-Agent": user_agent()})
+    if adapter is not None:
+        sesh.mount("https://", adapter)
+        sesh.mount("http://", adapter)
     return sesh
 
 
+class SessionPool:
+    """Hands out a requests.Session per thread, all sharing one pool of
+    keep-alive connections.
+
+    Sessions themselves are not thread safe (eg: the cookie jar) but the
+    connection pool underneath them is, so reusing connections across threads
+    avoids a new TCP and TLS handshake for each request.
+
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE) -> None:
+        self._adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._local = local()
+        # host -> content coding that host accepts for request bodies
+        self._body_encodings: Dict[str, Optional[str]] = {}
+
+    def get(self) -> requests.Session:
+        sesh: Optional[requests.Session] = getattr(self._local, "sesh", None)
+        if sesh is None:
+            sesh = get_http_sesh(self._adapter)
+            sesh.hooks["response"].append(self._note_body_encoding)
+            self._local.sesh = sesh
+        return sesh
+
+    def body_encoding(self, url: str) -> Optional[str]:
+        """Return the content coding to compress request bodies sent to url
+        with, if the server has said it accepts one."""
+        return self._body_encodings.get(urlsplit(url).netloc)
+
+    def _note_body_encoding(self, response: requests.Response, *args, **kwargs):
+        if "Accept-Encoding" in response.headers:
+            self._body_encodings[urlsplit(response.url).netloc] = request_body_encoding(
+                response.headers
+            )
+
+    def close(self) -> None:
+        self._adapter.close()
+
+
+def upload_encodings() -> List[str]:
+    """The content codings we can compress request bodies with, best first."""
+    return ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+
+
+def request_body_encoding(headers: Mapping[str, str]) -> Optional[str]:
+    """Choose a content coding for request bodies from those that a server
+    accepts, going by the Accept-Encoding header of one of its responses (see
+    RFC 7694)."""
+    accepted = {
+        coding.split(";")[0].strip().lower()
+        for coding in headers.get("Accept-Encoding", "").split(",")
+    }
+    for coding in upload_encodings():
+        if coding in accepted:
+            return coding
+    return None
+
+
+def compress_chunks(chunks: Iterable[bytes], coding: str) -> Iterator[bytes]:
+    """Compress a stream of chunks with the given content coding."""
+    if coding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    elif coding == "gzip":
+        # wbits of 31 means "with a gzip header"
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    else:
+        raise ValueError(f"unsupported content coding: {coding}")
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if len(compressed) > 0:
+            yield compressed
+    yield compressor.flush()
+
+
+def parse_cache_control(headers: Mapping[str, str]) -> Optional[int]:
+    """Return how long (in seconds) a response's Cache-Control header says it
+    is fresh for, or None if it doesn't say.
+
+    no-cache and no-store mean it must be revalidated every time, ie: 0.
+
+    """
+    max_age = None
+    for directive in headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().lower().partition("=")
+        if name in ("no-cache", "no-store"):
+            return 0
+        elif name == "max-age":
+            try:
+                max_age = max(int(value.strip('"')), 0)
+            except ValueError:
+                # RFC 9111 says an invalid max-age means stale
+                return 0
+    return max_age
+
+
 def ref_to_url(base_url: str, ref: str, content_type: ContentType) -> str:
     url = urljoin(base_url, ref)
     if content_type is not None:
@@ -1,6 +1,8 @@
 import enum
 from base64 import b64encode
 from dataclasses import dataclass
+from datetime import datetime
+from typing import IO, Optional
 
 
 @dataclass
@@ -14,6 +16,57 @@ class Auth:
         return f"Basic {encoded}"
 
 
+@dataclass
+class RepMetadata:
+    """What the server says about a representation, without the body."""
+
+    etag: str
+    # None when the server did not send a Content-Length
+    size: Optional[int]
+    last_modified: Optional[datetime] = None
+    # when the cached copy was last confirmed current by the server (UTC)
+    validated_at: Optional[datetime] = None
+    # how long (in seconds) the server said the rep stays fresh for, via
+    # Cache-Control.  None when it didn't say.
+    max_age: Optional[int] = None
+    # whether the server said (via Accept-Ranges) that it serves parts of the
+    # rep.  Not kept in the cache.
+    accepts_ranges: bool = False
+
+
+@enum.unique
+class CacheOutcome(enum.Enum):
+    """How a rep was got."""
+
+    # downloaded, as it was not in the cache or had changed
+    MISS = 1
+    # in the cache, and the server confirmed it had not changed
+    REVALIDATED = 2
+    # in the cache, and validated recently enough not to ask the server
+    FRESH = 3
+    # in the cache, and used without asking the server (only-if-cached)
+    UNVALIDATED = 4
+
+
+@enum.unique
+class CachePolicy(enum.Enum):
+    """How the cache is used when getting a rep."""
+
+    # use the cache, revalidating with the server unless fresh
+    DEFAULT = 1
+    # always download, ignoring whatever is cached (the result is still
+    # cached)
+    NO_CACHE = 2
+    # never touch the network: use whatever is cached, or fail
+    ONLY_IF_CACHED = 3
+
+
+@dataclass
+class FetchedRep:
+    rep: IO[bytes]
+    outcome: CacheOutcome
+
+
 @enum.unique
 class ContentType(enum.Enum):
     PARQUET = 1
@@ -44,3 +97,11 @@ FILE_EXTENSION_MAP = {
     ContentType.PARQUET: ".parquet",
     ContentType.JSON: ".json",
 }
+
+
+def path_for_rep(ref: str, content_type: ContentType) -> str:
+    """Return the path of a rep, as would be given to the fsspec filesystem
+    (see csvbase_client.fsspec.parse_path)."""
+    if content_type == ContentType.CSV:
+        return ref
+    return ref + content_type.file_extension()
@@ -1,5 +1,8 @@
 # FIXME: copy tests for this
-from typing import Protocol
+import queue
+import time
+from threading import Thread
+from typing import Callable, Iterator, Optional, Protocol
 
 
 class Seekable(Protocol):
@@ -9,6 +12,30 @@ class Seekable(Protocol):
         pass
 
 
+class Readable(Protocol):
+    """A binary stream that can be read from (and perhaps nothing else)."""
+
+    def read(self, size: int = -1) -> bytes:
+        pass
+
+
+class CountingReader:
+    """Wraps a stream, counting the bytes read from it (and the seconds spent
+    waiting for them)."""
+
+    def __init__(self, stream: Readable) -> None:
+        self.stream = stream
+        self.count = 0
+        self.seconds = 0.0
+
+    def read(self, size: int = -1) -> bytes:
+        start = time.perf_counter()
+        data = self.stream.read(size)
+        self.seconds += time.perf_counter() - start
+        self.count += len(data)
+        return data
+
+
 class rewind:
     """Ensure that a stream is rewound after doing something.
 
@@ -24,3 +51,59 @@ class rewind:
 
     def __exit__(self, exc_type, exc_value, traceback) -> None:
         self.stream.seek(0)
+
+
+class ChunkPipe:
+    """Passes chunks of bytes, as they are written, to a consumer running in a
+    background thread.
+
+    The consumer is called with an iterator of the chunks, which ends when the
+    pipe is closed.  At most `max_pending` chunks are held at once: writers
+    block until the consumer catches up, so memory use is bounded.
+
+    If the consumer raises, the exception is re-raised in the writing thread,
+    by write() or close().
+
+    """
+
+    def __init__(
+        self, consumer: Callable[[Iterator[bytes]], None], max_pending: int = 2
+    ) -> None:
+        self._queue: "queue.Queue[Optional[bytes]]" = queue.Queue(max_pending)
+        self._error: Optional[BaseException] = None
+        self._thread = Thread(target=self._consume, args=(consumer,), daemon=True)
+        self._thread.start()
+
+    def write(self, chunk: bytes) -> None:
+        if len(chunk) > 0:
+            self._put(chunk)
+
+    def close(self) -> None:
+        self._put(None)
+        self._thread.join()
+        self._check()
+
+    def _put(self, item: Optional[bytes]) -> None:
+        # the consumer may stop early (eg: on error), so don't block forever
+        while self._thread.is_alive():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        self._check()
+        raise BrokenPipeError("consumer stopped before the pipe was closed")
+
+    def _check(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _chunks(self) -> Iterator[bytes]:
+        while (chunk := self._queue.get()) is not None:
+            yield chunk
+
+    def _consume(self, consumer: Callable[[Iterator[bytes]], None]) -> None:
+        try:
+            consumer(self._chunks())
+        except BaseException as e:
+            self._error = e
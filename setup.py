@@ -36,6 +36,11 @@ setup(
         "rich",
         "humanize",
     ],
+    extras_require={
+        "arrow": ["pyarrow"],
+        "async": ["aiohttp"],
+        "zstd": ["zstandard"],
+    },
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Intended Audience :: Developers",
@@ -1,7 +1,10 @@
+import json
 from io import BytesIO
+from unittest.mock import patch
 
+from csvbase_client import fsspec as fsspec_module
 from csvbase_client.internals.cli import cli
-from csvbase_client.internals.cache import get_fs_cache, RepKey
+from csvbase_client.internals.cache import get_fs_cache, CacheCompressor, RepKey
 from csvbase_client.constants import CSVBASE_DOT_COM
 from csvbase_client.internals.value_objs import ContentType
 
@@ -26,3 +29,82 @@ def test_cache_clear__removes_entries(runner):
 def test_cache__show_with_no_entries(runner):
     result = runner.invoke(cli, ["cache", "show"])
     assert result.exit_code == 0
+
+
+def test_cache__show_compressed_sizes(runner, fake_csvbase):
+    get_fs_cache().compressor = CacheCompressor("gzip")
+    fake_csvbase.tables["test/compressible"] = b"a,b\n" + b"1,2\n" * 10_000
+    result = runner.invoke(cli, ["table", "get", "test/compressible"])
+    assert result.exit_code == 0, result.stderr_bytes
+
+    result = runner.invoke(cli, ["cache", "show"])
+    assert result.exit_code == 0
+    assert "Size on disk" in result.stdout
+    # logical size, and a far smaller size on disk
+    assert "39.1K" in result.stdout
+
+
+def test_cache__refresh(runner, fake_csvbase):
+    for name in ["unchanged", "changed", "deleted"]:
+        fake_csvbase.tables[f"test/{name}"] = b"a\n1\n"
+        result = runner.invoke(cli, ["table", "get", f"test/{name}"])
+        assert result.exit_code == 0, result.stderr_bytes
+    fake_csvbase.tables["test/changed"] = b"a\n2\n"
+    del fake_csvbase.tables["test/deleted"]
+    fake_csvbase.requests.clear()
+
+    result = runner.invoke(cli, ["cache", "refresh", "--jobs", "2"])
+    assert result.exit_code == 1
+    assert "updated: test/changed" in result.stderr
+    assert "Table not found: test/deleted" in result.stderr
+    assert "1 updated, 1 skipped (unchanged), 1 failed" in result.stderr
+    # all were conditional requests
+    assert all("If-None-Match" in r.headers for r in fake_csvbase.requests)
+
+    # the changed table was downloaded into the cache
+    result = runner.invoke(cli, ["table", "get", "test/changed", "--offline"])
+    assert result.stdout_bytes == b"a\n2\n"
+
+
+def test_cache__refresh_with_short_body(runner, fake_csvbase):
+    fake_csvbase.tables["test/short"] = b"a\n1\n"
+    result = runner.invoke(cli, ["table", "get", "test/short"])
+    assert result.exit_code == 0, result.stderr_bytes
+    fake_csvbase.tables["test/short"] = b"a\n" + b"2\n" * 100
+    fake_csvbase.short_bodies = True
+
+    result = runner.invoke(cli, ["cache", "refresh"])
+    assert result.exit_code == 1
+    assert "test/short: Connection lost while getting" in result.stderr
+    assert "0 updated, 0 skipped (unchanged), 1 failed" in result.stderr
+
+    # the last good copy is still cached
+    result = runner.invoke(cli, ["table", "get", "test/short", "--offline"])
+    assert result.stdout_bytes == b"a\n1\n"
+
+
+def test_cache__refresh_with_full_disk(runner, fake_csvbase):
+    fake_csvbase.tables["test/full"] = b"a\n1\n"
+    result = runner.invoke(cli, ["table", "get", "test/full"])
+    assert result.exit_code == 0, result.stderr_bytes
+    fake_csvbase.tables["test/full"] = b"a\n2\n"
+
+    error = OSError(28, "No space left on device")
+    with patch.object(fsspec_module, "store_blob", side_effect=error):
+        result = runner.invoke(cli, ["cache", "refresh"])
+    assert result.exit_code == 1
+    assert "test/full: [Errno 28] No space left on device" in result.stderr
+    assert "1 failed" in result.stderr
+
+
+def test_cache__show_json(runner, fake_csvbase):
+    for ref in ["test/a", "test/b", "other/c"]:
+        fake_csvbase.tables[ref] = b"a\n1\n"
+        result = runner.invoke(cli, ["table", "get", ref])
+        assert result.exit_code == 0, result.stderr_bytes
+
+    result = runner.invoke(cli, ["cache", "show", "--json", "--filter", "test/*"])
+    assert result.exit_code == 0
+    entries = [json.loads(line) for line in result.stdout.splitlines()]
+    assert [entry["path"] for entry in entries] == ["test/a", "test/b"]
+    assert entries[0]["logical_size_bytes"] == 4
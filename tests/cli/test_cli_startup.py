@@ -0,0 +1,30 @@
+import subprocess
+import sys
+
+from csvbase_client.internals.cache import CACHE_ENTRY_ORDERINGS
+from csvbase_client.internals.cli import CACHE_SORTS, cli
+from csvbase_client.internals.version import get_version
+
+
+def test_version(runner):
+    result = runner.invoke(cli, ["--version"])
+    assert result.exit_code == 0
+    assert result.stdout == f"csvbase-client, version {get_version()}\n"
+
+
+def test_cache_sorts_match_cache():
+    assert set(CACHE_SORTS) == set(CACHE_ENTRY_ORDERINGS)
+
+
+def test_cli_import_is_light():
+    """Importing the cli (which happens on every run) should not import what
+    only some commands need."""
+    heavy = ["fsspec", "pyappcache", "requests", "rich", "humanize"]
+    code = (
+        "import sys; import csvbase_client.internals.cli;"
+        f" print(','.join(m for m in {heavy!r} if m in sys.modules))"
+    )
+    completed = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    )
+    assert completed.stdout.strip() == ""
@@ -1,10 +1,13 @@
 """Test getting and setting tables"""
 
 from io import BytesIO
+from unittest.mock import patch
 
 import pandas as pd
 from pandas.testing import assert_frame_equal
+import requests
 
+from csvbase_client.fsspec import CSVBaseFileSystem
 from csvbase_client.internals.cli import cli
 import pytest
 
@@ -66,3 +69,154 @@ def test_show__happy(runner, test_user, test_table):
     with mock_auth(test_user.username, test_user.hex_api_key()):
         result = runner.invoke(cli, ["table", "show", test_table])
     assert result.exit_code == 0, result.stderr_bytes
+
+
+def test_get__many_to_output_dir(runner, fake_csvbase, tmpdir):
+    refs = [f"test/many-{n}" for n in range(3)]
+    for ref in refs:
+        fake_csvbase.tables[ref] = f"a\n{ref}\n".encode("utf-8")
+    refs_file = tmpdir / "refs.txt"
+    refs_file.write_text("\n".join(refs[1:]) + "\n", encoding="utf-8")
+    output_dir = tmpdir / "output"
+
+    args = ["table", "get", refs[0], "--refs-file", str(refs_file)]
+    args += ["--output-dir", str(output_dir), "--jobs", "2"]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.stderr_bytes
+    assert "0 cache hits, 3 cache misses" in result.stderr
+
+    for ref in refs:
+        assert (output_dir / f"{ref}.csv").read_binary() == fake_csvbase.tables[ref]
+
+    # again, this time from the cache
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.stderr_bytes
+    assert "3 cache hits, 0 cache misses" in result.stderr
+
+
+def test_get__many_with_missing_table(runner, fake_csvbase, tmpdir):
+    fake_csvbase.tables["test/present"] = b"a\n1\n"
+    args = ["table", "get", "test/present", "test/absent"]
+    args += ["--output-dir", str(tmpdir)]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    assert "Table not found: test/absent" in result.stderr
+    assert "1 failed" in result.stderr
+
+
+def test_get__many_with_duplicate_refs(runner, fake_csvbase, tmpdir):
+    fake_csvbase.tables["test/twice"] = b"a\n1\n"
+    args = ["table", "get", "test/twice", "test/twice", "test/twice.csv"]
+    args += ["--output-dir", str(tmpdir)]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.stderr_bytes
+    assert "got 1 of 1 tables" in result.stderr
+    assert len(fake_csvbase.requests_by_method("GET")) == 1
+
+
+def test_get__many_outside_output_dir(runner, fake_csvbase, tmpdir):
+    fake_csvbase.tables["test/inside"] = b"a\n1\n"
+    output_dir = tmpdir / "output"
+    args = ["table", "get", "test/inside", "../../escaped"]
+    args += ["--output-dir", str(output_dir)]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    assert "1 failed" in result.stderr
+    assert (output_dir / "test" / "inside.csv").exists()
+    assert not (tmpdir / "escaped.csv").exists()
+
+
+def test_get__many_with_connection_error(runner, fake_csvbase, tmpdir):
+    fake_csvbase.tables["test/reachable"] = b"a\n1\n"
+    args = ["table", "get", "test/reachable", "test/unreachable"]
+    args += ["--output-dir", str(tmpdir)]
+    real_fetch_rep = CSVBaseFileSystem._fetch_rep
+
+    def fetch_rep(self, ref, *args, **kwargs):
+        if ref == "test/unreachable":
+            raise requests.ConnectionError("connection refused")
+        return real_fetch_rep(self, ref, *args, **kwargs)
+
+    with patch.object(CSVBaseFileSystem, "_fetch_rep", fetch_rep):
+        result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    assert "test/unreachable: connection refused" in result.stderr
+    assert "got 1 of 2 tables" in result.stderr
+    assert (tmpdir / "test" / "reachable.csv").read_binary() == b"a\n1\n"
+
+
+def test_get__many_with_short_body(runner, fake_csvbase, tmpdir):
+    fake_csvbase.tables["test/short"] = b"a\n" + b"1\n" * 100
+    fake_csvbase.short_bodies = True
+    args = ["table", "get", "test/short", "--output-dir", str(tmpdir)]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    assert "test/short: Connection lost while getting" in result.stderr
+    assert "got 0 of 1 tables" in result.stderr
+    assert not (tmpdir / "test" / "short.csv").exists()
+
+
+def test_get__force_cache_miss(runner, fake_csvbase):
+    fake_csvbase.tables["test/forced"] = b"a\n1\n"
+    for _ in range(2):
+        result = runner.invoke(
+            cli, ["table", "get", "test/forced", "--force-cache-miss"]
+        )
+        assert result.exit_code == 0, result.stderr_bytes
+        assert result.stdout_bytes == b"a\n1\n"
+
+    second_get = fake_csvbase.requests_by_method("GET")[1]
+    assert "If-None-Match" not in second_get.headers
+
+
+def test_get__offline(runner, fake_csvbase, tmpdir):
+    fake_csvbase.tables["test/cached"] = b"a\n1\n"
+    result = runner.invoke(cli, ["table", "get", "test/cached"])
+    assert result.exit_code == 0, result.stderr_bytes
+
+    args = ["table", "get", "test/cached", "test/uncached", "--offline"]
+    args += ["--output-dir", str(tmpdir)]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    assert "1 cache hits, 0 cache misses, 1 failed" in result.stderr
+    assert (tmpdir / "test" / "cached.csv").read_binary() == b"a\n1\n"
+    assert len(fake_csvbase.requests) == 1
+
+
+def test_get__stats(runner, fake_csvbase, tmpdir):
+    fake_csvbase.tables["test/a"] = b"a\n1\n"
+    args = ["--stats", "table", "get", "test/a", "test/absent"]
+    args += ["--output-dir", str(tmpdir)]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    assert result.stdout == ""
+
+    rows = {
+        cells[0]: cells[1:6]
+        for cells in (
+            [cell.strip() for cell in line.strip("│").split("│")]
+            for line in result.stderr.splitlines()
+            if line.startswith("│")
+        )
+    }
+    # fresh, 304, miss, failed, transferred
+    assert rows["test/a"] == ["0", "0", "1", "0", "4B"]
+    assert rows["test/absent"] == ["0", "0", "0", "1", "0B"]
+    assert rows["total"] == ["0", "0", "1", "1", "4B"]
+
+
+def test_get__offline_and_force_cache_miss(runner):
+    args = ["table", "get", "test/a", "--offline", "--force-cache-miss"]
+    assert runner.invoke(cli, args).exit_code == 2
+
+
+def test_get__many_requires_output_dir(runner):
+    result = runner.invoke(cli, ["table", "get", "test/a", "test/b"])
+    assert result.exit_code == 2
+
+
+def test_set__from_stdin(runner, fake_csvbase):
+    table = b"a,b\n1,2\n"
+    result = runner.invoke(cli, ["table", "set", "test/stdin", "-"], input=table)
+    assert result.exit_code == 0, result.stderr_bytes
+    assert fake_csvbase.tables["test/stdin"] == table
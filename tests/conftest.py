@@ -11,10 +11,12 @@ from sqlalchemy.orm import Session
 import pytest
 
 from csvbase_client.internals import http, cache, auth
+from csvbase_client.fsspec import CSVBaseFileSystem
 
 from .utils import random_string
 from .value_objs import ExtendedUser
 from .requests_adapter import FlaskAdapter
+from .fake_csvbase import FakeCSVBase, FakeCSVBaseAdapter, FakeCSVBaseServer
 
 
 @pytest.fixture(scope="session")
@@ -83,6 +85,28 @@ def http_sesh(flask_adapter):
         yield sesh
 
 
+@pytest.fixture(autouse=True)
+def clear_filesystem_instances():
+    """fsspec reuses filesystem instances, which would otherwise carry their
+    http sessions from one test to the next."""
+    CSVBaseFileSystem.clear_instance_cache()
+
+
+@pytest.fixture()
+def fake_csvbase(http_sesh):
+    """Replace the csvbase app with a minimal in-memory stand-in."""
+    fake = FakeCSVBase()
+    http_sesh.mount("https://csvbase.com", FakeCSVBaseAdapter(fake))
+    return fake
+
+
+@pytest.fixture()
+def fake_csvbase_server(fake_csvbase):
+    """Serve the stand-in over real HTTP, on localhost."""
+    with FakeCSVBaseServer(fake_csvbase) as server:
+        yield server
+
+
 @pytest.fixture(autouse=True)
 def mock_cache(tmpdir):
     with patch.object(cache, "cache_path") as mocked_cache_path:
@@ -0,0 +1,299 @@
+"""A minimal, in-memory stand-in for a csvbase server.
+
+The FlaskAdapter runs the real csvbase app, which is what most tests should
+use.  This is for testing HTTP behaviour that the real app does not (yet)
+have, for example HEAD and Range requests.
+
+It can be used either via a requests adapter (FakeCSVBaseAdapter) or over
+real HTTP on localhost (FakeCSVBaseServer).  The benchmarks use the latter,
+with latency and bandwidth limits to make it more like the real thing.
+
+"""
+
+import gzip
+import hashlib
+import time
+from dataclasses import dataclass
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from threading import Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.response import HTTPResponse
+
+
+@dataclass
+class FakeRequest:
+    method: str
+    path: str
+    headers: CaseInsensitiveDict
+    body: bytes
+
+
+class FakeCSVBase:
+    """Serves tables (held as bytes) with ETags, conditional and range
+    requests."""
+
+    def __init__(self) -> None:
+        self.tables: Dict[str, bytes] = {}
+        self.requests: List[FakeRequest] = []
+        # called (from the requesting thread) before each request is served
+        self.on_request: Optional[Callable[[FakeRequest], None]] = None
+        # whether to gzip (whole) responses, when the client accepts that
+        self.gzip_responses = False
+        # content codings accepted for request bodies, as advertised in the
+        # Accept-Encoding response header
+        self.request_encodings: List[str] = []
+        # sent as the Cache-Control header of responses about a table
+        self.cache_control: Optional[str] = None
+        # seconds to wait before responding, eg: to be like a distant server
+        self.latency = 0.0
+        # bytes per second that response bodies are sent at (None for as fast
+        # as possible).  Only applies over real HTTP
+        self.bandwidth: Optional[int] = None
+        # whether If-None-Match is honoured: if not, tables are always sent
+        self.conditional_requests = True
+        # whether Range is honoured (and Accept-Ranges sent): if not, whole
+        # tables are always sent
+        self.range_requests = True
+        # whether to keep self.requests (benchmarks don't, to save memory)
+        self.record_requests = True
+        # whether to send only half of each table, as a dropped connection
+        # would (the Content-Length is of the whole table)
+        self.short_bodies = False
+        # total bytes of response bodies
+        self.bytes_sent = 0
+        # ref -> (table, etag), so big tables aren't hashed for every request
+        self._etags: Dict[str, Tuple[bytes, str]] = {}
+
+    def handle(self, request: FakeRequest) -> Tuple[int, Dict[str, str], bytes]:
+        """Return the status code, headers and body for a request."""
+        if self.record_requests:
+            self.requests.append(request)
+        if self.on_request is not None:
+            self.on_request(request)
+        if self.latency > 0:
+            time.sleep(self.latency)
+        ref = request.path.split("?")[0].lstrip("/")
+        headers: Dict[str, str] = {}
+        body = b""
+        if self.request_encodings:
+            headers["Accept-Encoding"] = ", ".join(self.request_encodings)
+        if request.method == "PUT":
+            if request.headers.get("Content-Encoding") == "gzip":
+                self.tables[ref] = gzip.decompress(request.body)
+            else:
+                self.tables[ref] = request.body
+            status_code = 201
+        elif ref not in self.tables:
+            status_code = 404
+        else:
+            table = self.tables[ref]
+            etag = self._etag(ref, table)
+            headers["ETag"] = etag
+            if self.range_requests:
+                headers["Accept-Ranges"] = "bytes"
+            if self.cache_control is not None:
+                headers["Cache-Control"] = self.cache_control
+            range_header = request.headers.get("Range")
+            if (
+                self.conditional_requests
+                and request.headers.get("If-None-Match") == etag
+            ):
+                status_code = 304
+            elif range_header is not None and self.range_requests:
+                start_str, end_str = range_header[len("bytes=") :].split("-")
+                start, end = int(start_str), min(int(end_str), len(table) - 1)
+                body = table[start : end + 1]
+                headers["Content-Range"] = f"bytes {start}-{end}/{len(table)}"
+                status_code = 206
+            else:
+                body = table
+                status_code = 200
+                if self.gzip_responses and "gzip" in request.headers.get(
+                    "Accept-Encoding", ""
+                ):
+                    body = gzip.compress(body)
+                    headers["Content-Encoding"] = "gzip"
+            if request.method == "HEAD":
+                headers["Content-Length"] = str(len(body))
+                body = b""
+        if status_code != 304:
+            headers.setdefault("Content-Length", str(len(body)))
+        if self.short_bodies and status_code == 200:
+            body = body[: len(body) // 2]
+        self.bytes_sent += len(body)
+        return status_code, headers, body
+
+    def requests_by_method(self, method: str) -> List[FakeRequest]:
+        return [r for r in self.requests if r.method == method]
+
+    def _etag(self, ref: str, table: bytes) -> str:
+        known = self._etags.get(ref)
+        if known is None or known[0] is not table:
+            known = (table, etag_for(table))
+            self._etags[ref] = known
+        return known[1]
+
+
+class FakeCSVBaseAdapter(BaseAdapter):
+    """Adapts requests requests into requests against a FakeCSVBase."""
+
+    def __init__(self, fake_csvbase: FakeCSVBase) -> None:
+        super().__init__()
+        self.fake_csvbase = fake_csvbase
+
+    def send(
+        self,
+        request: requests.PreparedRequest,
+        stream: bool = False,
+        timeout=None,
+        verify=True,
+        cert=None,
+        proxies=None,
+    ) -> requests.Response:
+        status_code, headers, body = self.fake_csvbase.handle(
+            FakeRequest(
+                method=request.method or "GET",
+                path=request.path_url,
+                headers=CaseInsensitiveDict(request.headers),
+                body=_read_body(request),
+            )
+        )
+        response = requests.Response()
+        response.request = request
+        response.url = request.url or ""
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict(headers)
+        # a urllib3 response, as requests' own adapter gives, so that a body
+        # shorter than its Content-Length is an error
+        response.raw = HTTPResponse(
+            body=BytesIO(body),
+            headers=headers,
+            status=status_code,
+            preload_content=False,
+            request_method=request.method,
+        )
+        response.reason = HTTPStatus(status_code).phrase
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+class FakeCSVBaseServer:
+    """Serves a FakeCSVBase over HTTP on localhost, from a background thread.
+
+    Use as a context manager.
+
+    """
+
+    def __init__(self, fake_csvbase: FakeCSVBase) -> None:
+        self.fake_csvbase = fake_csvbase
+        self._httpd = _HTTPServer(("127.0.0.1", 0), _make_handler(fake_csvbase))
+        self._httpd.daemon_threads = True
+        self._thread = Thread(
+            target=self._httpd.serve_forever, args=(0.05,), daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        # always bound to 127.0.0.1, only the port varies
+        port = self._httpd.server_address[1]
+        return f"http://127.0.0.1:{port}/"
+
+    def __enter__(self) -> "FakeCSVBaseServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    # many clients may connect at once (eg: in the concurrency benchmark), and
+    # the default backlog of 5 would make some wait for a SYN retry
+    request_queue_size = 128
+
+
+def _make_handler(fake_csvbase: FakeCSVBase):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # otherwise small responses can wait on a delayed ACK for the headers
+        disable_nagle_algorithm = True
+
+        def _handle(self) -> None:
+            status_code, headers, body = fake_csvbase.handle(
+                FakeRequest(
+                    method=self.command,
+                    path=self.path,
+                    headers=CaseInsensitiveDict(dict(self.headers)),
+                    body=self._read_request_body(),
+                )
+            )
+            self.send_response(status_code)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self._write_body(body)
+            content_length = int(headers.get("Content-Length", 0))
+            if self.command != "HEAD" and len(body) < content_length:
+                self.close_connection = True
+
+        do_GET = do_HEAD = do_PUT = _handle
+
+        def _write_body(self, body: bytes) -> None:
+            bandwidth = fake_csvbase.bandwidth
+            if bandwidth is None:
+                self.wfile.write(body)
+                return
+            # in slices of about 10ms each, sleeping to keep to the bandwidth
+            slice_size = max(bandwidth // 100, 1)
+            view = memoryview(body)
+            start = time.perf_counter()
+            for offset in range(0, len(view), slice_size):
+                self.wfile.write(view[offset : offset + slice_size])
+                sent = min(offset + slice_size, len(view))
+                delay = start + sent / bandwidth - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+        def _read_request_body(self) -> bytes:
+            if self.headers.get("Transfer-Encoding") != "chunked":
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()  # the CRLF after each chunk
+                if size == 0:
+                    return b"".join(chunks)
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+    return Handler
+
+
+def etag_for(table: bytes) -> str:
+    return 'W/"' + hashlib.sha256(table).hexdigest() + '"'
+
+
+def _read_body(request: requests.PreparedRequest) -> bytes:
+    body = request.body
+    if body is None:
+        return b""
+    elif isinstance(body, bytes):
+        return body
+    elif isinstance(body, str):
+        return body.encode("utf-8")
+    elif hasattr(body, "read"):
+        return body.read()
+    else:
+        return b"".join(body)
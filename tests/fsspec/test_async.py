@@ -0,0 +1,179 @@
+"""Tests for the asyncio version of the filesystem, against the stand-in
+csvbase (over real HTTP)."""
+
+import contextlib
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from csvbase_client import async_fsspec
+from csvbase_client.async_fsspec import AsyncCSVBaseFileSystem
+from csvbase_client.exceptions import CSVBaseException
+from csvbase_client.instrumentation import Stats, add_hook, remove_hook
+from csvbase_client.internals import cache
+from csvbase_client.internals.cache import get_fs_cache, RepKey
+from csvbase_client.internals.value_objs import CacheOutcome, ContentType
+
+
+@pytest.fixture()
+def async_fs(fake_csvbase_server):
+    fs = AsyncCSVBaseFileSystem(skip_instance_cache=True)
+    fs._base_url = fake_csvbase_server.url
+    return fs
+
+
+def test_async__cat_many_concurrently(fake_csvbase, async_fs):
+    # pick refs that don't share a lock stripe
+    refs_by_lock = {}
+    for n in range(100):
+        ref = f"test/async-{n}"
+        key = RepKey(async_fs._base_url, ref, ContentType.CSV)
+        refs_by_lock.setdefault(get_fs_cache().lock(key).stripe, ref)
+    refs = list(refs_by_lock.values())[:4]
+    for ref in refs:
+        fake_csvbase.tables[ref] = f"a\n{ref}\n".encode("utf-8")
+    # each request waits until all of them have been made, so if they were
+    # made one at a time this would time out
+    barrier = threading.Barrier(len(refs), timeout=5)
+    fake_csvbase.on_request = lambda request: barrier.wait()
+
+    assert async_fs.cat(refs) == {ref: fake_csvbase.tables[ref] for ref in refs}
+
+
+def test_async__cache_hit(fake_csvbase, async_fs):
+    table = b"a,b\n1,2\n3,4\n"
+    fake_csvbase.tables["test/cached"] = table
+
+    assert async_fs.cat_file("test/cached") == table
+    assert async_fs.cat_file("test/cached", start=4, end=8) == b"1,2\n"
+
+    first_req, second_req = fake_csvbase.requests_by_method("GET")
+    assert "If-None-Match" not in first_req.headers
+    assert second_req.headers["If-None-Match"] == async_fs.info("test/cached")["etag"]
+
+
+def test_async__instrumented(fake_csvbase, async_fs):
+    table = b"a,b\n1,2\n"
+    fake_csvbase.tables["test/instrumented"] = table
+    stats = Stats()
+    add_hook(stats)
+    try:
+        for _ in range(2):
+            async_fs.cat_file("test/instrumented")
+    finally:
+        remove_hook(stats)
+
+    summary = stats.by_path()["test/instrumented"]
+    assert summary.operations == 2
+    assert summary.bytes == len(table)
+    assert summary.outcomes[CacheOutcome.MISS] == 1
+    assert summary.outcomes[CacheOutcome.REVALIDATED] == 1
+
+
+def test_async__pipe_and_info(fake_csvbase, async_fs):
+    async_fs.pipe_file("test/piped", b"a\n1\n")
+
+    assert fake_csvbase.tables["test/piped"] == b"a\n1\n"
+    assert async_fs.info("test/piped")["size"] == 4
+
+
+def test_async__pipe_compressed_and_instrumented(fake_csvbase, async_fs):
+    fake_csvbase.request_encodings = ["gzip"]
+    table = b"a,b\n" + b"3,4\n" * 1000
+    stats = Stats()
+    add_hook(stats)
+    try:
+        # nothing is compressed until the server has said that it accepts that
+        for _ in range(2):
+            async_fs.pipe_file("test/compressed", table)
+    finally:
+        remove_hook(stats)
+
+    first_put, second_put = fake_csvbase.requests_by_method("PUT")
+    assert "Content-Encoding" not in first_put.headers
+    assert second_put.headers["Content-Encoding"] == "gzip"
+    assert len(second_put.body) < len(table)
+    assert fake_csvbase.tables["test/compressed"] == table
+    summary = stats.by_path()["test/compressed"]
+    assert summary.operations == 2
+    assert summary.bytes == 2 * len(table)
+
+
+def test_async__session_closed_on_loop_thread(fake_csvbase, async_fs):
+    fake_csvbase.tables["test/closed"] = b"a\n1\n"
+    async_fs.cat_file("test/closed")
+    session = async_fs._session
+
+    # as when the filesystem is garbage collected on the loop's own thread,
+    # where it can't wait for the loop
+    closed = threading.Event()
+
+    def close_on_loop():
+        async_fsspec.close_session(async_fs.loop, session)
+        closed.set()
+
+    async_fs.loop.call_soon_threadsafe(close_on_loop)
+    assert closed.wait(timeout=5)
+    assert session.closed
+
+
+def test_async__does_not_exist(fake_csvbase, async_fs):
+    with pytest.raises(CSVBaseException):
+        async_fs.cat_file("test/does-not-exist")
+
+
+def test_async__cache_used_off_the_event_loop(fake_csvbase, async_fs, tmpdir):
+    fake_csvbase.tables["test/off-loop"] = b"a,b\n1,2\n"
+    used_from = set()
+
+    def recording(func):
+        def wrapper(*args, **kwargs):
+            used_from.add(threading.current_thread())
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    cache_functions = [
+        "get_fresh_rep",
+        "get_last_etag",
+        "get_last_rep",
+        "get_last_metadata",
+        "mark_validated",
+        "publish_blob",
+        "copy_to_path",
+    ]
+    with contextlib.ExitStack() as stack:
+        for name in cache_functions:
+            stack.enter_context(
+                patch.object(async_fsspec, name, recording(getattr(async_fsspec, name)))
+            )
+        async_fs.cat_file("test/off-loop")
+        async_fs.get_file("test/off-loop", str(tmpdir / "off-loop.csv"))
+        async_fs.info("test/off-loop")
+
+    loop_thread = async_fs.loop._thread_id
+    assert len(used_from) > 0
+    assert all(thread.ident != loop_thread for thread in used_from)
+
+
+def test_async__cat_many_sharing_a_lock(fake_csvbase, async_fs):
+    """More refs sharing a lock than there are executor threads shouldn't
+    deadlock: those waiting for the lock mustn't take up the threads that the
+    holder needs."""
+    refs = [f"test/shared-lock-{n}" for n in range(40)]
+    for ref in refs:
+        fake_csvbase.tables[ref] = f"a\n{ref}\n".encode("utf-8")
+    results = {}
+
+    with patch.object(cache, "KEY_LOCK_STRIPES", 1):
+        catting = threading.Thread(
+            target=lambda: results.update(async_fs.cat(refs)), daemon=True
+        )
+        catting.start()
+        catting.join(timeout=30)
+
+    assert not catting.is_alive(), "deadlocked"
+    assert results == {ref: fake_csvbase.tables[ref] for ref in refs}
+    # coroutines are serialised per stripe, not per ref
+    assert len(async_fs._stripe_locks) == 1
@@ -4,13 +4,22 @@ import fsspec
 import pandas as pd
 import pytest
 import io
+import itertools
 from typing import IO
 import os
+import threading
+from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
 from pandas.testing import assert_frame_equal
 
 from csvbase_client.exceptions import CSVBaseException
+from csvbase_client import fsspec as fsspec_module
+from csvbase_client.fsspec import CachePolicy, ContentType, map_rep, parse_path
+from csvbase_client.internals.cache import get_fs_cache, RepKey
+from csvbase_client.internals.value_objs import path_for_rep
 
 from csvbase_client.io import rewind
+from ..fake_csvbase import etag_for
 from ..utils import random_string, mock_auth, random_dataframe
 
 
@@ -126,3 +135,369 @@ def _get_fh_size(fh: IO[bytes]) -> int:
     size = fh.tell()
     fh.seek(pos)
     return size
+
+
+@pytest.mark.parametrize("body", [b"", b"a,b\n1,2\n"])
+def test_map_rep(tmpdir, body):
+    rep_path = tmpdir / "rep.csv"
+    rep_path.write_binary(body)
+
+    with open(rep_path, "rb") as rep:
+        assert map_rep(rep)[:] == body
+
+    # and when not backed by a real file
+    assert map_rep(io.BytesIO(body))[:] == body
+
+
+def test_fsspec__lazy_read(fake_csvbase):
+    fake_csvbase.tables["test/big"] = b"a,b\n" + b"1,2\n" * 10_000
+    fs = fsspec.filesystem("csvbase")
+
+    with fs.open("test/big", lazy=True, block_size=1024) as table_f:
+        assert table_f.size == len(fake_csvbase.tables["test/big"])
+        assert table_f.readline() == b"a,b\n"
+
+    # only the first block was fetched
+    (get_req,) = fake_csvbase.requests_by_method("GET")
+    assert get_req.headers["Range"] == "bytes=0-1023"
+
+
+@pytest.mark.parametrize("advertised", [False, True])
+def test_fsspec__lazy_read_without_ranges(fake_csvbase, advertised):
+    """If the server doesn't do range requests, a lazy read gets the table
+    once, rather than all of it for every block."""
+    table = b"a,b\n" + b"1,2\n" * 10_000
+    fake_csvbase.tables["test/no-ranges"] = table
+    fake_csvbase.range_requests = False
+    fs = fsspec.filesystem("csvbase")
+    if advertised:
+        # the server says it does, but then doesn't
+        with patch.object(fsspec_module, "accepts_ranges", return_value=True):
+            table_f = fs.open("test/no-ranges", lazy=True, block_size=1024)
+    else:
+        table_f = fs.open("test/no-ranges", lazy=True, block_size=1024)
+    with table_f:
+        assert table_f.read() == table
+
+    # the ignored range request is the one wasted GET
+    assert len(fake_csvbase.requests_by_method("GET")) == (2 if advertised else 1)
+    assert fake_csvbase.bytes_sent <= len(table) * (2 if advertised else 1)
+
+
+def test_fsspec__lazy_read_when_cached(fake_csvbase):
+    table = b"a,b\n" + b"1,2\n" * 10
+    fake_csvbase.tables["test/small"] = table
+    fs = fsspec.filesystem("csvbase")
+
+    with fs.open("test/small") as table_f:
+        table_f.read()
+
+    with fs.open("test/small", lazy=True) as table_f:
+        assert table_f.read() == table
+
+    # the cached copy was used, no further GETs
+    assert len(fake_csvbase.requests_by_method("GET")) == 1
+
+
+def test_fsspec__lazy_read_table_changed(fake_csvbase):
+    fake_csvbase.tables["test/changing"] = b"a,b\n1,2\n"
+    fs = fsspec.filesystem("csvbase")
+
+    with fs.open("test/changing", lazy=True) as table_f:
+        fake_csvbase.tables["test/changing"] = b"a,b\n3,4\n"
+        with pytest.raises(CSVBaseException):
+            table_f.read()
+
+
+def test_fsspec__info(fake_csvbase):
+    table = b"a,b\n1,2\n"
+    fake_csvbase.tables["test/info"] = table
+    fs = fsspec.filesystem("csvbase")
+
+    assert fs.info("test/info")["size"] == len(table)
+    assert fake_csvbase.requests_by_method("GET") == []
+
+    # once the table has been read, the size is taken from the cache
+    with fs.open("test/info") as table_f:
+        table_f.read()
+    info = fs.info("test/info")
+    assert info["size"] == len(table)
+    assert info["etag"] == fake_csvbase.requests[-1].headers["If-None-Match"]
+
+
+def test_fsspec__different_tables_read_concurrently(fake_csvbase):
+    """Reads of different tables should not wait on each other."""
+    fs = fsspec.filesystem("csvbase")
+    # pick refs that don't share a lock stripe
+    refs_by_lock = {}
+    for n in range(100):
+        ref = f"test/concurrent-{n}"
+        refs_by_lock.setdefault(fs._lock_ref(ref, ContentType.CSV).stripe, ref)
+    refs = list(refs_by_lock.values())[:4]
+    for ref in refs:
+        fake_csvbase.tables[ref] = f"a\n{ref}\n".encode("utf-8")
+    # each request waits until all of them have been made, so if they were
+    # serialised this would time out
+    barrier = threading.Barrier(len(refs), timeout=5)
+    fake_csvbase.on_request = lambda request: barrier.wait()
+
+    def read(ref: str) -> bytes:
+        with fs.open(ref) as table_f:
+            return table_f.read()
+
+    with ThreadPoolExecutor(len(refs)) as executor:
+        tables = list(executor.map(read, refs))
+
+    assert tables == [fake_csvbase.tables[ref] for ref in refs]
+
+
+def test_fsspec__streaming_upload(fake_csvbase_server):
+    """Multi-block uploads should be sent as a single streamed request, not
+    buffered up first."""
+    fs = fsspec.filesystem("csvbase")
+    fs._base_url = fake_csvbase_server.url
+    table = b"a,b\n" + b"1,2\n" * 10_000
+
+    with fs.open("test/streamed", "wb", block_size=1024) as table_f:
+        for start in range(0, len(table), 1024):
+            table_f.write(table[start : start + 1024])
+        assert table_f._chunk_count > 1, "not a multi-chunk upload"
+
+    fake_csvbase = fake_csvbase_server.fake_csvbase
+    (put_req,) = fake_csvbase.requests_by_method("PUT")
+    assert put_req.headers["Transfer-Encoding"] == "chunked"
+    assert fake_csvbase.tables["test/streamed"] == table
+
+
+def test_fsspec__read_while_uploading(fake_csvbase_server):
+    """Reading a table while writing another should work, even when both
+    share a lock stripe."""
+    fake_csvbase = fake_csvbase_server.fake_csvbase
+    fs = fsspec.filesystem("csvbase")
+    fs._base_url = fake_csvbase_server.url
+
+    def stripe(ref: str) -> int:
+        return get_fs_cache().lock(RepKey(fs._base_url, ref, ContentType.CSV)).stripe
+
+    other_ref = next(
+        f"test/other-{n}"
+        for n in itertools.count()
+        if stripe(f"test/other-{n}") == stripe("test/uploading")
+    )
+    fake_csvbase.tables[other_ref] = b"a\n1\n"
+
+    with ThreadPoolExecutor(1) as executor:
+        with fs.open("test/uploading", "wb", block_size=1024) as table_f:
+            table_f.write(b"a\n" + b"2\n" * 1024)
+            assert table_f._chunk_count > 0, "upload not started"
+            read = executor.submit(fs.cat, other_ref)
+            assert read.result(timeout=10) == b"a\n1\n"
+
+    assert fake_csvbase.tables["test/uploading"] == b"a\n" + b"2\n" * 1024
+
+
+def test_fsspec__compressed_download(fake_csvbase_server):
+    fake_csvbase = fake_csvbase_server.fake_csvbase
+    fake_csvbase.gzip_responses = True
+    table = b"a,b\n" + b"1,2\n" * 1000
+    fake_csvbase.tables["test/gzipped"] = table
+    fs = fsspec.filesystem("csvbase")
+    fs._base_url = fake_csvbase_server.url
+
+    with fs.open("test/gzipped") as table_f:
+        assert table_f.read() == table
+
+    # and the cache holds the decoded table
+    with fs._get_cached_rep(
+        "test/gzipped", ContentType.CSV, etag_for(table)
+    ) as cached_rep:
+        assert cached_rep.read() == table
+
+
+def test_fsspec__compressed_upload(fake_csvbase_server):
+    fake_csvbase = fake_csvbase_server.fake_csvbase
+    fake_csvbase.request_encodings = ["gzip"]
+    fake_csvbase.tables["test/compressed"] = b"a,b\n1,2\n"
+    fs = fsspec.filesystem("csvbase")
+    fs._base_url = fake_csvbase_server.url
+    table = b"a,b\n" + b"3,4\n" * 1000
+
+    # nothing is compressed until the server has said that it accepts that
+    fs.pipe("test/compressed", table)
+    fs.pipe("test/compressed", table)
+
+    first_put, second_put = fake_csvbase.requests_by_method("PUT")
+    assert "Content-Encoding" not in first_put.headers
+    assert second_put.headers["Content-Encoding"] == "gzip"
+    assert len(second_put.body) < len(table)
+    assert fake_csvbase.tables["test/compressed"] == table
+
+
+@pytest.mark.parametrize(
+    "path, content_type, expected",
+    [
+        ("user/table", None, ("user/table", ContentType.CSV)),
+        ("user/table.csv", None, ("user/table", ContentType.CSV)),
+        ("user/table.parquet", None, ("user/table", ContentType.PARQUET)),
+        ("user/table", ContentType.PARQUET, ("user/table", ContentType.PARQUET)),
+    ],
+)
+def test_parse_path(path, content_type, expected):
+    assert parse_path(path, content_type) == expected
+
+
+def test_parse_path__conflicting_content_type():
+    with pytest.raises(CSVBaseException):
+        parse_path("user/table.csv", ContentType.PARQUET)
+
+
+@pytest.mark.parametrize("content_type", [ContentType.CSV, ContentType.PARQUET])
+def test_parse_path__of_path_for_rep(content_type):
+    path = path_for_rep("user/table", content_type)
+    assert parse_path(path) == ("user/table", content_type)
+
+
+def test_fsspec__parquet(fake_csvbase):
+    df = random_dataframe()
+    parquet_buf = io.BytesIO()
+    df.to_parquet(parquet_buf, index=False)
+    fake_csvbase.tables["test/columnar.parquet"] = parquet_buf.getvalue()
+
+    assert_frame_equal(df, pd.read_parquet("csvbase://test/columnar.parquet"))
+    # again, from the cache
+    assert_frame_equal(df, pd.read_parquet("csvbase://test/columnar.parquet"))
+
+    # pyarrow opens the file more than once, but it is downloaded only once
+    first_get, *later_gets = fake_csvbase.requests_by_method("GET")
+    assert first_get.headers["Accept"] == "application/parquet"
+    assert len(later_gets) > 0
+    assert all("If-None-Match" in get_req.headers for get_req in later_gets)
+
+    # which is cached separately from the csv
+    fs = fsspec.filesystem("csvbase")
+    assert fs._get_cached_rep("test/columnar", ContentType.CSV, "") is None
+
+
+def test_fsspec__read_arrow(fake_csvbase):
+    fake_csvbase.tables["test/arrow"] = b"a,b\n1,2\n3,4\n"
+    fs = fsspec.filesystem("csvbase")
+
+    table = fs.read_arrow("test/arrow")
+    assert table.to_pydict() == {"a": [1, 3], "b": [2, 4]}
+
+    (arrow_path,) = get_fs_cache().directory.glob("*.arrow")
+    inode = arrow_path.stat().st_ino
+
+    # not rebuilt when the table hasn't changed
+    assert fs.read_arrow("test/arrow").equals(table)
+    assert arrow_path.stat().st_ino == inode
+
+    # but is when it has
+    fake_csvbase.tables["test/arrow"] = b"a,b\n5,6\n"
+    assert fs.read_arrow("test/arrow").to_pydict() == {"a": [5], "b": [6]}
+
+
+def test_fsspec__fresh_read_not_revalidated(fake_csvbase):
+    fake_csvbase.tables["test/fresh"] = b"a,b\n1,2\n"
+    fs = fsspec.filesystem("csvbase", max_age=60)
+
+    for _ in range(2):
+        with fs.open("test/fresh") as table_f:
+            assert table_f.read() == b"a,b\n1,2\n"
+    assert fs.info("test/fresh")["size"] == len(b"a,b\n1,2\n")
+
+    # only the first read asked the server
+    assert len(fake_csvbase.requests) == 1
+
+    # unless a shorter max_age is given
+    with fs.open("test/fresh", max_age=0) as table_f:
+        table_f.read()
+    assert fake_csvbase.requests[-1].headers["If-None-Match"] is not None
+
+
+def test_fsspec__server_max_age_honoured(fake_csvbase):
+    fake_csvbase.tables["test/fresh"] = b"a,b\n1,2\n"
+    fake_csvbase.cache_control = "max-age=60"
+    fs = fsspec.filesystem("csvbase")
+
+    for _ in range(2):
+        with fs.open("test/fresh") as table_f:
+            table_f.read()
+    assert len(fake_csvbase.requests) == 1
+
+
+def test_fsspec__server_no_cache_honoured(fake_csvbase):
+    fake_csvbase.tables["test/fresh"] = b"a,b\n1,2\n"
+    fake_csvbase.cache_control = "no-cache"
+    fs = fsspec.filesystem("csvbase", max_age=60)
+
+    for _ in range(2):
+        with fs.open("test/fresh") as table_f:
+            table_f.read()
+    assert len(fake_csvbase.requests) == 2
+
+
+def test_fsspec__only_if_cached(fake_csvbase):
+    table = b"a,b\n1,2\n"
+    fake_csvbase.tables["test/offline"] = table
+    fs = fsspec.filesystem("csvbase", cache_policy=CachePolicy.ONLY_IF_CACHED)
+
+    with pytest.raises(CSVBaseException):
+        fs.open("test/offline")
+
+    with fs.open("test/offline", cache_policy=CachePolicy.DEFAULT) as table_f:
+        table_f.read()
+
+    # then even if the table changes, the cached copy is used
+    fake_csvbase.tables["test/offline"] = b"a,b\n3,4\n"
+    for lazy in [False, True]:
+        with fs.open("test/offline", lazy=lazy) as table_f:
+            assert table_f.read() == table
+    assert fs.info("test/offline")["size"] == len(table)
+    assert len(fake_csvbase.requests) == 1
+
+
+def test_fsspec__only_if_cached_lazy_without_blob(fake_csvbase):
+    """If the etag of a table is known but its blob isn't cached (eg: it was
+    evicted) then reading it offline, even lazily, should fail at once."""
+    table = b"a,b\n1,2\n"
+    fake_csvbase.tables["test/no-blob"] = table
+    fs = fsspec.filesystem("csvbase", cache_policy=CachePolicy.ONLY_IF_CACHED)
+    with fs.open("test/no-blob", cache_policy=CachePolicy.DEFAULT) as table_f:
+        table_f.read()
+    for blob_path in get_fs_cache().directory.glob("v0_blobs_*"):
+        blob_path.unlink()
+
+    with pytest.raises(CSVBaseException):
+        fs.open("test/no-blob", lazy=True)
+    with pytest.raises(CSVBaseException):
+        fs.info("test/no-blob")
+    with pytest.raises(CSVBaseException):
+        fs._get_rep_range("test/no-blob", ContentType.CSV, etag_for(table), 0, 1)
+    assert len(fake_csvbase.requests) == 1
+
+
+def test_fsspec__no_cache(fake_csvbase):
+    fake_csvbase.tables["test/no-cache"] = b"a,b\n1,2\n"
+    fs = fsspec.filesystem("csvbase", max_age=60)
+
+    for _ in range(2):
+        with fs.open("test/no-cache", cache_policy=CachePolicy.NO_CACHE) as table_f:
+            table_f.read()
+
+    assert len(fake_csvbase.requests) == 2
+    assert all("If-None-Match" not in r.headers for r in fake_csvbase.requests)
+
+
+def test_fsspec__copies_stored_once(fake_csvbase):
+    table = b"a,b\n" + b"1,2\n" * 100
+    fs = fsspec.filesystem("csvbase")
+    for ref in ["test/original", "test/copy"]:
+        fake_csvbase.tables[ref] = table
+        with fs.open(ref) as table_f:
+            assert table_f.read() == table
+
+    assert len(list(get_fs_cache().directory.glob("v0_blobs_*"))) == 1
+    for ref in ["test/original", "test/copy"]:
+        with fs._get_cached_rep(ref, ContentType.CSV, etag_for(table)) as rep:
+            assert rep.read() == table
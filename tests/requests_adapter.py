@@ -35,7 +35,7 @@ class FlaskAdapter(BaseAdapter):
             path=request.path_url,
             method=request.method,
             headers=dict(request.headers),
-            data=request.body.read() if request.body is not None else None,
+            data=_read_body(request.body),
         )
         response = requests.Response()
         response.status_code = flask_response.status_code
@@ -45,3 +45,13 @@ class FlaskAdapter(BaseAdapter):
         response.headers = flask_response.headers
         self.request_response_pairs.append((request, response))
         return response
+
+
+def _read_body(body):
+    if body is None or isinstance(body, (bytes, str)):
+        return body
+    elif hasattr(body, "read"):
+        return body.read()
+    else:
+        # an iterable of chunks (ie: chunked transfer encoding)
+        return b"".join(body)
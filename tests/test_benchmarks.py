@@ -0,0 +1,62 @@
+"""Check that the benchmarks still run (not how fast)."""
+
+import sys
+
+from benchmarks import bench_concurrency, bench_startup
+from benchmarks.bench_fsspec import BENCHMARK_NAMES, run_suite
+from benchmarks.harness import StandInSettings, make_table, percentile
+
+
+def test_make_table():
+    table = make_table(1000, seed="a")
+    assert len(table) == 1000
+    assert table == make_table(1000, seed="a")
+    assert table != make_table(1000, seed="b")
+
+
+def test_percentile():
+    values = [float(n) for n in range(1, 101)]
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 99) == 99.0
+    assert percentile([1.0], 95) == 1.0
+
+
+def test_bench_fsspec():
+    results = run_suite([1024], repeat=1, settings=StandInSettings(latency=0.001))
+
+    assert [result.benchmark for result in results] == BENCHMARK_NAMES
+    by_name = {result.benchmark: result.as_json() for result in results}
+    assert by_name["get_rep_miss"]["outcomes"] == {"miss": 1}
+    assert by_name["get_rep_304"]["outcomes"] == {"revalidated": 1}
+    assert by_name["get_rep_fresh"]["outcomes"] == {"fresh": 1}
+    assert all(r["peak_memory_bytes"] > 0 for r in by_name.values())
+
+
+def test_bench_concurrency():
+    results = bench_concurrency.run_suite(
+        threads=[2],
+        processes=[2],
+        threads_per_process=1,
+        patterns=["identical"],
+        mode="304",
+        opens=2,
+        size=1024,
+        settings=StandInSettings(),
+    )
+
+    assert [result.benchmark for result in results] == ["threads", "processes"]
+    for result in results:
+        as_json = result.as_json()
+        assert as_json["opens"] == 4
+        assert as_json["throughput_opens_per_second"] > 0
+        assert as_json["lock_wait_seconds"] >= 0
+
+
+def test_bench_startup():
+    target = ("module", [sys.executable, "-m", "csvbase_client.internals.cli"])
+    results = bench_startup.run_suite([target], repeat=1, warmup=0)
+
+    assert [result.benchmark for result in results] == ["python_startup"] + [
+        name for name, _, _ in bench_startup.COMMANDS
+    ]
+    assert all(result.peak_memory_bytes for result in results)
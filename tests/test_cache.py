@@ -1,9 +1,38 @@
+import gzip
+import multiprocessing
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
 from pathlib import Path
 from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+from pyappcache.fs import FilesystemCache
 
 from csvbase_client.constants import CSVBASE_DOT_COM
-from csvbase_client.internals.cache import get_fs_cache, RepKey
-from csvbase_client.internals.value_objs import ContentType
+from csvbase_client.internals.cache import (
+    cache_contents,
+    cache_totals,
+    get_cache_max_size,
+    get_fs_cache,
+    rep_size,
+    store_blob,
+    get_last_metadata,
+    get_last_rep,
+    is_fresh,
+    set_etag,
+    BlobKey,
+    RepKey,
+    CacheCompressor,
+    CACHE_MAX_SIZE_ENV_VAR,
+    CHUNK_SIZE,
+    METADATA_LOCK,
+)
+from csvbase_client.internals.config import parse_size
+from csvbase_client.exceptions import CSVBaseException
+from csvbase_client.internals.value_objs import ContentType, RepMetadata
 from csvbase_client.io import rewind
 
 
@@ -25,3 +54,369 @@ def test_fs_cache__getting_and_setting(tmpdir):
     # assert that i can get it
     actual = cache.get(key)
     assert actual.read() == filelike.read()
+
+
+def test_fs_cache__set_copies_without_the_metadata_lock(tmpdir):
+    cache = get_fs_cache(Path(str(tmpdir)))
+    lock_free = []
+
+    def try_lock() -> None:
+        if METADATA_LOCK.acquire(timeout=1):
+            METADATA_LOCK.release()
+            lock_free.append(True)
+        else:
+            lock_free.append(False)
+
+    class SlowReader(BytesIO):
+        def read(self, *args):
+            # other threads can use the cache while this is copied
+            other = threading.Thread(target=try_lock)
+            other.start()
+            other.join()
+            return super().read(*args)
+
+    cache.set_raw("slow", SlowReader(b"a\n1\n"), 0)
+
+    assert lock_free and all(lock_free)
+    assert cache.get_raw("slow").read() == b"a\n1\n"
+
+
+def test_fs_cache__store_blob(tmpdir):
+    cache = get_fs_cache(Path(str(tmpdir)))
+    body = b"a,b\n" + b"1,2\n" * (CHUNK_SIZE // 2)
+
+    blob, rep = store_blob(cache, BytesIO(body))
+    with rep:
+        assert rep.read() == body
+
+    # no temporary files are left behind
+    assert [p.name for p in cache.directory.glob("v0_blobs_*")] == [f"v0_blobs_{blob}"]
+    assert list(cache.directory.glob(".tmp-*")) == []
+    assert cache.get(BlobKey(blob)).read() == body
+
+
+def test_fs_cache__blob_recorded_before_release(tmpdir):
+    """A blob that has just been stored can't be released (by another thread)
+    before its etag is recorded."""
+    cache = get_fs_cache(Path(str(tmpdir)))
+    releasers = []
+
+    def record(blob: str) -> None:
+        releaser = threading.Thread(target=cache.release_blob, args=(blob,))
+        releaser.start()
+        releaser.join(timeout=0.1)
+        assert releaser.is_alive(), "not held off by the metadata lock"
+        releasers.append(releaser)
+        set_etag(cache, CSVBASE_DOT_COM, "test/a", ContentType.CSV, "etag", blob=blob)
+
+    store_blob(cache, BytesIO(b"a\n1\n"), record)[1].close()
+    releasers[0].join()
+
+    with get_last_rep(cache, CSVBASE_DOT_COM, "test/a", ContentType.CSV) as rep:
+        assert rep.read() == b"a\n1\n"
+
+
+def test_fs_cache__blob_too_big_to_keep(tmpdir):
+    """A blob too big for the cache is evicted at once, and its etag with it."""
+    cache = get_fs_cache(Path(str(tmpdir)))
+    cache.max_size_bytes = 10
+    table = b"a\n" + b"1\n" * 100
+
+    blob, rep = store_blob(
+        cache,
+        BytesIO(table),
+        lambda blob: set_etag(
+            cache, CSVBASE_DOT_COM, "test/big", ContentType.CSV, "etag", blob=blob
+        ),
+    )
+    with rep:
+        assert rep.read() == table
+
+    assert (
+        get_last_metadata(cache, CSVBASE_DOT_COM, "test/big", ContentType.CSV) is None
+    )
+    assert list(cache.directory.glob("v0_blobs_*")) == []
+
+
+def test_fs_cache__etag_table_migrated(tmpdir):
+    """Check that caches created before the etags table had metadata columns
+    get them added."""
+    cache_dir = Path(str(tmpdir))
+    conn = sqlite3.connect(str(cache_dir / FilesystemCache.METADATA_DB_FILENAME))
+    conn.execute("""
+        CREATE TABLE etags (
+            base_url NOT NULL,
+            ref NOT NULL,
+            content_type NOT NULL,
+            etag NOT NULL,
+            PRIMARY KEY (base_url, ref, content_type)
+        );
+        """)
+    conn.commit()
+
+    cache = get_fs_cache(cache_dir)
+    set_etag(cache, CSVBASE_DOT_COM, "test/test", ContentType.CSV, "an-etag", size=4)
+    metadata = get_last_metadata(cache, CSVBASE_DOT_COM, "test/test", ContentType.CSV)
+    assert metadata is not None
+    assert (metadata.etag, metadata.size, metadata.last_modified) == (
+        "an-etag",
+        4,
+        None,
+    )
+    assert metadata.validated_at is not None
+
+
+def test_fs_cache__reused(tmpdir):
+    cache = get_fs_cache(Path(str(tmpdir)))
+    assert get_fs_cache(Path(str(tmpdir))) is cache
+    (journal_mode,) = cache.metadata_conn.execute("PRAGMA journal_mode;").fetchone()
+    assert journal_mode == "wal"
+
+
+def test_fs_cache__last_read_batched(tmpdir):
+    cache = get_fs_cache(Path(str(tmpdir)))
+    key = RepKey(CSVBASE_DOT_COM, "test/test", ContentType.CSV)
+    cache.set(key, BytesIO(b"rhubarb"))
+    cache.flush()
+
+    def last_read():
+        (rv,) = cache.metadata_conn.execute(
+            "SELECT last_read FROM pyappcache WHERE key = 'v0/test/test.csv'"
+        ).fetchone()
+        return rv
+
+    before = last_read()
+    cache.get(key)
+    assert last_read() == before, "last_read was not held back"
+    cache.flush()
+    assert last_read() != before
+
+
+@pytest.mark.parametrize("coding", [None, "gzip"])
+def test_fs_cache__compressed_at_rest(tmpdir, coding):
+    cache = get_fs_cache(Path(str(tmpdir)))
+    cache.compressor = CacheCompressor(coding, level=1)
+    body = b"a,b\n" + b"1,2\n" * 10_000
+
+    blob, rep = store_blob(cache, BytesIO(body))
+    with rep:
+        assert rep.read() == body
+    key = BlobKey(blob)
+    with cache.get(key) as rep:
+        assert rep.read(4) == b"a,b\n"
+        assert rep.read() == body[4:]
+    with cache.get(key) as rep:
+        assert rep_size(rep) == len(body)
+
+    (entry_path,) = Path(str(tmpdir)).glob("v0_blobs_*")
+    if coding is None:
+        assert entry_path.read_bytes() == body
+    else:
+        assert gzip.decompress(entry_path.read_bytes()) == body
+
+
+def test_cache_compressor__unknown_coding():
+    with pytest.raises(CSVBaseException):
+        CacheCompressor("lzma")
+
+
+def test_fs_cache__evicts_least_recently_read(tmpdir):
+    cache = get_fs_cache(Path(str(tmpdir)))
+    cache.max_size_bytes = 250
+    refs = ["test/a", "test/b", "test/c"]
+    for ref in refs:
+        blob, rep = store_blob(cache, BytesIO(ref.encode("utf-8") * 20))
+        rep.close()
+        set_etag(cache, CSVBASE_DOT_COM, ref, ContentType.CSV, f"etag-{ref}", blob=blob)
+        if ref == "test/b":
+            # read "a" again, so that it is more recently read than "b"
+            get_last_rep(cache, CSVBASE_DOT_COM, "test/a", ContentType.CSV).close()
+
+    assert len(list(cache.directory.glob("v0_blobs_*"))) == 2
+    assert get_last_rep(cache, CSVBASE_DOT_COM, "test/b", ContentType.CSV) is None
+    # the etag went too
+    assert get_last_metadata(cache, CSVBASE_DOT_COM, "test/b", ContentType.CSV) is None
+    assert [ce.ref for ce in cache_contents(cache)] == ["test/a", "test/c"]
+
+
+def test_fs_cache__blobs_deduplicated(tmpdir):
+    cache = get_fs_cache(Path(str(tmpdir)))
+    refs = ["test/original", "test/copy"]
+    for ref in refs:
+        blob, rep = store_blob(cache, BytesIO(b"a,b\n1,2\n"))
+        rep.close()
+        set_etag(cache, CSVBASE_DOT_COM, ref, ContentType.CSV, "an-etag", blob=blob)
+    (blob_path,) = cache.directory.glob("v0_blobs_*")
+    for ref in refs:
+        with get_last_rep(cache, CSVBASE_DOT_COM, ref, ContentType.CSV) as rep:
+            assert rep.read() == b"a,b\n1,2\n"
+
+    # the blob stays while anything refers to it
+    for ref in refs:
+        assert blob_path.exists()
+        blob, rep = store_blob(cache, BytesIO(ref.encode("utf-8")))
+        rep.close()
+        set_etag(cache, CSVBASE_DOT_COM, ref, ContentType.CSV, "new-etag", blob=blob)
+    assert not blob_path.exists()
+    assert len(list(cache.directory.glob("v0_blobs_*"))) == 2
+
+
+def test_cache_contents__sorted_filtered_and_totalled(tmpdir):
+    cache = get_fs_cache(Path(str(tmpdir)))
+    other_base_url = "http://localhost:6001/"
+    tables = [
+        (CSVBASE_DOT_COM, "alice/small", b"a\n1\n"),
+        (CSVBASE_DOT_COM, "alice/large", b"a\n1\n" * 100),
+        (CSVBASE_DOT_COM, "bob/copy", b"a\n1\n" * 100),
+        (other_base_url, "alice/elsewhere", b"a\n2\n"),
+    ]
+    for base_url, ref, table in tables:
+        blob, rep = store_blob(cache, BytesIO(table))
+        rep.close()
+        set_etag(
+            cache, base_url, ref, ContentType.CSV, "etag", size=len(table), blob=blob
+        )
+
+    assert [ce.ref for ce in cache_contents(cache)] == [
+        "alice/elsewhere",
+        "alice/large",
+        "alice/small",
+        "bob/copy",
+    ]
+    assert [ce.ref for ce in cache_contents(cache, "size", "alice/*")] == [
+        "alice/large",
+        "alice/elsewhere",
+        "alice/small",
+    ]
+    (elsewhere,) = cache_contents(cache, ref_glob="*/elsewhere")
+    assert elsewhere.base_url == other_base_url
+
+    totals = cache_totals(cache)
+    assert totals.entries == 4
+    assert totals.logical_size_bytes == 4 + 400 + 400 + 4
+    # the copy shares a blob
+    assert totals.size_bytes == 4 + 400 + 4
+    assert cache_totals(cache, "nobody/*").entries == 0
+
+
+def test_cache_contents__streamed_while_writing(tmpdir):
+    cache = get_fs_cache(Path(str(tmpdir)))
+    refs = [f"test/{n}" for n in range(3)]
+
+    def cache_table(ref: str) -> None:
+        blob, rep = store_blob(cache, BytesIO(ref.encode("utf-8")))
+        rep.close()
+        set_etag(cache, CSVBASE_DOT_COM, ref, ContentType.CSV, "etag", blob=blob)
+
+    for ref in refs:
+        cache_table(ref)
+
+    contents = cache_contents(cache)
+    first = next(contents)
+    # other threads can write meanwhile
+    writer = threading.Thread(target=cache_table, args=("test/later",))
+    writer.start()
+    writer.join(timeout=5)
+    assert not writer.is_alive()
+
+    assert [first.ref] + [ce.ref for ce in contents] == refs
+
+
+def test_fs_cache__removes_orphans(tmpdir):
+    cache = get_fs_cache(Path(str(tmpdir)))
+    blob, rep = store_blob(cache, BytesIO(b"a\n1\n"))
+    rep.close()
+    old_orphan = cache.directory / ".tmp-old"
+    old_orphan.write_bytes(b"left behind")
+    os.utime(old_orphan, (0, 0))
+    new_orphan = cache.directory / ".tmp-new"
+    new_orphan.write_bytes(b"being written")
+
+    cache.remove_orphans()
+
+    assert not old_orphan.exists()
+    assert new_orphan.exists()
+    assert cache.get(BlobKey(blob)).read() == b"a\n1\n"
+
+
+def test_fs_cache__orphans_looked_for_occasionally(tmpdir):
+    """Evicting only looks for orphans once per ORPHAN_SECONDS."""
+    cache = get_fs_cache(Path(str(tmpdir)))
+    cache.max_size_bytes = 10
+    with patch.object(cache, "remove_orphans", wraps=cache.remove_orphans) as mocked:
+        for n in range(3):
+            store_blob(cache, BytesIO(b"a\n" * (10 + n)))[1].close()
+    assert mocked.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "size, expected",
+    [(100, 100), ("100", 100), ("2K", 2048), ("1.5GB", 1536 * 1024**2)],
+)
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+def test_cache_max_size_from_env(monkeypatch):
+    monkeypatch.setenv(CACHE_MAX_SIZE_ENV_VAR, "5G")
+    assert get_cache_max_size() == 5 * 1024**3
+
+
+@pytest.mark.parametrize(
+    "age, server_max_age, max_age, expected",
+    [
+        (10, None, None, False),
+        (10, None, 60, True),
+        (10, None, 5, False),
+        (10, 60, None, True),
+        (10, 5, None, False),
+        (10, 5, 60, False),
+        (10, 0, 60, False),
+        (-10, None, 60, False),
+    ],
+)
+def test_is_fresh(age, server_max_age, max_age, expected):
+    metadata = RepMetadata(
+        etag="an-etag",
+        size=4,
+        validated_at=datetime.utcnow() - timedelta(seconds=age),
+        max_age=server_max_age,
+    )
+    assert is_fresh(metadata, max_age) is expected
+
+
+def test_is_fresh__never_validated():
+    assert not is_fresh(RepMetadata(etag="an-etag", size=4), 60)
+
+
+def _hold_lock(cache_dir: str, acquired, release) -> None:
+    cache = get_fs_cache(Path(cache_dir))
+    with cache.lock(RepKey(CSVBASE_DOT_COM, "test/locked", ContentType.CSV)):
+        acquired.set()
+        release.wait(10)
+
+
+def test_fs_cache__lock_excludes_other_processes(tmpdir):
+    context = multiprocessing.get_context("spawn")
+    acquired, release = context.Event(), context.Event()
+    child = context.Process(target=_hold_lock, args=(str(tmpdir), acquired, release))
+    child.start()
+    try:
+        assert acquired.wait(30)
+        cache = get_fs_cache(Path(str(tmpdir)))
+        lock = cache.lock(RepKey(CSVBASE_DOT_COM, "test/locked", ContentType.CSV))
+        got_lock = threading.Event()
+
+        def take_lock() -> None:
+            with lock:
+                got_lock.set()
+
+        thread = threading.Thread(target=take_lock)
+        thread.start()
+        assert not got_lock.wait(0.2)
+        release.set()
+        assert got_lock.wait(10)
+        thread.join()
+    finally:
+        release.set()
+        child.join()
@@ -0,0 +1,70 @@
+import gzip
+from threading import Thread
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from csvbase_client.internals import http
+from csvbase_client.internals.http import (
+    SessionPool,
+    compress_chunks,
+    parse_cache_control,
+    request_body_encoding,
+)
+
+
+def test_session_pool__one_session_per_thread():
+    pool = SessionPool(pool_size=2)
+    other_thread_seshes = []
+    with patch.object(http, "_get_http_sesh", side_effect=requests.Session):
+        sesh = pool.get()
+        thread = Thread(target=lambda: other_thread_seshes.append(pool.get()))
+        thread.start()
+        thread.join()
+
+        assert pool.get() is sesh
+
+    (other_sesh,) = other_thread_seshes
+    assert other_sesh is not sesh
+
+    # but they share connections
+    url = "https://csvbase.com/"
+    assert sesh.get_adapter(url) is other_sesh.get_adapter(url)
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        ("", None),
+        ("identity", None),
+        ("gzip", "gzip"),
+        ("deflate, GZIP;q=0.5", "gzip"),
+    ],
+)
+def test_request_body_encoding(accept_encoding, expected):
+    assert request_body_encoding({"Accept-Encoding": accept_encoding}) == expected
+
+
+def test_compress_chunks__gzip():
+    chunks = [b"a,b\n", b"", b"1,2\n" * 100]
+    assert gzip.decompress(b"".join(compress_chunks(chunks, "gzip"))) == b"".join(
+        chunks
+    )
+
+
+@pytest.mark.parametrize(
+    "cache_control, expected",
+    [
+        (None, None),
+        ("public", None),
+        ("max-age=60", 60),
+        ("public, Max-Age=60", 60),
+        ("max-age=60, no-cache", 0),
+        ("no-store", 0),
+        ("max-age=soon", 0),
+    ],
+)
+def test_parse_cache_control(cache_control, expected):
+    headers = {"Cache-Control": cache_control} if cache_control is not None else {}
+    assert parse_cache_control(headers) == expected
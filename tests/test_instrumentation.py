@@ -0,0 +1,117 @@
+from typing import List
+
+import fsspec
+import pytest
+
+from csvbase_client.exceptions import CSVBaseException
+from csvbase_client.instrumentation import (
+    Event,
+    Operation,
+    Phase,
+    Stats,
+    add_hook,
+    measure,
+    remove_hook,
+)
+from csvbase_client.internals.value_objs import CacheOutcome, ContentType
+
+
+@pytest.fixture()
+def events():
+    received: List[Event] = []
+    add_hook(received.append)
+    yield received
+    remove_hook(received.append)
+
+
+def test_get_rep__outcomes(fake_csvbase, events):
+    table = b"a,b\n1,2\n"
+    fake_csvbase.tables["test/table"] = table
+    fs = fsspec.filesystem("csvbase")
+
+    for max_age in [None, 0, 60]:
+        fs._get_rep("test/table", ContentType.CSV, max_age=max_age).close()
+
+    get_reps = [e for e in events if e.operation == Operation.GET_REP]
+    assert [e.outcome for e in get_reps] == [
+        CacheOutcome.MISS,
+        CacheOutcome.REVALIDATED,
+        CacheOutcome.FRESH,
+    ]
+    miss, revalidated, fresh = get_reps
+    assert miss.bytes == len(table)
+    assert miss.phases.keys() == set(Phase)
+    assert revalidated.bytes == 0
+    assert Phase.TRANSFER not in revalidated.phases
+    assert fresh.phases.keys() == {Phase.LOCK_WAIT, Phase.CACHE_LOOKUP}
+    assert all(e.seconds >= sum(e.phases.values()) for e in get_reps)
+
+
+def test_open__events(fake_csvbase, events):
+    fake_csvbase.tables["test/table"] = b"a,b\n1,2\n"
+    fs = fsspec.filesystem("csvbase")
+    with fs.open("test/table.parquet", "wb") as table_f:
+        table_f.write(b"PAR1")
+    with fs.open("test/table") as table_f:
+        table_f.read()
+    with fs.open("test/table", lazy=True, max_age=0) as table_f:
+        table_f.read()
+
+    assert [(e.operation, e.path()) for e in events] == [
+        (Operation.SEND_REP, "test/table.parquet"),
+        (Operation.GET_REP, "test/table"),
+        (Operation.MAP_REP, "test/table"),
+        (Operation.GET_REP_METADATA, "test/table"),
+        (Operation.MAP_REP, "test/table"),
+    ]
+    assert events[0].bytes == len(b"PAR1")
+    assert events[3].outcome == CacheOutcome.REVALIDATED
+
+
+def test_failed_operation(fake_csvbase, events):
+    fs = fsspec.filesystem("csvbase")
+    with pytest.raises(CSVBaseException):
+        fs.open("test/missing")
+
+    (event,) = events
+    assert event.failed
+    assert event.outcome is None
+
+
+def test_failing_hook_is_not_raised(events):
+    def bad_hook(event: Event) -> None:
+        raise RuntimeError("bad hook")
+
+    add_hook(bad_hook)
+    try:
+        with measure(Operation.GET_REP, "test/table", ContentType.CSV):
+            pass
+    finally:
+        remove_hook(bad_hook)
+    # other hooks still get the event
+    assert len(events) == 1
+
+
+def test_stats():
+    stats = Stats()
+    add_hook(stats)
+    try:
+        for ref, outcome in [
+            ("test/a", CacheOutcome.MISS),
+            ("test/a", CacheOutcome.FRESH),
+            ("test/b", CacheOutcome.MISS),
+        ]:
+            with measure(Operation.GET_REP, ref, ContentType.CSV) as event:
+                event.bytes = 10
+                event.outcome = outcome
+    finally:
+        remove_hook(stats)
+
+    by_path = stats.by_path()
+    assert list(by_path) == ["test/a", "test/b"]
+    assert by_path["test/a"].operations == 2
+    assert by_path["test/a"].bytes == 20
+    total = stats.total()
+    assert total.operations == 3
+    assert total.bytes == 30
+    assert total.outcomes[CacheOutcome.MISS] == 2
@@ -0,0 +1,28 @@
+from typing import Iterator, List
+
+import pytest
+
+from csvbase_client.io import ChunkPipe
+
+
+def test_chunk_pipe():
+    received: List[bytes] = []
+    pipe = ChunkPipe(received.extend, max_pending=1)
+    for chunk in [b"a", b"", b"b", b"c"]:
+        pipe.write(chunk)
+    pipe.close()
+
+    assert received == [b"a", b"b", b"c"]
+
+
+def test_chunk_pipe__consumer_fails():
+    def consumer(chunks: Iterator[bytes]) -> None:
+        next(chunks)
+        raise RuntimeError("consumer failed")
+
+    pipe = ChunkPipe(consumer, max_pending=1)
+    with pytest.raises(RuntimeError, match="consumer failed"):
+        # the writer notices rather than blocking forever
+        for _ in range(10):
+            pipe.write(b"a")
+        pipe.close()